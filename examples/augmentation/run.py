@@ -0,0 +1,83 @@
+"""Throughput of batch augmentation ops on CIFAR-10 sized NHWC batches."""
+
+import argparse
+import os
+import time
+
+import numpy as np
+from tinynn.utils.augmentation import Compose
+from tinynn.utils.augmentation import Cutout
+from tinynn.utils.augmentation import Mixup
+from tinynn.utils.augmentation import RandomCrop
+from tinynn.utils.augmentation import RandomFlip
+from tinynn.utils.augmentation import RandomTranslate
+from tinynn.utils.data_iterator import BatchIterator
+from tinynn.utils.dataset import cifar10
+from tinynn.utils.seeder import random_seed
+
+
+def per_sample_pipeline(images, targets):
+    # the same crop + flip + cutout done sample by sample in Python
+    outputs = np.empty_like(images)
+    for i, image in enumerate(images):
+        image = np.pad(image, ((4, 4), (4, 4), (0, 0)))
+        top, left = np.random.randint(0, 9, size=2)
+        image = image[top: top + 32, left: left + 32]
+        if np.random.uniform() < 0.5:
+            image = image[:, ::-1]
+        image = image.copy()
+        cy, cx = np.random.randint(0, 32, size=2)
+        image[max(cy - 4, 0): cy + 4, max(cx - 4, 0): cx + 4] = 0.0
+        outputs[i] = image
+    return outputs, targets
+
+
+def benchmark(name, op, images, targets, args):
+    iterator = BatchIterator(batch_size=args.batch_size, batch_transform=op)
+    t_start = time.time()
+    n_images = 0
+    for _ in range(args.num_ep):
+        for batch in iterator(images, targets):
+            n_images += len(batch.inputs)
+    cost = time.time() - t_start
+    print("%-28s %10.0f images/sec" % (name, n_images / cost))
+
+
+def main(args):
+    random_seed(args.seed)
+    if args.synthetic:
+        images = np.random.uniform(size=(10000, 32, 32, 3)).astype(np.float32)
+        targets = np.random.randint(0, 10, len(images))
+    else:
+        train_set, _ = cifar10(args.data_dir, channels_last=True)
+        images = train_set[0].reshape((-1, 32, 32, 3))
+        targets = train_set[1]
+
+    ops = [
+        ("none", None),
+        ("RandomCrop(padding=4)", RandomCrop(padding=4)),
+        ("RandomTranslate(4)", RandomTranslate(max_shift=4)),
+        ("RandomFlip", RandomFlip()),
+        ("Cutout(8)", Cutout(size=8)),
+        ("Mixup(1.0)", Mixup(alpha=1.0, num_classes=10)),
+        ("crop+flip+cutout", Compose([
+            RandomCrop(padding=4), RandomFlip(), Cutout(size=8)])),
+        ("crop+flip+cutout per sample", per_sample_pipeline),
+    ]
+    for name, op in ops:
+        benchmark(name, op, images, targets, args)
+
+
+if __name__ == "__main__":
+    curr_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str,
+                        default=os.path.join(curr_dir, "data"))
+    parser.add_argument("--synthetic", action="store_true",
+                        help="Use random images instead of CIFAR-10.")
+    parser.add_argument("--batch_size", default=128, type=int)
+    parser.add_argument("--num_ep", default=1, type=int)
+    parser.add_argument("--seed", default=31, type=int)
+    args = parser.parse_args()
+    main(args)
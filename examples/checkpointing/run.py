@@ -0,0 +1,81 @@
+"""Memory benchmark of gradient checkpointing on a deep teacher_net variant."""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from tinynn.core.layer import Conv2D
+from tinynn.core.layer import Dense
+from tinynn.core.layer import Flatten
+from tinynn.core.layer import MaxPool2D
+from tinynn.core.layer import ReLU
+from tinynn.core.loss import SoftmaxCrossEntropy
+from tinynn.core.model import Model
+from tinynn.core.net import Net
+from tinynn.core.optimizer import Adam
+from tinynn.utils.seeder import random_seed
+
+
+def conv_relu(kernel):
+    return [Conv2D(kernel=kernel, stride=(1, 1), padding="SAME"), ReLU()]
+
+
+def max_pool():
+    return MaxPool2D(pool_size=(2, 2), stride=(2, 2), padding="SAME")
+
+
+def deep_teacher_net(depth):
+    # same three stages as teacher_net, with `depth` conv blocks per stage
+    layers = []
+    in_c = 1
+    for out_c in (32, 64, 128):
+        for _ in range(depth):
+            layers.extend(conv_relu((3, 3, in_c, out_c)))
+            in_c = out_c
+        layers.append(max_pool())
+    layers.extend([Flatten(), Dense(512), ReLU(), Dense(10)])
+    return Net(layers)
+
+
+def benchmark(args, boundaries):
+    random_seed(args.seed)
+    net = deep_teacher_net(args.depth)
+    net.init_params(input_shape=(28, 28, 1))
+    net.set_checkpoints(boundaries)
+    model = Model(net=net, loss=SoftmaxCrossEntropy(),
+                  optimizer=Adam(lr=1e-3))
+
+    x = np.random.normal(size=(args.batch_size, 28, 28, 1))
+    y = np.random.randint(0, 10, args.batch_size)
+
+    tracemalloc.start()
+    t_start = time.time()
+    for _ in range(args.num_steps):
+        pred = model.forward(x)
+        loss, grads = model.backward(pred, y)
+        model.apply_grads(grads)
+        del pred, grads
+    cost = (time.time() - t_start) / args.num_steps
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, cost
+
+
+def main(args):
+    print("deep teacher net: %d layers" % len(deep_teacher_net(args.depth).layers))
+    for boundaries in (None, "auto"):
+        peak, cost = benchmark(args, boundaries)
+        print("checkpoints: %-5s peak memory: %8.1f MB  time/step: %.3fs" %
+              (boundaries, peak / 1024 ** 2, cost))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", default=4, type=int,
+                        help="Number of conv blocks in each stage.")
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--num_steps", default=3, type=int)
+    parser.add_argument("--seed", default=31, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -16,8 +16,7 @@ class AutoEncoder(Model):
         return inputs
 
     def backward(self, preds, targets):
-        loss = self.loss.loss(preds, targets)
-        grad_from_loss = self.loss.grad(preds, targets)
+        loss, grad_from_loss = self.loss.loss_and_grad(preds, targets)
 
         # through decoder network
         de_grads = self.de_net.backward(grad_from_loss)
@@ -1,7 +1,6 @@
 """Implementation of asynchronous and synchronous SGD."""
 
 import argparse
-import copy
 import os
 import time
 
@@ -17,6 +16,7 @@ from tinynn.utils.data_iterator import BatchIterator
 from tinynn.utils.dataset import mnist
 from tinynn.utils.metric import accuracy
 from tinynn.utils.seeder import random_seed
+from tinynn.utils.shared_dataset import SharedDataset
 
 
 def get_model(lr):
@@ -52,9 +52,11 @@ class ParamServer:
 @ray.remote
 class Worker:
 
-    def __init__(self, model, train_set):
-        self.model = model
-        self.train_set = train_set
+    def __init__(self, shared_train_set, rank, num_workers):
+        # params are set by the parameter server before each step
+        self.model = get_model(args.lr)
+        # each worker trains on its own shard of the shared dataset
+        self.train_set = shared_train_set.shard(rank, num_workers)
 
         self.iterator = BatchIterator(batch_size=args.batch_size)
         self.batch_gen = None
@@ -86,7 +88,9 @@ def main():
         random_seed(args.seed)
 
     # data preparation
-    train_set, valid_set, test_set = mnist(args.data_dir, one_hot=True)
+    train_set, valid_set, test_set = mnist(args.data_dir)
+    # workers attach to the dataset instead of receiving copies of it
+    shared_train_set = SharedDataset(train_set)
 
     # init ray
     ray.init()
@@ -94,16 +98,17 @@ def main():
     model = get_model(args.lr)
 
     # init parameter server and workers
-    ps = ParamServer.remote(model=copy.deepcopy(model),
-                            test_set=test_set)
+    ps = ParamServer.remote(model=model, test_set=test_set)
     workers = []
-    for rank in range(1, args.num_workers + 1):
-        worker = Worker.remote(model=copy.deepcopy(model),
-                               train_set=train_set)
+    for rank in range(args.num_workers):
+        worker = Worker.remote(shared_train_set=shared_train_set, rank=rank,
+                               num_workers=args.num_workers)
         workers.append(worker)
 
     start_time = time.time()
-    iter_each_epoch = len(train_set[0]) // args.batch_size + 1
+    # an epoch is a pass of every worker over its shard
+    iter_each_epoch = len(train_set[0]) // (
+        args.batch_size * args.num_workers) + 1
     iterations = args.num_ep * iter_each_epoch
     if args.mode == "async":
         print("Run asynchronous training.")
@@ -156,13 +161,11 @@ def main():
 
 
 def evaluate(test_set, model):
-    model.set_phase("TEST")
     test_x, test_y = test_set
-    test_pred = model.forward(test_x)
+    test_pred = model.predict(test_x)
 
     test_pred_idx = np.argmax(test_pred, axis=1)
-    test_y_idx = np.argmax(test_y, axis=1)
-    return accuracy(test_pred_idx, test_y_idx)
+    return accuracy(test_pred_idx, test_y)
 
 
 if __name__ == "__main__":
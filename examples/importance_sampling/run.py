@@ -0,0 +1,92 @@
+"""Wall-clock time to a target accuracy on MNIST with loss-based importance
+sampling compared with uniform sampling."""
+
+import argparse
+import os
+import time
+
+import numpy as np
+from tinynn.core.layer import Dense
+from tinynn.core.layer import ReLU
+from tinynn.core.loss import SoftmaxCrossEntropy
+from tinynn.core.model import Model
+from tinynn.core.net import Net
+from tinynn.core.optimizer import Adam
+from tinynn.utils.data_iterator import BatchIterator
+from tinynn.utils.dataset import mnist
+from tinynn.utils.metric import accuracy
+from tinynn.utils.sampler import ImportanceSampler
+from tinynn.utils.seeder import random_seed
+
+
+def train(mode, dataset, args):
+    train_x, train_y, test_x, test_y = dataset
+    random_seed(args.seed)
+    net = Net([Dense(200), ReLU(), Dense(100), ReLU(), Dense(10)])
+    model = Model(net=net, loss=SoftmaxCrossEntropy(),
+                  optimizer=Adam(lr=args.lr))
+
+    sampler = None
+    if mode == "importance":
+        sampler = ImportanceSampler(len(train_x),
+                                    uniform_ratio=args.uniform_ratio)
+    iterator = BatchIterator(batch_size=args.batch_size, sampler=sampler)
+
+    # evaluation time is excluded from the wall-clock time
+    train_time, n_passes, n_steps = 0.0, 0, 0
+    acc = 0.0
+    for epoch in range(args.num_ep):
+        t_start = time.time()
+        for batch in iterator(train_x, train_y):
+            pred = model.forward(batch.inputs)
+            if sampler is None:
+                loss, grads = model.backward(pred, batch.targets)
+            else:
+                weights = sampler.importance_weights(batch.indices)
+                loss, grads, losses = model.weighted_backward(
+                    pred, batch.targets, weights)
+                sampler.record(batch.indices, losses)
+            model.apply_grads(grads)
+            n_passes += len(batch.inputs)
+            n_steps += 1
+
+            if n_steps % args.eval_every == 0:
+                train_time += time.time() - t_start
+                test_pred = model.predict(test_x, batch_size=args.eval_batch_size)
+                acc = accuracy(np.argmax(test_pred, axis=1), test_y)["accuracy"]
+                if acc >= args.target_accuracy:
+                    print("%-10s reached %.4f after %.2f epochs of passes "
+                          "in %.1fs" % (mode, acc, n_passes / len(train_x),
+                                        train_time))
+                    return
+                t_start = time.time()
+        train_time += time.time() - t_start
+    print("%-10s accuracy=%.4f after %d epochs in %.1fs (target %.4f not "
+          "reached)" % (mode, acc, args.num_ep, train_time,
+                        args.target_accuracy))
+
+
+def main(args):
+    train_set, _, test_set = mnist(args.data_dir)
+    dataset = (*train_set, *test_set)
+    for mode in args.modes.split(","):
+        train(mode, dataset, args)
+
+
+if __name__ == "__main__":
+    curr_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str,
+                        default=os.path.join(curr_dir, "data"))
+    parser.add_argument("--modes", default="uniform,importance", type=str)
+    parser.add_argument("--target_accuracy", default=0.98, type=float)
+    parser.add_argument("--uniform_ratio", default=0.3, type=float)
+    parser.add_argument("--num_ep", default=30, type=int)
+    parser.add_argument("--lr", default=1e-3, type=float)
+    parser.add_argument("--batch_size", default=128, type=int)
+    parser.add_argument("--eval_every", default=100, type=int)
+    parser.add_argument("--eval_batch_size", default=1000, type=int)
+    parser.add_argument("--seed", default=31, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -9,6 +9,7 @@ from tinynn.core.loss import Loss
 from tinynn.core.loss import SoftmaxCrossEntropy
 from tinynn.core.model import Model
 from tinynn.core.optimizer import Adam
+from tinynn.utils.augmentation import Normalize
 from tinynn.utils.data_iterator import BatchIterator
 from tinynn.utils.dataset import fashion_mnist
 from tinynn.utils.math import softmax
@@ -39,9 +40,18 @@ class DistillationLoss(Loss):
         return (self.alpha * distill_grad + 
                 (1 - self.alpha) * student_grad)
 
+    def loss_and_grad(self, pred, label, teacher_prob):
+        student_loss, student_grad = self.ce_loss.loss_and_grad(pred, label)
+        distill_loss, distill_grad = self.ce_loss_t.loss_and_grad(
+            pred, teacher_prob)
+        student_grad *= 1 - self.alpha
+        student_grad += self.alpha * distill_grad
+        return (self.alpha * distill_loss +
+                (1 - self.alpha) * student_loss), student_grad
+
 
 def prepare_dataset(data_dir):
-    train_set, _, test_set = fashion_mnist(data_dir, one_hot=True)
+    train_set, _, test_set = fashion_mnist(data_dir, one_hot=True, normalize=False)
     train_x, train_y = train_set
     test_x, test_y = test_set
     train_x = train_x.reshape((-1, 28, 28, 1))
@@ -53,7 +63,9 @@ def train_single_model(model, dataset, args, name="teacher"):
     print("training %s model" % name)
     train_x, train_y, test_x, test_y = dataset
 
-    iterator = BatchIterator(batch_size=args.batch_size)
+    # images are kept as uint8 and scaled per batch
+    iterator = BatchIterator(batch_size=args.batch_size,
+                             batch_transform=Normalize(scale=1 / 255.0))
     for epoch in range(args.num_ep):
         t_start = time.time()
         
@@ -105,7 +117,9 @@ def train_distill_model(dataset, args):
                     optimizer=Adam(lr=args.lr))
 
     # run training
-    iterator = BatchIterator(batch_size=args.batch_size)
+    # images are kept as uint8 and scaled per batch
+    iterator = BatchIterator(batch_size=args.batch_size,
+                             batch_transform=Normalize(scale=1 / 255.0))
     for epoch in range(args.num_ep):
         t_start = time.time()
         for i, batch in enumerate(iterator(train_x, train_y)):
@@ -113,8 +127,8 @@ def train_distill_model(dataset, args):
             teacher_out = teacher.forward(batch.inputs)
             teacher_out_prob = softmax(teacher_out, t=args.T)
 
-            loss = student.loss.loss(pred, batch.targets, teacher_out_prob)
-            grad_from_loss = student.loss.grad(pred, batch.targets, teacher_out_prob)
+            loss, grad_from_loss = student.loss.loss_and_grad(
+                pred, batch.targets, teacher_out_prob)
             grads = student.net.backward(grad_from_loss)
             student.apply_grads(grads)
         print("Epoch %d time cost: %.4f" % (epoch, time.time() - t_start))
@@ -0,0 +1,84 @@
+"""Compare LAMB/LARS with Adam on MNIST with very large batch sizes."""
+
+import argparse
+import os
+import time
+
+import numpy as np
+from tinynn.core.layer import Dense
+from tinynn.core.layer import ReLU
+from tinynn.core.loss import SoftmaxCrossEntropy
+from tinynn.core.model import Model
+from tinynn.core.net import Net
+from tinynn.core.optimizer import LAMB
+from tinynn.core.optimizer import LARS
+from tinynn.core.optimizer import Adam
+from tinynn.utils.data_iterator import BatchIterator
+from tinynn.utils.dataset import mnist
+from tinynn.utils.metric import accuracy
+from tinynn.utils.seeder import random_seed
+
+
+def get_optimizer(name, batch_size, args):
+    # scale the learning rate with the batch size (sqrt scaling)
+    scale = (batch_size / args.base_batch_size) ** 0.5
+    if name == "adam":
+        return Adam(lr=args.lr * scale)
+    elif name == "lamb":
+        return LAMB(lr=args.lr * scale, weight_decay=args.weight_decay)
+    elif name == "lars":
+        return LARS(lr=args.lars_lr * scale, weight_decay=args.weight_decay)
+    else:
+        raise ValueError("Invalid optimizer: %s" % name)
+
+
+def train(name, batch_size, dataset, args):
+    train_x, train_y, test_x, test_y = dataset
+    random_seed(args.seed)
+    net = Net([Dense(200), ReLU(), Dense(100), ReLU(), Dense(10)])
+    model = Model(net=net, loss=SoftmaxCrossEntropy(),
+                  optimizer=get_optimizer(name, batch_size, args))
+
+    iterator = BatchIterator(batch_size=batch_size)
+    t_start = time.time()
+    res = {"accuracy": 0.0}
+    for epoch in range(args.num_ep):
+        for batch in iterator(train_x, train_y):
+            pred = model.forward(batch.inputs)
+            loss, grads = model.backward(pred, batch.targets)
+            model.apply_grads(grads)
+        if not np.isfinite(loss):
+            print("%-5s bs=%-6d diverged at epoch %d" % (name, batch_size, epoch))
+            return
+        test_pred = model.predict(test_x, batch_size=args.eval_batch_size)
+        res = accuracy(np.argmax(test_pred, axis=1), test_y)
+    print("%-5s bs=%-6d epochs=%d accuracy=%.4f time=%.1fs" % (
+        name, batch_size, args.num_ep, res["accuracy"],
+        time.time() - t_start))
+
+
+def main(args):
+    train_set, _, test_set = mnist(args.data_dir)
+    dataset = (*train_set, *test_set)
+    for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+        for name in args.optimizers.split(","):
+            train(name, batch_size, dataset, args)
+
+
+if __name__ == "__main__":
+    curr_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str,
+                        default=os.path.join(curr_dir, "data"))
+    parser.add_argument("--optimizers", default="adam,lamb,lars", type=str)
+    parser.add_argument("--batch_sizes", default="4096,8192,16384", type=str)
+    parser.add_argument("--base_batch_size", default=128, type=int)
+    parser.add_argument("--num_ep", default=30, type=int)
+    parser.add_argument("--lr", default=1e-3, type=float)
+    parser.add_argument("--lars_lr", default=1.0, type=float)
+    parser.add_argument("--weight_decay", default=1e-4, type=float)
+    parser.add_argument("--eval_batch_size", default=1000, type=int)
+    parser.add_argument("--seed", default=31, type=int)
+    args = parser.parse_args()
+    main(args)
@@ -17,6 +17,7 @@ from tinynn.core.model import Model
 from tinynn.core.net import Net
 from tinynn.core.optimizer import Adam
 from tinynn.utils.data_iterator import BatchIterator
+from tinynn.utils.data_iterator import PrefetchIterator
 from tinynn.utils.dataset import mnist
 from tinynn.utils.metric import accuracy
 from tinynn.utils.seeder import random_seed
@@ -26,7 +27,7 @@ def main(args):
     if args.seed >= 0:
         random_seed(args.seed)
 
-    train_set, _, test_set = mnist(args.data_dir, one_hot=True)
+    train_set, _, test_set = mnist(args.data_dir)
     train_x, train_y = train_set
     test_x, test_y = test_set
 
@@ -75,7 +76,7 @@ def main(args):
     model = Model(net=net, loss=SoftmaxCrossEntropy(),
                   optimizer=Adam(lr=args.lr))
 
-    iterator = BatchIterator(batch_size=args.batch_size)
+    iterator = PrefetchIterator(BatchIterator(batch_size=args.batch_size))
     loss_list = list()
     for epoch in range(args.num_ep):
         t_start = time.time()
@@ -84,15 +85,13 @@ def main(args):
             loss, grads = model.backward(pred, batch.targets)
             model.apply_grads(grads)
             loss_list.append(loss)
-        print("Epoch %d time cost: %.4f" % (epoch, time.time() - t_start))
+        print("Epoch %d time cost: %.4f (waiting for data: %.4f)" % (
+            epoch, time.time() - t_start, iterator.wait_time))
         # evaluate
-        model.set_phase("TEST")
-        test_pred = model.forward(test_x)
+        test_pred = model.predict(test_x, batch_size=args.batch_size)
         test_pred_idx = np.argmax(test_pred, axis=1)
-        test_y_idx = np.argmax(test_y, axis=1)
-        res = accuracy(test_pred_idx, test_y_idx)
+        res = accuracy(test_pred_idx, test_y)
         print(res)
-        model.set_phase("TRAIN")
     
     # save model
     if not os.path.isdir(args.model_dir):
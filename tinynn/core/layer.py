@@ -1,9 +1,12 @@
 """Network layers."""
 
+from collections import OrderedDict
+
 import numpy as np
 from tinynn.core.initializer import Ones
 from tinynn.core.initializer import XavierUniform
 from tinynn.core.initializer import Zeros
+from tinynn.core.net import SparseGrad
 
 
 class Layer:
@@ -14,6 +17,9 @@ class Layer:
 
         self.grads = {}
         self.shapes = {}
+        # preallocated arrays bound by Net.compile
+        self.buffers = {}
+        self._buffer_requests = None
 
         self.is_training = True
         self.is_init = False
@@ -24,6 +30,56 @@ class Layer:
     def backward(self, grad):
         raise NotImplementedError
 
+    def infer_shape(self, input_shape):
+        """
+        Set up parameter shapes and return the output shape of the layer.
+        Shapes exclude the batch dimension. Layers without a shape function
+        fall back to a forward pass on a single dummy sample.
+        """
+        return self.predict(np.ones((1, *input_shape))).shape[1:]
+
+    def predict(self, inputs):
+        """Forward pass for inference that keeps no cache for backward."""
+        outputs = self.forward(inputs)
+        self.clear_cache()
+        return outputs
+
+    def clear_cache(self):
+        for name in self.cache_names:
+            setattr(self, name, None)
+
+    def _get_buffer(self, name, shape, dtype, kind="keep"):
+        """
+        Get a named output or temporary array of the layer.
+        Return the buffer bound by Net.compile if it matches the requested
+        shape and dtype, otherwise allocate a new one.
+        :param kind: Lifetime of the buffer, one of "keep" (alive until the
+            next forward, e.g. outputs and backward caches), "grad" (the
+            gradient w.r.t. the inputs) or "temp" (only used inside the call)
+        """
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        if self._buffer_requests is not None:
+            self._buffer_requests[name] = (shape, dtype, kind)
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+        return buf
+
+    def _pad(self, inputs, padding):
+        """Zero-pad NHWC inputs to the "pad" temporary buffer."""
+        (_, _), (top, bottom), (left, right), (_, _) = padding
+        if not (top or bottom or left or right):
+            return inputs
+        batch_sz, in_h, in_w, in_c = inputs.shape
+        shape = (batch_sz, in_h + top + bottom, in_w + left + right, in_c)
+        X = self._get_buffer("pad", shape, inputs.dtype, kind="temp")
+        X[:, :top] = 0.0
+        X[:, top + in_h:] = 0.0
+        X[:, :, :left] = 0.0
+        X[:, :, left + in_w:] = 0.0
+        X[:, top: top + in_h, left: left + in_w] = inputs
+        return X
+
     def set_phase(self, phase):
         self.is_training = True if phase == "TRAIN" else False
 
@@ -43,6 +99,10 @@ class Layer:
     def ut_param_names(self):
         return ()
 
+    @property
+    def cache_names(self):
+        return ()
+
 
 class Dense(Layer):
 
@@ -59,15 +119,182 @@ class Dense(Layer):
 
     def forward(self, inputs):
         if not self.is_init:
-            self.shapes["w"][0] = inputs.shape[1]
+            self.infer_shape(inputs.shape[1:])
             self._init_params()
         self.inputs = inputs
-        return inputs @ self.params["w"] + self.params["b"]
+        w = self.params["w"]
+        outputs = self._get_buffer(
+            "out", (len(inputs), w.shape[1]), np.result_type(inputs, w))
+        np.matmul(inputs, w, out=outputs)
+        outputs += self.params["b"]
+        return outputs
+
+    def predict(self, inputs):
+        if not self.is_init:
+            self.infer_shape(inputs.shape[1:])
+            self._init_params()
+        outputs = inputs @ self.params["w"]
+        outputs += self.params["b"]
+        return outputs
 
     def backward(self, grad):
         self.grads["w"] = self.inputs.T @ grad
         self.grads["b"] = np.sum(grad, axis=0)
-        return grad @ self.params["w"].T
+        w = self.params["w"]
+        d_in = self._get_buffer("d_in", (len(grad), w.shape[0]),
+                                np.result_type(grad, w), kind="grad")
+        return np.matmul(grad, w.T, out=d_in)
+
+    def infer_shape(self, input_shape):
+        self.shapes["w"][0] = input_shape[0]
+        return (self.shapes["w"][1],)
+
+    def _init_params(self):
+        for p in self.param_names:
+            self.params[p] = self.initializers[p](self.shapes[p])
+        self.is_init = True
+
+    @property
+    def param_names(self):
+        return "w", "b"
+
+    @property
+    def cache_names(self):
+        return ("inputs",)
+
+
+class Embedding(Layer):
+    """
+    Look up rows of an embedding matrix by integer indices.
+    :param num_embeddings: size of the vocabulary
+    :param embedding_dim: size of each embedding vector
+    :param w_init: weight initializer
+    The gradient w.r.t. the embedding matrix is a SparseGrad holding only
+    the rows looked up in the batch.
+    """
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 w_init=XavierUniform()):
+        super().__init__()
+
+        self.initializers = {"w": w_init}
+        self.shapes = {"w": [num_embeddings, embedding_dim]}
+
+        self.inputs = None
+
+    def forward(self, inputs):
+        if not self.is_init:
+            self._init_params()
+        self.inputs = inputs
+        w = self.params["w"]
+        outputs = self._get_buffer(
+            "out", (*inputs.shape, w.shape[1]), w.dtype)
+        return np.take(w, inputs, axis=0, out=outputs)
+
+    def backward(self, grad):
+        dim = self.shapes["w"][1]
+        rows, values = segment_sum(self.inputs.ravel(), grad.reshape((-1, dim)))
+        self.grads["w"] = SparseGrad(rows, values, tuple(self.shapes["w"]))
+        # indices are not differentiable
+        return None
+
+    def infer_shape(self, input_shape):
+        return (*input_shape, self.shapes["w"][1])
+
+    def _init_params(self):
+        for p in self.param_names:
+            self.params[p] = self.initializers[p](self.shapes[p])
+        self.is_init = True
+
+    @property
+    def param_names(self):
+        return ("w",)
+
+    @property
+    def cache_names(self):
+        return ("inputs",)
+
+
+class SampledDense(Layer):
+    """
+    Output layer to be trained with SampledSoftmaxCrossEntropy.
+    In training phase the forward pass keeps the inputs and skips the full
+    matmul. The loss then asks for logits of the target classes and a
+    shared set of sampled classes only (`sampled_logits`), and backward
+    returns row-sparse gradients of those classes. In test phase and
+    `predict` the full logits are computed as in Dense.
+    :param num_out: number of classes
+    Note that the weight matrix is stored as [num_out, num_in] so that
+    gradients of the classes are rows.
+    """
+    def __init__(self,
+                 num_out,
+                 w_init=XavierUniform(),
+                 b_init=Zeros()):
+        super().__init__()
+
+        self.initializers = {"w": w_init, "b": b_init}
+        self.shapes = {"w": [num_out, None], "b": [num_out]}
+
+        self.inputs = None
+        self.classes = None
+
+    def forward(self, inputs):
+        if not self.is_training:
+            return self.predict(inputs)
+        if not self.is_init:
+            self.infer_shape(inputs.shape[1:])
+            self._init_params()
+        self.inputs = inputs
+        return inputs
+
+    def predict(self, inputs):
+        if not self.is_init:
+            self.infer_shape(inputs.shape[1:])
+            self._init_params()
+        outputs = inputs @ self.params["w"].T
+        outputs += self.params["b"]
+        return outputs
+
+    def sampled_logits(self, labels, sampled):
+        """
+        Logits of the true classes (first column) and the sampled classes
+        (remaining columns) for the inputs of the last forward pass.
+        :param labels: true class of each sample, shape [batch_size]
+        :param sampled: sampled classes shared by the batch, shape [n]
+        """
+        w, b = self.params["w"], self.params["b"]
+        self.classes = (labels, sampled)
+        logits = np.empty((len(labels), len(sampled) + 1),
+                          dtype=np.result_type(self.inputs, w))
+        logits[:, 0] = np.einsum("ij,ij->i", self.inputs, w[labels])
+        logits[:, 0] += b[labels]
+        np.matmul(self.inputs, w[sampled].T, out=logits[:, 1:])
+        logits[:, 1:] += b[sampled]
+        return logits
+
+    def backward(self, grad):
+        labels, sampled = self.classes
+        w = self.params["w"]
+        true_grad, sampled_grad = grad[:, :1], grad[:, 1:]
+
+        classes = np.concatenate([labels, sampled])
+        w_values = np.concatenate(
+            [true_grad * self.inputs, sampled_grad.T @ self.inputs])
+        b_values = np.concatenate([true_grad[:, 0], sampled_grad.sum(axis=0)])
+        rows, w_values = segment_sum(classes, w_values)
+        _, b_values = segment_sum(classes, b_values)
+        self.grads["w"] = SparseGrad(rows, w_values, tuple(self.shapes["w"]))
+        self.grads["b"] = SparseGrad(rows, b_values, tuple(self.shapes["b"]))
+
+        d_in = true_grad * w[labels]
+        d_in += sampled_grad @ w[sampled]
+        return d_in
+
+    def infer_shape(self, input_shape):
+        self.shapes["w"][1] = input_shape[0]
+        return (self.shapes["w"][0],)
 
     def _init_params(self):
         for p in self.param_names:
@@ -78,6 +305,10 @@ class Dense(Layer):
     def param_names(self):
         return "w", "b"
 
+    @property
+    def cache_names(self):
+        return "inputs", "classes"
+
 
 class Conv2D(Layer):
     """
@@ -104,6 +335,8 @@ class Conv2D(Layer):
 
         self.padding_mode = padding
         self.padding = None
+        self._plans = PlanCache()
+        self._plan = None
 
     def forward(self, inputs):
         """
@@ -119,32 +352,46 @@ class Conv2D(Layer):
                 | 34  76  35   8 |              | 7 |
                 | 76  95   8  46 |              | 9 |
         """
+        Z, X_shape, col, W = self._conv(inputs, buffered=True)
+        # save results for backward function
+        self.X_shape, self.col, self.W = X_shape, col, W
+        return Z
+
+    def predict(self, inputs):
+        # the column matrix is released as soon as the product is done
+        return self._conv(inputs, buffered=False)[0]
+
+    def _conv(self, inputs, buffered):
         if not self.is_init:
             self._init_params()
 
         k_h, k_w, in_c, out_c = self.kernel_shape
         s_h, s_w = self.stride
+        # look up the padding and output size for this input size
+        self._plan = self._plans.get(inputs.shape[1:3], self._build_plan)
+        self.padding = self._plan["padding"]
         X = self._inputs_preprocess(inputs)
 
+        batch_sz = len(X)
+        out_h, out_w = self._plan["out_size"]
+        col_shape = (batch_sz * out_h * out_w, k_h * k_w * in_c)
+        W = self.params["w"].reshape(-1, out_c)
+
+        col, Z = None, None
+        if buffered:
+            col = self._get_buffer("col", col_shape, np.result_type(X, W))
+            Z = self._get_buffer("out", (col_shape[0], out_c),
+                                 np.result_type(col, W))
         # padded inputs to column matrix
-        col = im2col(X, k_h, k_w, s_h, s_w)
+        col = im2col(X, k_h, k_w, s_h, s_w, out=col)
         # perform convolution by matrix product.
-        W = self.params["w"].reshape(-1, out_c)
-        Z = col @ W
-        # reshape output 
-        batch_sz, in_h, in_w, _ = X.shape
-        # separate the batch size and feature map dimensions
-        Z = Z.reshape(batch_sz, Z.shape[0] // batch_sz, out_c)
-        # further divide the feature map in to (h, w) dimension
-        out_h = (in_h - k_h) // s_h + 1
-        out_w = (in_w - k_w) // s_w + 1
+        Z = np.matmul(col, W, out=Z)
+        # separate the batch size and feature map (h, w) dimensions
         Z = Z.reshape(batch_sz, out_h, out_w, out_c)
 
         # plus the bias for every filter
         Z += self.params["b"]
-        # save results for backward function
-        self.X_shape, self.col, self.W = X.shape, col, W
-        return Z
+        return Z, X.shape, col, W
 
     def backward(self, grad):
         """
@@ -167,31 +414,43 @@ class Conv2D(Layer):
         self.grads["b"] = np.sum(flat_grad, axis=0)
 
         # grads w.r.t inputs
-        d_X = grad @ self.W.T
+        d_X = self._get_buffer("d_X", (*grad.shape[:3], self.W.shape[0]),
+                               np.result_type(grad, self.W), kind="temp")
+        np.matmul(grad, self.W.T, out=d_X)
         # cast gradients back to original shape as d_in
-        d_in = np.zeros(shape=self.X_shape)
-        for i, r in enumerate(range(0, in_h - k_h + 1, s_h)):
-            for j, c in enumerate(range(0, in_w - k_w + 1, s_w)):
-                patch = d_X[:, i, j, :]
-                patch = patch.reshape((batch_sz, k_h, k_w, in_c))
-                d_in[:, r:r+k_h, c:c+k_w, :] += patch
-                
+        d_in = self._get_buffer("d_in", self.X_shape, d_X.dtype, kind="grad")
+        d_in.fill(0.0)
+        out_h, out_w = grad.shape[1:3]
+        d_X = d_X.reshape((batch_sz, out_h, out_w, k_h, k_w, in_c))
+        for i in range(k_h):
+            for j in range(k_w):
+                d_in[:, i: i + s_h * (out_h - 1) + 1: s_h,
+                     j: j + s_w * (out_w - 1) + 1: s_w, :] += d_X[:, :, :, i, j]
+
         # cut off gradients of padding
         d_in = d_in[:, pad_h[0]:in_h-pad_h[1], pad_w[0]:in_w-pad_w[1], :]
         return self._grads_postprocess(d_in)
 
+    def infer_shape(self, input_shape):
+        out_h, out_w = self._plans.get(input_shape[:2], self._build_plan)[
+            "out_size"]
+        return out_h, out_w, self.kernel_shape[-1]
+
     def _inputs_preprocess(self, inputs):
-        _, in_h, in_w, _ = inputs.shape
-        k_h, k_w, _, _ = self.kernel_shape
-        # padding calculation
-        if self.padding is None:
-            self.padding = get_padding_2d(
-                (in_h, in_w), (k_h, k_w), self.padding_mode)
-        return np.pad(inputs, pad_width=self.padding, mode="constant")
+        return self._pad(inputs, self.padding)
 
     def _grads_postprocess(self, grads):
         return grads
 
+    def _build_plan(self, in_h, in_w):
+        k_h, k_w = self.kernel_shape[:2]
+        s_h, s_w = self.stride
+        # padding calculation
+        padding = get_padding_2d((in_h, in_w), (k_h, k_w), self.padding_mode)
+        out_h = (in_h + sum(padding[1]) - k_h) // s_h + 1
+        out_w = (in_w + sum(padding[2]) - k_w) // s_w + 1
+        return {"padding": padding, "out_size": (out_h, out_w)}
+
     def _init_params(self):
         for p in self.param_names:
             self.params[p] = self.initializers[p](self.shapes[p])
@@ -201,6 +460,10 @@ class Conv2D(Layer):
     def param_names(self):
         return "w", "b"
 
+    @property
+    def cache_names(self):
+        return "col", "W"
+
 
 class ConvTranspose2D(Conv2D):
 
@@ -215,36 +478,37 @@ class ConvTranspose2D(Conv2D):
         self.stride = (1, 1)
 
     def _inputs_preprocess(self, inputs):
-        k_h, k_w = self.kernel_shape[:2]
         # insert zeros to inputs
-        inputs = self._insert_zeros(
-            inputs, *self.origin_stride, self.padding_mode)
-        batch_sz, in_h, in_w, in_c = inputs.shape
-        # padding calculation
-        if self.padding is None:
-            if self.padding_mode == "SAME":
-                self.padding = get_padding_2d(
-                    (in_h, in_w), (k_h, k_w), self.padding_mode)
-            else:
-                self.padding = ((0, 0), (k_h - 1, k_h - 1),
-                                (k_w - 1, k_w - 1), (0, 0))
-        return np.pad(inputs, pad_width=self.padding, mode="constant")
+        s_h, s_w = self.origin_stride
+        batch_sz, _, _, in_c = inputs.shape
+        expand_shape = (batch_sz, *self._plan["expand_size"], in_c)
+        expand = self._get_buffer("expand", expand_shape, inputs.dtype,
+                                  kind="temp")
+        expand.fill(0.0)
+        expand[:, ::s_h, ::s_w, :] = inputs
+        return self._pad(expand, self.padding)
 
     def _grads_postprocess(self, grads):
         return grads[:, ::self.origin_stride[0], ::self.origin_stride[1], :]
 
-    @staticmethod
-    def _insert_zeros(inputs, s_h, s_w, mode):
-        batch_sz, in_h, in_w, in_c = inputs.shape
-        if mode == "SAME":
-            out_h = in_h * s_h
-            out_w = in_w * s_w
+    def _build_plan(self, in_h, in_w):
+        k_h, k_w = self.kernel_shape[:2]
+        s_h, s_w = self.origin_stride
+        # size after zeros inserted
+        if self.padding_mode == "SAME":
+            in_h, in_w = in_h * s_h, in_w * s_w
         else:
-            out_h = (in_h - 1) * s_h + 1
-            out_w = (in_w - 1) * s_h + 1
-        expand = np.zeros((batch_sz, out_h, out_w, in_c))
-        expand[:, ::s_h, ::s_w, :] = inputs
-        return expand
+            in_h, in_w = (in_h - 1) * s_h + 1, (in_w - 1) * s_w + 1
+        # padding calculation
+        if self.padding_mode == "SAME":
+            padding = get_padding_2d(
+                (in_h, in_w), (k_h, k_w), self.padding_mode)
+        else:
+            padding = ((0, 0), (k_h - 1, k_h - 1), (k_w - 1, k_w - 1), (0, 0))
+        out_h = in_h + sum(padding[1]) - k_h + 1
+        out_w = in_w + sum(padding[2]) - k_w + 1
+        return {"padding": padding, "out_size": (out_h, out_w),
+                "expand_size": (in_h, in_w)}
 
 
 class MaxPool2D(Layer):
@@ -262,68 +526,97 @@ class MaxPool2D(Layer):
 
         self.padding_mode = padding
         self.padding = None
+        self._plans = PlanCache()
 
     def forward(self, inputs):
-        s_h, s_w = self.stride
-        k_h, k_w = self.kernel_shape
-        batch_sz, in_h, in_w, in_c = inputs.shape
+        max_pool, argmax = self._pool(inputs, buffered=True)
+        self.argmax = argmax
+        return max_pool
 
-        # zero-padding
-        if self.padding is None:
-            self.padding = get_padding_2d(
-                (in_h, in_w), (k_h, k_w), self.padding_mode)
-        X = np.pad(inputs, pad_width=self.padding, mode="constant")
-        padded_h, padded_w = X.shape[1:3]
-    
-        out_h = (padded_h - k_h) // s_h + 1
-        out_w = (padded_w - k_w) // s_w + 1
+    def predict(self, inputs):
+        return self._pool(inputs, buffered=False)[0]
 
-        # construct output matrix and argmax matrix
-        max_pool = np.empty(shape=(batch_sz, out_h, out_w, in_c))
-        argmax = np.empty(shape=(batch_sz, out_h, out_w, in_c), dtype=int)
-        for r in range(out_h):
-            r_start = r * s_h
-            for c in range(out_w):
-                c_start = c * s_w
-                pool = X[:, r_start: r_start+k_h, c_start: c_start+k_w, :]
-                pool = pool.reshape((batch_sz, -1, in_c))
-
-                _argmax = np.argmax(pool, axis=1)[:, np.newaxis, :]
-                argmax[:, r, c, :] = _argmax.squeeze()
-
-                # get max elements
-                _max_pool = np.take_along_axis(pool, _argmax, axis=1).squeeze()
-                max_pool[:, r, c, :] = _max_pool
+    def _pool(self, inputs, buffered):
+        batch_sz, in_h, in_w, in_c = inputs.shape
+        plan = self._plans.get((in_h, in_w), self._build_plan)
+        self.padding = plan["padding"]
 
+        # zero-padding
+        X = self._pad(inputs, self.padding)
+        out_h, out_w = plan["out_size"]
         self.X_shape = X.shape
         self.out_shape = (out_h, out_w)
-        self.argmax = argmax
-        return max_pool
+
+        # gather all pooling windows with shape (B, out_h*out_w, k_sz, C)
+        windows_shape = (batch_sz, *plan["index"].shape, in_c)
+        windows = self._get_buffer("windows", windows_shape, X.dtype,
+                                   kind="temp")
+        np.take(X.reshape((batch_sz, -1, in_c)), plan["index"], axis=1,
+                out=windows, mode="clip")
+
+        out_shape = (batch_sz, out_h, out_w, in_c)
+        if not buffered:
+            # take the max of each window directly, no argmax is kept
+            return windows.max(axis=2).reshape(out_shape), None
+
+        # construct output matrix and argmax matrix
+        max_pool = self._get_buffer("out", out_shape, X.dtype)
+        argmax = self._get_buffer("argmax", out_shape, int)
+        flat_argmax = argmax.reshape((batch_sz, -1, in_c))
+        np.argmax(windows, axis=2, out=flat_argmax)
+        flat_argmax = flat_argmax[:, :, np.newaxis, :]
+        max_pool.reshape(flat_argmax.shape)[:] = np.take_along_axis(
+            windows, flat_argmax, axis=2)
+        return max_pool, argmax
 
     def backward(self, grad):
         batch_sz, in_h, in_w, in_c = self.X_shape
         out_h, out_w = self.out_shape
         s_h, s_w = self.stride
         k_h, k_w = self.kernel_shape
-        k_sz = k_h * k_w
         pad_h, pad_w = self.padding[1:3]
 
-        d_in = np.zeros(shape=(batch_sz, in_h, in_w, in_c))
-        for r in range(out_h):
-            r_start = r * s_h
-            for c in range(out_w):
-                c_start = c * s_w
-                _argmax = self.argmax[:, r, c, :]
-                mask = np.eye(k_sz)[_argmax].transpose((0, 2, 1))
-                _grad = grad[:, r, c, :][:, np.newaxis, :]
-                patch = np.repeat(_grad, k_sz, axis=1) * mask
-                patch = patch.reshape((batch_sz, k_h, k_w, in_c))
-                d_in[:, r_start:r_start+k_h, c_start:c_start+k_w, :] += patch
+        d_in = self._get_buffer("d_in", self.X_shape, grad.dtype, kind="grad")
+        d_in.fill(0.0)
+        # route gradients to the max positions of each kernel offset
+        mask = self._get_buffer("mask", grad.shape, bool, kind="temp")
+        patch = self._get_buffer("patch", grad.shape, grad.dtype, kind="temp")
+        for i in range(k_h):
+            for j in range(k_w):
+                np.equal(self.argmax, i * k_w + j, out=mask)
+                np.multiply(grad, mask, out=patch)
+                d_in[:, i: i + s_h * (out_h - 1) + 1: s_h,
+                     j: j + s_w * (out_w - 1) + 1: s_w, :] += patch
 
         # cut off gradients of padding
         d_in = d_in[:, pad_h[0]:in_h-pad_h[1], pad_w[0]:in_w-pad_w[1], :]
         return d_in
 
+    def infer_shape(self, input_shape):
+        out_h, out_w = self._plans.get(input_shape[:2], self._build_plan)[
+            "out_size"]
+        return out_h, out_w, input_shape[2]
+
+    def _build_plan(self, in_h, in_w):
+        k_h, k_w = self.kernel_shape
+        s_h, s_w = self.stride
+        padding = get_padding_2d((in_h, in_w), (k_h, k_w), self.padding_mode)
+        padded_h = in_h + sum(padding[1])
+        padded_w = in_w + sum(padding[2])
+        out_h = (padded_h - k_h) // s_h + 1
+        out_w = (padded_w - k_w) // s_w + 1
+        # flattened (h, w) position of every element in every window
+        rows = np.arange(out_h)[:, None] * s_h + np.arange(k_h)[None, :]
+        cols = np.arange(out_w)[:, None] * s_w + np.arange(k_w)[None, :]
+        index = (rows[:, None, :, None] * padded_w + cols[None, :, None, :])
+        index = index.reshape((out_h * out_w, k_h * k_w))
+        return {"padding": padding, "out_size": (out_h, out_w),
+                "index": index}
+
+    @property
+    def cache_names(self):
+        return ("argmax",)
+
 
 class RNN(Layer):
     
@@ -350,11 +643,7 @@ class RNN(Layer):
         """
         batch_size, n_ts, input_dim = inputs.shape
         if not self.is_init:
-            self.shapes = {"W": [self.num_hidden, self.num_hidden],
-                           "V": [input_dim, self.num_hidden],
-                           "U": [self.num_hidden, input_dim],
-                           "b": [self.num_hidden],
-                           "c": [input_dim]}
+            self.infer_shape(inputs.shape[1:])
             self._init_params()
 
         a = np.empty((batch_size, n_ts, self.num_hidden))
@@ -372,6 +661,20 @@ class RNN(Layer):
         self.h, self.a, self.X = h, a, inputs
         return out[:, -1]
 
+    def predict(self, inputs):
+        # only the latest hidden state is kept while stepping through time
+        batch_size, n_ts, input_dim = inputs.shape
+        if not self.is_init:
+            self.infer_shape(inputs.shape[1:])
+            self._init_params()
+
+        h = np.zeros((batch_size, self.num_hidden))
+        for t in range(n_ts):
+            a = (inputs[:, t] @ self.params["U"].T +
+                 h @ self.params["W"].T + self.params["b"])
+            h = self.activation.func(a)
+        return h @ self.params["V"].T + self.params["c"]
+
     def backward(self, grad):
         n_ts = self.X.shape[1]
         for p in self.param_names:
@@ -399,6 +702,15 @@ class RNN(Layer):
                 d_a = d_h * self.activation.derivative(self.a[:, t - i - 1])
         return d_in
 
+    def infer_shape(self, input_shape):
+        input_dim = input_shape[-1]
+        self.shapes = {"W": [self.num_hidden, self.num_hidden],
+                       "V": [input_dim, self.num_hidden],
+                       "U": [self.num_hidden, input_dim],
+                       "b": [self.num_hidden],
+                       "c": [input_dim]}
+        return (input_dim,)
+
     def _init_params(self):
         for p in self.param_names:
             self.params[p] = self.initializer[p](self.shapes[p])
@@ -408,6 +720,10 @@ class RNN(Layer):
     def param_names(self):
         return "W", "U", "V", "b", "c"
 
+    @property
+    def cache_names(self):
+        return "h", "a", "X"
+
 
 class BatchNormalization(Layer):
 
@@ -427,8 +743,7 @@ class BatchNormalization(Layer):
     def forward(self, inputs):
         self.reduce = (0) if inputs.ndim == 2 else (0, 1, 2)
         if not self.is_init:
-            for p in self.param_names:
-                self.shapes[p] = inputs.shape[-1]
+            self.infer_shape(inputs.shape[1:])
             self._init_params()
 
         if self.ut_params["r_mean"] is None:
@@ -452,6 +767,23 @@ class BatchNormalization(Layer):
         self.X_norm = self.X_center / self.std
         return self.params["gamma"] * self.X_norm + self.params["beta"]
 
+    def predict(self, inputs):
+        if not self.is_init:
+            self.infer_shape(inputs.shape[1:])
+            self._init_params()
+        if self.ut_params["r_mean"] is None:
+            self.reduce = (0) if inputs.ndim == 2 else (0, 1, 2)
+            self.ut_params["r_mean"] = inputs.mean(self.reduce, keepdims=True)
+            self.ut_params["r_var"] = inputs.var(self.reduce, keepdims=True)
+
+        # normalize with running statistics in a single output buffer
+        std = (self.ut_params["r_var"] + self.epsilon) ** 0.5
+        outputs = inputs - self.ut_params["r_mean"]
+        outputs /= std
+        outputs *= self.params["gamma"]
+        outputs += self.params["beta"]
+        return outputs
+
     def backward(self, grad):
         # grads w.r.t params
         self.grads["gamma"] = (self.X_norm * grad).sum(self.reduce)
@@ -467,6 +799,11 @@ class BatchNormalization(Layer):
             self.X_center * std_inv ** 2 * np.sum(grad * self.X_center, axis=self.reduce, keepdims=True))
         return d_in
 
+    def infer_shape(self, input_shape):
+        for p in self.param_names:
+            self.shapes[p] = input_shape[-1]
+        return tuple(input_shape)
+
     def _init_params(self):
         for p in self.param_names:
             self.params[p] = self.initializer[p](self.shapes[p])
@@ -480,6 +817,10 @@ class BatchNormalization(Layer):
     def ut_param_names(self):
         return "r_mean", "r_var"
 
+    @property
+    def cache_names(self):
+        return "X_center", "X_norm"
+
 
 class Reshape(Layer):
 
@@ -495,6 +836,14 @@ class Reshape(Layer):
     def backward(self, grad):
         return grad.reshape(self.input_shape)
 
+    def infer_shape(self, input_shape):
+        output_shape = list(self.output_shape)
+        if -1 in output_shape:
+            known = int(np.prod([d for d in output_shape if d != -1]))
+            output_shape[output_shape.index(-1)] = (
+                int(np.prod(input_shape)) // known)
+        return tuple(output_shape)
+
 
 class Flatten(Reshape):
 
@@ -519,10 +868,20 @@ class Dropout(Layer):
             outputs = inputs
         return outputs
 
+    def predict(self, inputs):
+        return inputs
+
+    def infer_shape(self, input_shape):
+        return tuple(input_shape)
+
     def backward(self, grad):
         assert self.is_training is True
         return grad * self._multiplier
 
+    @property
+    def cache_names(self):
+        return ("_multiplier",)
+
 
 class Activation(Layer):
 
@@ -534,6 +893,12 @@ class Activation(Layer):
         self.inputs = inputs
         return self.func(inputs)
 
+    def predict(self, inputs):
+        return self.func(inputs)
+
+    def infer_shape(self, input_shape):
+        return tuple(input_shape)
+
     def backward(self, grad):
         return self.derivative(self.inputs) * grad
 
@@ -543,6 +908,10 @@ class Activation(Layer):
     def derivative(self, x):
         raise NotImplementedError
 
+    @property
+    def cache_names(self):
+        return ("inputs",)
+
 
 class Sigmoid(Activation):
 
@@ -573,6 +942,18 @@ class Tanh(Activation):
 
 class ReLU(Activation):
 
+    def forward(self, inputs):
+        self.inputs = inputs
+        outputs = self._get_buffer("out", inputs.shape, inputs.dtype)
+        return np.maximum(inputs, 0.0, out=outputs)
+
+    def backward(self, grad):
+        mask = self._get_buffer("mask", grad.shape, bool, kind="temp")
+        np.greater(self.inputs, 0.0, out=mask)
+        d_in = self._get_buffer("d_in", grad.shape, np.result_type(
+            grad, self.inputs), kind="grad")
+        return np.multiply(grad, mask, out=d_in)
+
     def func(self, x):
         return np.maximum(x, 0.0)
 
@@ -608,9 +989,16 @@ class GELU(Activation):
         self.cache = self._sigmoid(1.702 * x)
         return x * self.cache
 
+    def predict(self, inputs):
+        return inputs * self._sigmoid(1.702 * inputs)
+
     def derivative(self, x):
         return self.cache + x * 1.702 * self.cache * (1.0 - self.cache)
 
+    @property
+    def cache_names(self):
+        return "inputs", "cache"
+
 
 class ELU(Activation):
 
@@ -625,13 +1013,14 @@ class ELU(Activation):
         return x > 0.0 + (x < 0.0) * self._alpha * np.exp(x)
 
 
-def im2col(img, k_h, k_w, s_h, s_w):
+def im2col(img, k_h, k_w, s_h, s_w, out=None):
     """Transform padded image into column matrix.
     :param img: padded inputs of shape (B, in_h, in_w, in_c)
     :param k_h: kernel height
     :param k_w: kernel width
     :param s_h: stride height
     :param s_w: stride width
+    :param out: optional preallocated array to store the column matrix
     :return col: column matrix of shape (B*out_h*out_w, k_h*k_h*inc)
     """
     batch_sz, h, w, in_c = img.shape
@@ -639,20 +1028,31 @@ def im2col(img, k_h, k_w, s_h, s_w):
     out_h = (h - k_h) // s_h + 1
     out_w = (w - k_w) // s_w + 1
     # allocate space for column matrix
-    col = np.empty((batch_sz * out_h * out_w, k_h * k_w * in_c))
-    # fill in the column matrix
-    batch_span = out_w * out_h
-    for r in range(out_h):
-        r_start = r * s_h
-        matrix_r = r * out_w
-        for c in range(out_w):
-            c_start = c * s_w
-            patch = img[:, r_start: r_start+k_h, c_start: c_start+k_w, :]
-            patch = patch.reshape(batch_sz, -1)
-            col[matrix_r+c::batch_span, :] = patch
+    col = out
+    if col is None:
+        col = np.empty((batch_sz * out_h * out_w, k_h * k_w * in_c))
+    # fill in the column matrix one kernel offset at a time
+    patches = col.reshape((batch_sz, out_h, out_w, k_h, k_w, in_c))
+    for i in range(k_h):
+        for j in range(k_w):
+            patches[:, :, :, i, j, :] = img[
+                :, i: i + s_h * (out_h - 1) + 1: s_h,
+                j: j + s_w * (out_w - 1) + 1: s_w, :]
     return col
 
 
+def segment_sum(indices, values):
+    """
+    Sum up rows of `values` that share the same index via a sorted segment
+    reduction. Return the unique indices and the summed rows.
+    """
+    order = np.argsort(indices, kind="stable")
+    sorted_idx = indices[order]
+    starts = np.flatnonzero(
+        np.concatenate([[True], sorted_idx[1:] != sorted_idx[:-1]]))
+    return sorted_idx[starts], np.add.reduceat(values[order], starts, axis=0)
+
+
 def get_padding_2d(in_shape, k_shape, mode):
 
     def get_padding_1d(w, k):
@@ -667,3 +1067,30 @@ def get_padding_2d(in_shape, k_shape, mode):
     h_pad = get_padding_1d(in_shape[0], k_shape[0])
     w_pad = get_padding_1d(in_shape[1], k_shape[1])
     return (0, 0), h_pad, w_pad, (0, 0)
+
+
+class PlanCache:
+    """A small LRU cache of execution plans keyed on input shapes."""
+
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self._plans = OrderedDict()
+
+    def get(self, key, build_fn=None):
+        """Return the plan of `key`, build it by `build_fn(*key)` if missed."""
+        key = tuple(key)
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+        elif build_fn is not None:
+            plan = self.put(key, build_fn(*key))
+        return plan
+
+    def put(self, key, plan):
+        self._plans[key] = plan
+        if len(self._plans) > self.max_size:
+            self._plans.popitem(last=False)
+        return plan
+
+    def __len__(self):
+        return len(self._plans)
@@ -10,9 +10,42 @@ class Loss:
     def loss(self, *args, **kwargs):
         raise NotImplementedError
 
+    def per_example(self, *args, **kwargs):
+        """
+        Loss of each example, an array of shape [batch_size] whose mean is
+        the loss.
+        """
+        raise NotImplementedError
+
     def grad(self, *args, **kwargs):
         raise NotImplementedError
 
+    def loss_and_grad(self, *args, **kwargs):
+        """
+        Return both the loss and its gradient. Subclasses override it to
+        share intermediate results between the two.
+        """
+        return self.loss(*args, **kwargs), self.grad(*args, **kwargs)
+
+    def weighted_loss_and_grad(self, predicted, actual, weights):
+        """
+        Loss and gradient of the weighted mean of the per-example losses
+        mean(weights * losses), e.g. with importance sampling weights.
+        :return: the weighted loss, its gradient and the (unweighted)
+            per-example losses
+        """
+        losses = self.per_example(predicted, actual)
+        _, grad = self.loss_and_grad(predicted, actual)
+        # each example only contributes to its own row of the gradient
+        grad *= _expand(weights, grad)
+        return float(np.mean(weights * losses)), grad, losses
+
+
+def _expand(weights, array):
+    """Reshape per-example weights to broadcast against `array`."""
+    weights = np.asarray(weights, dtype=array.dtype)
+    return weights.reshape((-1,) + (1,) * (array.ndim - 1))
+
 
 class MSE(Loss):
 
@@ -20,10 +53,21 @@ class MSE(Loss):
         m = predicted.shape[0]
         return 0.5 * np.sum((predicted - actual) ** 2) / m
 
+    def per_example(self, predicted, actual):
+        err = (predicted - actual).reshape((len(predicted), -1))
+        return 0.5 * np.einsum("ij,ij->i", err, err)
+
     def grad(self, predicted, actual):
         m = predicted.shape[0]
         return (predicted - actual) / m
 
+    def loss_and_grad(self, predicted, actual):
+        m = predicted.shape[0]
+        grad = predicted - actual
+        loss = 0.5 * float(np.vdot(grad, grad)) / m
+        grad /= m
+        return loss, grad
+
 
 class MAE(Loss):
 
@@ -31,10 +75,23 @@ class MAE(Loss):
         m = predicted.shape[0]
         return np.sum(np.abs(predicted - actual)) / m
 
+    def per_example(self, predicted, actual):
+        err = (predicted - actual).reshape((len(predicted), -1))
+        return np.sum(np.abs(err), axis=1)
+
     def grad(self, predicted, actual):
         m = predicted.shape[0]
         return np.sign(predicted - actual) / m
 
+    def loss_and_grad(self, predicted, actual):
+        m = predicted.shape[0]
+        err = predicted - actual
+        grad = np.sign(err)
+        # sign(err) * err = |err|
+        loss = float(np.vdot(grad, err)) / m
+        grad /= m
+        return loss, grad
+
 
 class Huber(Loss):
 
@@ -51,14 +108,25 @@ class Huber(Loss):
         m = predicted.shape[0]
         return np.sum(mse * mse_mask + mae * mae_mask) / m
 
+    def per_example(self, predicted, actual):
+        err = (predicted - actual).reshape((len(predicted), -1))
+        clipped = np.clip(err, -self._delta, self._delta)
+        return np.einsum("ij,ij->i", clipped, err - 0.5 * clipped)
+
     def grad(self, predicted, actual):
+        m = predicted.shape[0]
         err = predicted - actual
-        mse_mask = np.abs(err) < self._delta  # MSE part
-        mae_mask = ~mse_mask  # MAE part
+        return np.clip(err, -self._delta, self._delta) / m
+
+    def loss_and_grad(self, predicted, actual):
         m = predicted.shape[0]
-        mse_grad = err / m
-        mae_grad = np.sign(err) / m
-        return (mae_grad * mae_mask + mse_grad * mse_mask) / m
+        err = predicted - actual
+        # the gradient is the error clipped to [-delta, delta], and the
+        # loss is clip(err) * (err - 0.5 * clip(err)) for both parts
+        grad = np.clip(err, -self._delta, self._delta)
+        loss = float(np.vdot(grad, err) - 0.5 * np.vdot(grad, grad)) / m
+        grad /= m
+        return loss, grad
 
 
 class SoftmaxCrossEntropy(Loss):
@@ -68,6 +136,9 @@ class SoftmaxCrossEntropy(Loss):
         L = weight[class] * (-log(exp(x[class]) / sum(exp(x))))
         :paras T: temperature
         :param weight: A 1D tensor [n_classes] assigning weight to each corresponding sample.
+
+        `labels` can be either one-hot (or soft) targets with the same shape
+        as `logits`, or integer class indices of shape [batch_size].
         """
         weight = np.asarray(weight) if weight is not None else weight
         self._weight = weight
@@ -75,15 +146,76 @@ class SoftmaxCrossEntropy(Loss):
 
     def loss(self, logits, labels):
         m = logits.shape[0]
-        nll = -(log_softmax(logits, t=self._T, axis=1) * labels).sum(axis=1)
+        return np.sum(self.per_example(logits, labels)) / m
+
+    def per_example(self, logits, labels):
+        m = logits.shape[0]
+        if self._is_index(logits, labels):
+            # gather the target log-prob: log(sum(exp(x))) - x[class]
+            x = logits / self._T
+            x_max = np.max(x, axis=1)
+            target = x[np.arange(m), labels]
+            x -= x_max[:, None]
+            np.exp(x, out=x)
+            nll = np.log(np.sum(x, axis=1)) + x_max - target
+        else:
+            nll = -(log_softmax(logits, t=self._T, axis=1) * labels).sum(axis=1)
 
         if self._weight is not None:
             nll *= self._weight[labels]
-        return np.sum(nll) / m
+        return nll
 
     def grad(self, logits, labels):
         m = logits.shape[0]
-        return (softmax(logits, t=self._T) - labels) / m
+        grad = softmax(logits, t=self._T)
+        if self._is_index(logits, labels):
+            grad[np.arange(m), labels] -= 1.0
+        else:
+            grad -= labels
+        grad /= m
+        return grad
+
+    def loss_and_grad(self, logits, labels):
+        nll, grad = self._nll_and_grad(logits, labels)
+        return np.sum(nll) / logits.shape[0], grad
+
+    def weighted_loss_and_grad(self, logits, labels, weights):
+        nll, grad = self._nll_and_grad(logits, labels)
+        grad *= _expand(weights, grad)
+        return float(np.mean(weights * nll)), grad, nll
+
+    def _nll_and_grad(self, logits, labels):
+        m = logits.shape[0]
+        is_index = self._is_index(logits, labels)
+
+        # a single buffer goes from logits to softmax to gradient
+        x = logits / self._T
+        x -= np.max(x, axis=1, keepdims=True)
+        if is_index:
+            target = x[np.arange(m), labels]
+        else:
+            target = np.einsum("ij,ij->i", labels, x)
+        np.exp(x, out=x)
+        exp_sum = np.sum(x, axis=1)
+
+        nll = np.log(exp_sum)
+        if not is_index:
+            nll *= labels.sum(axis=1)
+        nll -= target
+        if self._weight is not None:
+            nll *= self._weight[labels]
+
+        x /= exp_sum[:, None]
+        if is_index:
+            x[np.arange(m), labels] -= 1.0
+        else:
+            x -= labels
+        x /= m
+        return nll, x
+
+    @staticmethod
+    def _is_index(logits, labels):
+        return labels.ndim == logits.ndim - 1
 
 
 class SigmoidCrossEntropy(Loss):
@@ -105,7 +237,111 @@ class SigmoidCrossEntropy(Loss):
         cost = -labels * logits + np.log(1 + np.exp(-logits)) + logits
         return np.sum(cost) / m
 
+    def per_example(self, logits, labels):
+        cost = np.logaddexp(0, logits) - labels * logits
+        return np.sum(cost.reshape((len(logits), -1)), axis=1)
+
     def grad(self, logits, labels):
         m = logits.shape[0]
         grad = -labels + 1.0 / (1 + np.exp(-logits))
         return grad / m
+
+    def loss_and_grad(self, logits, labels):
+        m = logits.shape[0]
+        # softplus(a) = log(1 + exp(a)) and sigmoid(a) = exp(a - softplus(a))
+        buf = np.logaddexp(0, logits)
+        loss = float(np.sum(buf) - np.vdot(labels, logits)) / m
+        np.subtract(logits, buf, out=buf)
+        np.exp(buf, out=buf)
+        buf -= labels
+        buf /= m
+        return loss, buf
+
+
+class SampledSoftmaxCrossEntropy(Loss):
+
+    def __init__(self, layer, num_sampled, sampler=None,
+                 remove_accidental_hits=True):
+        """
+        Softmax cross entropy over the target class and a set of negative
+        classes sampled once per batch, trained with a SampledDense output
+        layer. Logits are corrected by subtracting log(expected count) of
+        each class under the sampler so that the loss approximates the full
+        softmax cross entropy.
+        :param layer: the SampledDense output layer
+        :param num_sampled: number of negative classes per batch
+        :param sampler: LogUniformSampler (default) or UnigramSampler
+        :param remove_accidental_hits: mask sampled classes that happen to
+            be the target of a sample
+        """
+        self._layer = layer
+        self._num_sampled = num_sampled
+        self._sampler = sampler
+        self._remove_hits = remove_accidental_hits
+        self._ce = SoftmaxCrossEntropy()
+
+    def loss(self, inputs, labels):
+        return self.loss_and_grad(inputs, labels)[0]
+
+    def grad(self, inputs, labels):
+        return self.loss_and_grad(inputs, labels)[1]
+
+    def loss_and_grad(self, inputs, labels):
+        """
+        :param inputs: outputs of the SampledDense layer in training phase
+        :param labels: target class indices, shape [batch_size]
+        :return: the loss and the gradient w.r.t. the sampled logits, which
+            is consumed by SampledDense.backward
+        """
+        if self._sampler is None:
+            self._sampler = LogUniformSampler(self._layer.shapes["w"][0])
+        sampled = self._sampler.sample(self._num_sampled)
+        logits = self._layer.sampled_logits(labels, sampled)
+
+        logits[:, :1] -= np.log(self._sampler.expected_count(
+            labels, self._num_sampled))[:, None]
+        logits[:, 1:] -= np.log(self._sampler.expected_count(
+            sampled, self._num_sampled))
+        if self._remove_hits:
+            logits[:, 1:][labels[:, None] == sampled] = -np.inf
+        # the target is always the first column
+        targets = np.zeros(len(labels), dtype=np.int64)
+        return self._ce.loss_and_grad(logits, targets)
+
+
+class LogUniformSampler:
+    """
+    Sample classes from the log-uniform (Zipfian) distribution
+    P(k) = log((k + 2) / (k + 1)) / log(num_classes + 1), which fits
+    vocabularies sorted by decreasing frequency.
+    """
+    def __init__(self, num_classes):
+        self._num_classes = num_classes
+        self._log_range = np.log(num_classes + 1)
+
+    def sample(self, n):
+        samples = np.exp(np.random.uniform(size=n) * self._log_range) - 1
+        return np.minimum(samples.astype(np.int64), self._num_classes - 1)
+
+    def expected_count(self, classes, n):
+        return n * np.log((classes + 2.0) / (classes + 1.0)) / self._log_range
+
+
+class UnigramSampler:
+    """
+    Sample classes proportionally to counts ** distortion.
+    :param counts: occurrence count of each class
+    :param distortion: power applied to the counts (0.75 as in word2vec)
+    """
+    def __init__(self, counts, distortion=1.0):
+        probs = np.asarray(counts, dtype=np.float64) ** distortion
+        self._probs = probs / probs.sum()
+        self._cdf = np.cumsum(self._probs)
+
+    def sample(self, n):
+        samples = np.searchsorted(
+            self._cdf, np.random.uniform(size=n) * self._cdf[-1], side="right")
+        return np.minimum(samples, len(self._cdf) - 1)
+
+    def expected_count(self, classes, n):
+        return n * self._probs[classes]
@@ -1,5 +1,6 @@
 """Model class manage the network, loss function and optimizer."""
 
+import os
 import pickle
 
 
@@ -13,12 +14,25 @@ class Model:
     def forward(self, inputs):
         return self.net.forward(inputs)
 
+    def predict(self, inputs, batch_size=None):
+        return self.net.predict(inputs, batch_size)
+
     def backward(self, preds, targets):
-        loss = self.loss.loss(preds, targets)
-        grad_from_loss = self.loss.grad(preds, targets)
+        loss, grad_from_loss = self.loss.loss_and_grad(preds, targets)
         struct_grad = self.net.backward(grad_from_loss)
         return loss, struct_grad
 
+    def weighted_backward(self, preds, targets, weights):
+        """
+        Backward pass of the weighted mean of the per-example losses, e.g.
+        with importance sampling weights.
+        :return: the weighted loss, the gradients and the per-example losses
+        """
+        loss, grad_from_loss, losses = self.loss.weighted_loss_and_grad(
+            preds, targets, weights)
+        struct_grad = self.net.backward(grad_from_loss)
+        return loss, struct_grad, losses
+
     def apply_grads(self, grads):
         params = self.net.params
         self.optimizer.step(grads, params)
@@ -26,8 +40,10 @@ class Model:
     def save(self, path):
         with open(path, "wb") as f:
             pickle.dump(self.net.params, f)
+        # optimizer states are saved alongside the model
+        self.optimizer.save(path + ".optim")
 
-    def load(self, path):
+    def load(self, path, mmap_optimizer=True):
         with open(path, "rb") as f:
             params = pickle.load(f)
 
@@ -35,6 +51,10 @@ class Model:
         for layer in self.net.layers:
             layer.is_init = True
 
+        optim_path = path + ".optim"
+        if os.path.isfile(optim_path):
+            self.optimizer.load(optim_path, mmap=mmap_optimizer)
+
     def get_phase(self):
         return self.net.get_phase()
 
@@ -11,20 +11,105 @@ class Net:
         self.layers = layers
         self._phase = "TRAIN"
 
+        self._segments = None
+        self._segment_states = None
+        self._arena = None
+
     def __repr__(self):
         return "\n".join([str(l) for l in self.layers])
 
+    def set_checkpoints(self, boundaries="auto"):
+        """
+        Enable gradient checkpointing (activation recomputation).
+        Layers are split into segments and only the input of each segment
+        is kept during forward. Backward caches of a segment are rebuilt by
+        re-running its forward right before its backward.
+        :param boundaries: A list of layer indices where new segments start,
+            or "auto" to split the layers into about sqrt(N) segments.
+            None disables checkpointing.
+        """
+        if boundaries is None:
+            self._segments = None
+            return
+
+        n_layers = len(self.layers)
+        if boundaries == "auto":
+            seg_len = int(np.ceil(n_layers ** 0.5))
+            boundaries = range(seg_len, n_layers, seg_len)
+        starts = sorted({0, *[int(b) for b in boundaries if 0 < b < n_layers]})
+        self._segments = list(zip(starts, starts[1:] + [n_layers]))
+
     def forward(self, inputs):
+        if self._segments is None or self._phase != "TRAIN":
+            for layer in self.layers:
+                inputs = layer.forward(inputs)
+            return inputs
+
+        self._segment_states = []
+        last = len(self._segments) - 1
+        for i, (start, end) in enumerate(self._segments):
+            # keep segment inputs and random state for recomputation
+            self._segment_states.append((inputs, np.random.get_state()))
+            for layer in self.layers[start:end]:
+                inputs = layer.forward(inputs)
+            # the last segment is consumed by backward right away
+            if i != last:
+                for layer in self.layers[start:end]:
+                    layer.clear_cache()
+        return inputs
+
+    def predict(self, inputs, batch_size=None):
+        """
+        Inference-only forward pass. Layers run their lean `predict` kernels
+        which keep nothing for backward, so only the current activation is
+        alive at any time. Inputs are processed in chunks of `batch_size` if
+        specified to further bound the peak memory.
+        """
+        phase = self.get_phase()
+        self.set_phase("TEST")
+        try:
+            if batch_size is None:
+                return self._predict(inputs)
+
+            outputs = None
+            for start in range(0, len(inputs), batch_size):
+                end = start + batch_size
+                chunk_out = self._predict(inputs[start: end])
+                if outputs is None:
+                    outputs = np.empty((len(inputs), *chunk_out.shape[1:]),
+                                       dtype=chunk_out.dtype)
+                outputs[start: end] = chunk_out
+            return outputs
+        finally:
+            self.set_phase(phase)
+
+    def _predict(self, inputs):
         for layer in self.layers:
-            inputs = layer.forward(inputs)
+            inputs = layer.predict(inputs)
         return inputs
 
     def backward(self, grad):
+        if self._segments is None or self._segment_states is None:
+            segments = [(0, len(self.layers))]
+        else:
+            segments = self._segments
+
         # back propagation
         layer_grads = []
-        for layer in reversed(self.layers):
-            grad = layer.backward(grad)
-            layer_grads.append(copy.copy(layer.grads))
+        last = len(segments) - 1
+        for i in reversed(range(len(segments))):
+            start, end = segments[i]
+            if segments is self._segments and i != last:
+                self._recompute(start, end, *self._segment_states[i])
+            for layer in reversed(self.layers[start:end]):
+                grad = layer.backward(grad)
+                layer_grads.append(copy.copy(layer.grads))
+            if segments is self._segments:
+                # release segment caches as soon as they are consumed
+                self._segment_states[i] = None
+                for layer in self.layers[start:end]:
+                    layer.clear_cache()
+        self._segment_states = None
 
         # return structured gradients
         struct_grad = StructuredParam(layer_grads[::-1])
@@ -32,6 +117,107 @@ class Net:
         struct_grad.wrt_input = grad
         return struct_grad
 
+    def compile(self, input_shape=None, batch_size=None, dtype=np.float32,
+                inputs=None):
+        """
+        Plan and preallocate the buffers of layer outputs and temporaries
+        for fixed-shape batches. Shapes are recorded with a dry run on a
+        batch of zeros (or on `inputs`) and all buffers are bound to slices
+        of one arena:
+        - outputs and backward caches get their own slots since they stay
+          alive until the backward pass is done.
+        - gradients w.r.t. inputs only live until the next layer consumes
+          them, thus two slots are used in turn.
+        - temporaries of different layers share the same region.
+        Batches of other shapes (e.g. the last partial batch) fall back to
+        normal allocation. Note that the outputs of a compiled net are
+        overwritten by the next forward pass.
+        :param input_shape: shape of a single input sample
+        :param batch_size: number of samples in a batch
+        :param dtype: dtype of the input batches, e.g. an integer type for
+            nets starting with an Embedding
+        :param inputs: an example batch used for the dry run instead of
+            zeros, which sets the input shape, batch size and dtype
+        :return: size of the arena in bytes
+        """
+        if inputs is None:
+            inputs = np.zeros((batch_size, *input_shape), dtype)
+        # params are initialized (drawing from the random state as usual)
+        # before the dry run, which then leaves the random state and the
+        # untrainable params untouched
+        self.init_params(inputs.shape[1:])
+
+        for layer in self.layers:
+            layer.buffers = {}
+            layer._buffer_requests = {}
+
+        rng_state = np.random.get_state()
+        ut_params = [dict(layer.ut_params) for layer in self.layers]
+        phase = self.get_phase()
+        self.set_phase("TRAIN")
+        try:
+            outputs = self.forward(inputs)
+            self.backward(np.zeros_like(outputs))
+        finally:
+            self.set_phase(phase)
+            np.random.set_state(rng_state)
+            for layer, ut in zip(self.layers, ut_params):
+                layer.ut_params.update(ut)
+
+        requests = []
+        for layer in self.layers:
+            for name, (shape, dtype_, kind) in layer._buffer_requests.items():
+                nbytes = int(np.prod(shape)) * dtype_.itemsize
+                requests.append((layer, name, shape, dtype_, kind, nbytes))
+            layer._buffer_requests = None
+
+        def aligned(nbytes):
+            return (nbytes + 63) // 64 * 64
+
+        plan, offset = [], 0
+        for req in requests:
+            if req[4] == "keep":
+                plan.append((req, offset))
+                offset += aligned(req[5])
+
+        # gradients flow backward and alternate between two slots, layers
+        # which return a view of the incoming gradient keep the slot
+        grad_reqs = {id(r[0]): r for r in requests if r[4] == "grad"}
+        slot_sz = aligned(max([r[5] for r in grad_reqs.values()], default=0))
+        slots, curr = (offset, offset + slot_sz), 1
+        for layer in reversed(self.layers):
+            if id(layer) in grad_reqs:
+                curr = 1 - curr
+                plan.append((grad_reqs[id(layer)], slots[curr]))
+        offset += 2 * slot_sz
+
+        scratch_sz = 0
+        for layer in self.layers:
+            layer_offset = 0
+            for req in requests:
+                if req[0] is layer and req[4] == "temp":
+                    plan.append((req, offset + layer_offset))
+                    layer_offset += aligned(req[5])
+            scratch_sz = max(scratch_sz, layer_offset)
+        offset += scratch_sz
+
+        self._arena = np.empty(offset, dtype=np.uint8)
+        for (layer, name, shape, dtype_, _, nbytes), start in plan:
+            buf = self._arena[start: start + nbytes].view(dtype_)
+            layer.buffers[name] = buf.reshape(shape)
+        return self._arena.nbytes
+
+    def _recompute(self, start, end, inputs, rng_state):
+        # replay the forward pass with the same random state and without
+        # updating untrainable params (e.g. running statistics of BN)
+        curr_rng_state = np.random.get_state()
+        np.random.set_state(rng_state)
+        for layer in self.layers[start:end]:
+            ut_params = dict(layer.ut_params)
+            inputs = layer.forward(inputs)
+            layer.ut_params.update(ut_params)
+        np.random.set_state(curr_rng_state)
+
     @property
     def params(self):
         trainable = [l.params for l in self.layers]
@@ -40,8 +226,13 @@ class Net:
 
     @params.setter
     def params(self, params):
-        self.params.values = params.values
-        self.params.ut_values = params.ut_values
+        # values are copied into the current arrays rather than bound,
+        # since optimizers update them in place and nets (e.g. a target
+        # network) must not share them
+        _copy_params([l.params for l in self.layers], params.param_list)
+        if params.ut_param_list is not None:
+            _copy_params([l.ut_params for l in self.layers],
+                         params.ut_param_list)
 
     def get_phase(self):
         return self._phase
@@ -51,9 +242,54 @@ class Net:
             layer.set_phase(phase)
         self._phase = phase
 
+    def infer_shapes(self, input_shape):
+        """Propagate the input shape (without batch dimension) symbolically
+        and return the output shape of each layer."""
+        shapes = []
+        shape = tuple(input_shape)
+        for layer in self.layers:
+            shape = tuple(layer.infer_shape(shape))
+            shapes.append(shape)
+        return shapes
+
     def init_params(self, input_shape):
-        # manually init params by letting data forward through the network
-        self.forward(np.ones((1, *input_shape)))
+        # infer parameter shapes layer by layer and init all params up front
+        self.infer_shapes(input_shape)
+        for layer in self.layers:
+            if layer.param_names and not layer.is_init:
+                layer._init_params()
+
+    def summary(self, input_shape):
+        """Report output shape, number of params and activation size
+        (elements per sample) of each layer without running any data."""
+        lines = ["%-20s %-20s %10s %12s" % (
+            "layer", "output shape", "params", "activations")]
+        total_params, total_acts = 0, 0
+        for layer, shape in zip(self.layers, self.infer_shapes(input_shape)):
+            n_params = sum(int(np.prod(layer.shapes[p]))
+                           for p in layer.param_names)
+            n_acts = int(np.prod(shape))
+            total_params += n_params
+            total_acts += n_acts
+            lines.append("%-20s %-20s %10d %12d" % (
+                layer.name, shape, n_params, n_acts))
+        lines.append("total params: %d, total activations: %d" % (
+            total_params, total_acts))
+        return "\n".join(lines)
+
+
+def _copy_params(dst_list, src_list):
+    src_values = [v for p in src_list for v in p.values()]
+    dst_items = [(d, name) for d in dst_list for name in d]
+    for (d, name), value in zip(dst_items, src_values):
+        curr = d[name]
+        if value is None:
+            d[name] = None
+        elif (curr is not None and curr.shape == np.shape(value) and
+              curr.dtype == np.asarray(value).dtype):
+            np.copyto(curr, value)
+        else:
+            d[name] = np.array(value)
 
 
 class StructuredParam:
@@ -212,3 +448,20 @@ class StructuredParam:
         obj = copy.deepcopy(self)
         obj.values = self._ensure_values(other) | self.values
         return obj
+
+
+class SparseGrad:
+    """
+    Row-sparse gradient of a 2D parameter, e.g. the embedding matrix.
+    Only rows in `indices` (unique) have non-zero gradients `values`.
+    """
+
+    def __init__(self, indices, values, shape):
+        self.indices = indices
+        self.values = values
+        self.shape = shape
+
+    def to_dense(self):
+        dense = np.zeros(self.shape, dtype=self.values.dtype)
+        dense[self.indices] = self.values
+        return dense
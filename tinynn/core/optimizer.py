@@ -1,29 +1,208 @@
 """Various optimization algorithms and learning rate schedulers."""
 
+import os
+import pickle
+import struct
+
 import numpy as np
+from tinynn.core.net import SparseGrad
 
 
 class Optimizer:
-
+    """
+    Optimizers update parameters in place. The states (named by
+    `state_names`) of all parameters live in one float32 buffer of shape
+    (n_states, n_params) laid out in parameter order, and each parameter
+    gets views of it. All updates are written with `out=` ufunc calls into
+    the states and a shared scratch buffer, so no full-size temporaries
+    are created.
+    """
     def __init__(self, lr, weight_decay):
         self.lr = lr
         self.weight_decay = weight_decay
 
+        self._t = 0
+        self._buffer = None
+        self._shapes = None
+        self._states = []
+        self._scratch = None
+
+        self._clip_norm = None
+        self._clip_per_layer = False
+        # gradient norm before clipping of the latest step
+        self.grad_norm = None
+
+    def set_grad_clip(self, max_norm, per_layer=False):
+        """
+        Clip gradients by norm before each step. Gradients are rescaled in
+        place so that the global norm (or the norm of each layer if
+        `per_layer` is True) does not exceed `max_norm`. The norms before
+        clipping are kept in `grad_norm` (a list if `per_layer`).
+        Pass None to disable clipping.
+        """
+        self._clip_norm = max_norm
+        self._clip_per_layer = per_layer
+
     def step(self, grads, params):
-        # compute step according to derived class method
-        grad_values = grads.values
-        step_values = self._compute_step(grad_values)
-        grads.values = step_values
+        if self._clip_norm is not None:
+            self.grad_norm = self._clip_grads(grads)
+
+        pairs = list(self._iter_params(grads, params))
+        if not self._states:
+            self._init_states([param for _, param in pairs])
 
-        # apply weight_decay if specified
+        self._t += 1
+        for (grad, param), state in zip(pairs, self._states):
+            if isinstance(grad, SparseGrad):
+                self._sparse_update(grad, param, state)
+                continue
+            # apply decoupled weight_decay if specified
+            if self.weight_decay:
+                param *= 1.0 - self.lr * self.weight_decay
+            # take a step according to derived class method
+            self._update(grad, param, state)
+
+    def _sparse_update(self, grad, param, state):
+        """
+        Lazy update: gather the rows that have gradients together with
+        their states, run the dense update on them and scatter them back.
+        Rows not in the batch (and their states) are left untouched, so
+        the cost depends on the batch rather than the vocabulary size.
+        """
+        rows = grad.indices
+        param_rows = param[rows]
+        state_rows = {name: s[rows] for name, s in state.items()}
         if self.weight_decay:
-            grads -= self.lr * self.weight_decay * params
+            param_rows *= 1.0 - self.lr * self.weight_decay
+        self._update(grad.values, param_rows, state_rows)
+        param[rows] = param_rows
+        for name, s in state.items():
+            s[rows] = state_rows[name]
+
+    def save(self, path):
+        """
+        Save states to a compact binary file: a pickled header with the
+        step count and parameter shapes, followed by the raw float32 buffer
+        at a 64-byte aligned offset so that it can be memory-mapped back.
+        The file is written to a temporary file and renamed, since the
+        states may be memory-mapped from the file being overwritten.
+        """
+        header = pickle.dumps({"t": self._t, "state_names": self.state_names,
+                               "shapes": self._shapes})
+        offset = self._data_offset(len(header))
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.write(b"\0" * (offset - 8 - len(header)))
+            if self._buffer is not None:
+                self._buffer.tofile(f)
+        os.replace(tmp_path, path)
+
+    def load(self, path, mmap=True):
+        """
+        Load states saved by `save`. The buffer is memory-mapped in
+        copy-on-write mode if `mmap` is True, so updates never touch the
+        file.
+        """
+        with open(path, "rb") as f:
+            header_len = struct.unpack("<Q", f.read(8))[0]
+            header = pickle.loads(f.read(header_len))
+        if tuple(header["state_names"]) != tuple(self.state_names):
+            raise ValueError("State names mismatch: %s (expect %s)" % (
+                header["state_names"], self.state_names))
+
+        self._t = header["t"]
+        self._shapes = header["shapes"]
+        self._states = []
+        self._buffer = None
+        if self._shapes is not None:
+            n_params = sum(int(np.prod(s)) for s in self._shapes)
+            buf_shape = (len(self.state_names), n_params)
+            if not self.state_names:
+                self._buffer = np.zeros(buf_shape, dtype=np.float32)
+                return
+            self._buffer = np.memmap(
+                path, dtype=np.float32, mode="c",
+                offset=self._data_offset(header_len), shape=buf_shape)
+            if not mmap:
+                self._buffer = np.array(self._buffer)
+
+    def _init_states(self, params):
+        shapes = [param.shape for param in params]
+        if self._buffer is None:
+            n_params = sum(param.size for param in params)
+            self._buffer = np.zeros((len(self.state_names), n_params),
+                                    dtype=np.float32)
+        elif shapes != self._shapes:
+            raise ValueError("Parameter shapes mismatch the loaded states.")
+        self._shapes = shapes
+
+        # bind views of the buffer to each parameter
+        self._states, offset = [], 0
+        for shape in shapes:
+            size = int(np.prod(shape))
+            self._states.append(
+                {name: self._buffer[i, offset: offset + size].reshape(shape)
+                 for i, name in enumerate(self.state_names)})
+            offset += size
+
+    @staticmethod
+    def _data_offset(header_len):
+        return (8 + header_len + 63) // 64 * 64
+
+    def _update(self, grad, param, state):
+        raise NotImplementedError
 
-        # take a step
-        params += grads
+    def _clip_grads(self, grads):
+        # squared norm of each layer, one dot product per gradient array
+        layer_sq_norms = []
+        for grad_dict in grads.param_list:
+            layer_sq_norms.append(sum(
+                squared_norm(self._grad_values(g)) for g in grad_dict.values()))
+
+        if self._clip_per_layer:
+            norms = [sq ** 0.5 for sq in layer_sq_norms]
+            for grad_dict, norm in zip(grads.param_list, norms):
+                self._scale_grads(grad_dict.values(), norm)
+            return norms
+
+        norm = sum(layer_sq_norms) ** 0.5
+        self._scale_grads(
+            [g for grad_dict in grads.param_list for g in grad_dict.values()],
+            norm)
+        return norm
+
+    def _scale_grads(self, grad_list, norm):
+        if norm <= self._clip_norm:
+            return
+        scale = self._clip_norm / norm
+        for grad in grad_list:
+            self._grad_values(grad)[...] *= scale
+
+    @staticmethod
+    def _grad_values(grad):
+        return grad.values if isinstance(grad, SparseGrad) else grad
+
+    @staticmethod
+    def _iter_params(grads, params):
+        for grad_dict, param_dict in zip(grads.param_list, params.param_list):
+            for name, param in param_dict.items():
+                if param is not None:
+                    yield grad_dict[name], param
+
+    def _get_scratch(self, param, n=1):
+        """Return n scratch arrays with the shape and dtype of param."""
+        size = n * param.size
+        if (self._scratch is None or self._scratch.size < size or
+                self._scratch.dtype != param.dtype):
+            self._scratch = np.empty(size, dtype=param.dtype)
+        return [self._scratch[i * param.size: (i + 1) * param.size].reshape(
+            param.shape) for i in range(n)]
 
-    def _compute_step(self, grad):
-        raise NotImplementedError
+    @property
+    def state_names(self):
+        return ()
 
 
 class SGD(Optimizer):
@@ -31,8 +210,10 @@ class SGD(Optimizer):
     def __init__(self, lr=0.01, weight_decay=0.0):
         super().__init__(lr, weight_decay)
 
-    def _compute_step(self, grad):
-        return -self.lr * grad
+    def _update(self, grad, param, state):
+        tmp, = self._get_scratch(param)
+        np.multiply(grad, -self.lr, out=tmp)
+        param += tmp
 
 
 class Adam(Optimizer):
@@ -48,22 +229,25 @@ class Adam(Optimizer):
         self._b2 = beta2
         self._eps = epsilon
 
-        self._t = 0
-        self._m = 0
-        self._v = 0
-
-    def _compute_step(self, grad):
-        self._t += 1
-
-        self._m += (1.0 - self._b1) * (grad - self._m)
-        self._v += (1.0 - self._b2) * (grad ** 2 - self._v)
-
-        # bias correction
-        _m = self._m / (1 - self._b1 ** self._t)
-        _v = self._v / (1 - self._b2 ** self._t)
+    def _update(self, grad, param, state):
+        m, v = state["m"], state["v"]
+        tmp, = self._get_scratch(param)
+        update_moments(grad, m, v, self._b1, self._b2, tmp)
+
+        # bias correction folded into the step size and epsilon
+        # -lr * m_hat / (v_hat ** 0.5 + eps)
+        #   = -lr * c2 / c1 * m / (v ** 0.5 + eps * c2)
+        c1 = 1.0 - self._b1 ** self._t
+        c2 = (1.0 - self._b2 ** self._t) ** 0.5
+        np.sqrt(v, out=tmp)
+        tmp += self._eps * c2
+        np.divide(m, tmp, out=tmp)
+        tmp *= -self.lr * c2 / c1
+        param += tmp
 
-        step = -self.lr * _m / (_v ** 0.5 + self._eps)
-        return step
+    @property
+    def state_names(self):
+        return "m", "v"
 
 
 class RAdam(Optimizer):
@@ -81,30 +265,32 @@ class RAdam(Optimizer):
         self._b2 = beta2
         self._eps = epsilon
 
-        self._t = 0
-        self._m = 0
-        self._v = 0
-
         self.rho = 2 / (1 - self._b2) - 1
 
-    def _compute_step(self, grad):
-        self._t += 1
-
-        self._m += (1.0 - self._b1) * (grad - self._m)
-        self._v += (1.0 - self._b2) * (grad ** 2 - self._v)
+    def _update(self, grad, param, state):
+        m, v = state["m"], state["v"]
+        tmp, = self._get_scratch(param)
+        update_moments(grad, m, v, self._b1, self._b2, tmp)
 
         # bias correction
-        _m = self._m / (1 - self._b1 ** self._t)
-
-        _rho = self.rho - 2 * self._b2 ** self._t / (1 - self._b2 ** self._t)
+        c1 = 1.0 - self._b1 ** self._t
+        _rho = self.rho - 2 * self._t * self._b2 ** self._t / (
+            1 - self._b2 ** self._t)
         if _rho > 4:
-            _v = self._v / (1 - self._b2 ** self._t)
-            _r = (((_rho - 4) * (_rho - 2) * self.rho) / 
+            c2 = (1.0 - self._b2 ** self._t) ** 0.5
+            _r = (((_rho - 4) * (_rho - 2) * self.rho) /
                   ((self.rho - 4) * (self.rho - 2) * _rho))
-            step = -self.lr * _m * (_r ** 0.5) / (_v ** 0.5 + self._eps)
+            np.sqrt(v, out=tmp)
+            tmp += self._eps * c2
+            np.divide(m, tmp, out=tmp)
+            tmp *= -self.lr * (_r ** 0.5) * c2 / c1
         else:
-            step = -self.lr * _m
-        return step
+            np.multiply(m, -self.lr / c1, out=tmp)
+        param += tmp
+
+    @property
+    def state_names(self):
+        return "m", "v"
 
 
 class RMSProp(Optimizer):
@@ -126,16 +312,25 @@ class RMSProp(Optimizer):
         self._momentum = momentum
         self._eps = epsilon
 
-        self._ms = 0
-        self._mom = 0
+    def _update(self, grad, param, state):
+        ms, mom = state["ms"], state["mom"]
+        tmp, = self._get_scratch(param)
+        np.square(grad, out=tmp)
+        tmp -= ms
+        tmp *= 1.0 - self._decay
+        ms += tmp
+
+        np.add(ms, self._eps, out=tmp)
+        np.sqrt(tmp, out=tmp)
+        np.divide(grad, tmp, out=tmp)
+        tmp *= self.lr
+        mom *= self._momentum
+        mom += tmp
+        param -= mom
 
-    def _compute_step(self, grad):
-        self._ms += (1 - self._decay) * (grad ** 2 - self._ms)
-        self._mom = self._momentum * self._mom + \
-            self.lr * grad / (self._ms + self._eps) ** 0.5
-
-        step = -self._mom
-        return step
+    @property
+    def state_names(self):
+        return "ms", "mom"
 
 
 class Momentum(Optimizer):
@@ -146,12 +341,18 @@ class Momentum(Optimizer):
     def __init__(self, lr, momentum=0.9, weight_decay=0.0):
         super().__init__(lr, weight_decay)
         self._momentum = momentum
-        self._acc = 0
 
-    def _compute_step(self, grad):
-        self._acc = self._momentum * self._acc + grad
-        step = -self.lr * self._acc
-        return step
+    def _update(self, grad, param, state):
+        acc = state["acc"]
+        tmp, = self._get_scratch(param)
+        acc *= self._momentum
+        acc += grad
+        np.multiply(acc, -self.lr, out=tmp)
+        param += tmp
+
+    @property
+    def state_names(self):
+        return ("acc",)
 
 
 class Adagrad(Optimizer):
@@ -162,14 +363,23 @@ class Adagrad(Optimizer):
     """
     def __init__(self, lr, weight_decay=0.0, epsilon=1e-8):
         super().__init__(lr, weight_decay)
-        self._G = 0
         self._eps = epsilon
 
-    def _compute_step(self, grad):
-        self._G += grad ** 2
-        adjust_lr = self.lr / (self._G + self._eps) ** 0.5
-        step = -adjust_lr * grad
-        return step
+    def _update(self, grad, param, state):
+        G = state["G"]
+        tmp, = self._get_scratch(param)
+        np.square(grad, out=tmp)
+        G += tmp
+
+        np.add(G, self._eps, out=tmp)
+        np.sqrt(tmp, out=tmp)
+        np.divide(grad, tmp, out=tmp)
+        tmp *= -self.lr
+        param += tmp
+
+    @property
+    def state_names(self):
+        return ("G",)
 
 
 class Adadelta(Optimizer):
@@ -180,16 +390,123 @@ class Adadelta(Optimizer):
         super().__init__(lr, weight_decay)
         self._eps = epsilon
         self._decay = decay
-        self._Eg = 0  # running average of square gradient
-        self._delta = 0  # running average of delta
 
-    def _compute_step(self, grad):
-        self._Eg += (1 - self._decay) * (grad ** 2 - self._Eg)
-        std = (self._delta + self._eps) ** 0.5
-        delta = grad * (std / (self._Eg + self._eps) ** 0.5)
-        step = - self.lr * delta
-        self._delta += (1 - self._decay) * (delta ** 2 - self._delta)
-        return step
+    def _update(self, grad, param, state):
+        # Eg: running average of square gradient
+        # delta: running average of square delta
+        Eg, acc_delta = state["Eg"], state["delta"]
+        tmp, delta = self._get_scratch(param, n=2)
+        np.square(grad, out=tmp)
+        tmp -= Eg
+        tmp *= 1.0 - self._decay
+        Eg += tmp
+
+        # delta = grad * sqrt(delta + eps) / sqrt(Eg + eps)
+        np.add(Eg, self._eps, out=tmp)
+        np.sqrt(tmp, out=tmp)
+        np.add(acc_delta, self._eps, out=delta)
+        np.sqrt(delta, out=delta)
+        delta /= tmp
+        delta *= grad
+        np.multiply(delta, -self.lr, out=tmp)
+        param += tmp
+
+        np.square(delta, out=tmp)
+        tmp -= acc_delta
+        tmp *= 1.0 - self._decay
+        acc_delta += tmp
+
+    @property
+    def state_names(self):
+        return "Eg", "delta"
+
+
+class LARS(Optimizer):
+    """
+    Layer-wise Adaptive Rate Scaling (https://arxiv.org/abs/1708.03888)
+    local_lr = eta * ||w|| / (||g|| + weight_decay * ||w||)
+    acc = momentum * acc + lr * local_lr * (g + weight_decay * w)
+    w -= acc
+    The trust ratio is computed for each parameter of each layer and weight
+    decay is part of the update rather than decoupled.
+    """
+    def __init__(self,
+                 lr=1.0,
+                 momentum=0.9,
+                 eta=0.001,
+                 weight_decay=0.0,
+                 epsilon=1e-8):
+        super().__init__(lr, weight_decay=0.0)
+        self._momentum = momentum
+        self._eta = eta
+        self._wd = weight_decay
+        self._eps = epsilon
+
+    def _update(self, grad, param, state):
+        acc = state["acc"]
+        tmp, = self._get_scratch(param)
+        w_norm, g_norm = l2_norm(param), l2_norm(grad)
+        local_lr = 1.0
+        if w_norm > 0 and g_norm > 0:
+            local_lr = self._eta * w_norm / (
+                g_norm + self._wd * w_norm + self._eps)
+
+        np.multiply(param, self._wd, out=tmp)
+        tmp += grad
+        tmp *= self.lr * local_lr
+        acc *= self._momentum
+        acc += tmp
+        param -= acc
+
+    @property
+    def state_names(self):
+        return ("acc",)
+
+
+class LAMB(Optimizer):
+    """
+    Layer-wise Adaptive Moments for Batch training
+    (https://arxiv.org/abs/1904.00962)
+    r = m_hat / (sqrt(v_hat) + epsilon) + weight_decay * w
+    w -= lr * ||w|| / ||r|| * r
+    The trust ratio is computed for each parameter of each layer.
+    """
+    def __init__(self,
+                 lr=0.001,
+                 beta1=0.9,
+                 beta2=0.999,
+                 epsilon=1e-6,
+                 weight_decay=0.0):
+        super().__init__(lr, weight_decay=0.0)
+        self._b1 = beta1
+        self._b2 = beta2
+        self._eps = epsilon
+        self._wd = weight_decay
+
+    def _update(self, grad, param, state):
+        m, v = state["m"], state["v"]
+        tmp, r = self._get_scratch(param, n=2)
+        update_moments(grad, m, v, self._b1, self._b2, tmp)
+
+        # bias corrected adam step plus weight decay
+        c1 = 1.0 - self._b1 ** self._t
+        c2 = (1.0 - self._b2 ** self._t) ** 0.5
+        np.sqrt(v, out=tmp)
+        tmp += self._eps * c2
+        np.divide(m, tmp, out=r)
+        r *= c2 / c1
+        if self._wd:
+            np.multiply(param, self._wd, out=tmp)
+            r += tmp
+
+        w_norm, r_norm = l2_norm(param), l2_norm(r)
+        trust_ratio = w_norm / r_norm if w_norm > 0 and r_norm > 0 else 1.0
+        r *= self.lr * trust_ratio
+        param -= r
+
+    @property
+    def state_names(self):
+        return "m", "v"
 
 
 class BaseScheduler:
@@ -325,3 +642,28 @@ class CyclicalLR(BaseScheduler):
             return self.curr_lr + self._abs_lr_delta
         else:
             return self.curr_lr - self._abs_lr_delta
+
+
+def update_moments(grad, m, v, b1, b2, tmp):
+    """Update first and second moment estimates in place.
+    m += (1 - b1) * (grad - m)
+    v += (1 - b2) * (grad ** 2 - v)
+    """
+    np.subtract(grad, m, out=tmp)
+    tmp *= 1.0 - b1
+    m += tmp
+    np.square(grad, out=tmp)
+    tmp -= v
+    tmp *= 1.0 - b2
+    v += tmp
+
+
+def squared_norm(x):
+    """Squared L2 norm of an array computed without temporaries."""
+    x = np.ravel(x)
+    return float(np.dot(x, x))
+
+
+def l2_norm(x):
+    """L2 norm of an array computed without temporaries."""
+    return squared_norm(x) ** 0.5
@@ -87,3 +87,78 @@ def test_reshape():
     layer = Reshape(*target_shape)
     output = layer.forward(input_)
     assert output.shape[1:] == target_shape
+
+
+def test_predict():
+    batch_size = 4
+    input_ = np.random.randn(batch_size, 8, 8, 1)
+    net = Net([
+        Conv2D(kernel=[3, 3, 1, 2]),
+        BatchNormalization(),
+        ReLU(),
+        MaxPool2D(pool_size=[2, 2], stride=[2, 2]),
+        Flatten(),
+        Dropout(),
+        Dense(3)
+    ])
+    net.forward(input_)
+
+    # predict should match the TEST phase forward pass
+    net.set_phase("TEST")
+    expect = net.forward(input_)
+    net.set_phase("TRAIN")
+    output = net.predict(input_)
+    assert np.allclose(output, expect)
+    assert net.get_phase() == "TRAIN"
+
+    # chunked prediction gives the same results
+    output = net.predict(input_, batch_size=3)
+    assert np.allclose(output, expect)
+
+    # no backward cache is kept after prediction
+    for layer in net.layers:
+        layer.clear_cache()
+    net.predict(input_)
+    for layer in net.layers:
+        for name in layer.cache_names:
+            assert getattr(layer, name) is None
+
+
+def test_variable_input_size():
+    # padding and output size should follow the size of each input
+    conv = Conv2D(kernel=[3, 3, 1, 2], stride=[2, 2], padding="SAME")
+    conv_t = ConvTranspose2D(kernel=[3, 3, 2, 1], stride=[2, 2])
+    pool = MaxPool2D(pool_size=[2, 2], stride=[2, 2], padding="SAME")
+    for size in [(8, 8), (5, 7), (8, 8)]:
+        input_ = np.random.randn(2, *size, 1)
+        output = conv.forward(input_)
+        out_size = ((size[0] + 1) // 2, (size[1] + 1) // 2)
+        assert output.shape == (2, *out_size, 2)
+        assert conv.backward(output).shape == input_.shape
+
+        output = conv_t.forward(output)
+        assert output.shape == (2, out_size[0] * 2, out_size[1] * 2, 1)
+
+        output = pool.forward(input_)
+        assert output.shape == (2, *out_size, 1)
+        assert pool.backward(output).shape == input_.shape
+    # plans are cached per input size
+    assert len(conv._plans) == 2 and len(pool._plans) == 2
+
+
+def test_embedding():
+    vocab_size, dim = 20, 4
+    layer = Embedding(vocab_size, dim)
+    input_ = np.array([[1, 5, 1], [7, 5, 1]])
+    output = layer.forward(input_)
+    assert output.shape == (2, 3, dim)
+    assert np.all(output[0, 0] == layer.params["w"][1])
+
+    # the sparse gradient equals the dense gradient of the one-hot matmul
+    grad = np.random.randn(*output.shape)
+    assert layer.backward(grad) is None
+    sparse_grad = layer.grads["w"]
+    assert list(sparse_grad.indices) == [1, 5, 7]
+    one_hot = np.eye(vocab_size)[input_.ravel()]
+    dense_grad = one_hot.T @ grad.reshape((-1, dim))
+    assert np.allclose(sparse_grad.to_dense(), dense_grad)
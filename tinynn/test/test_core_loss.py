@@ -0,0 +1,127 @@
+"""test unit for core/loss.py"""
+
+import runtime_path  # isort:skip
+
+import numpy as np
+import pytest
+
+from tinynn.core.layer import SampledDense
+from tinynn.core.loss import MAE
+from tinynn.core.loss import MSE
+from tinynn.core.loss import Huber
+from tinynn.core.loss import SampledSoftmaxCrossEntropy
+from tinynn.core.loss import SigmoidCrossEntropy
+from tinynn.core.loss import SoftmaxCrossEntropy
+from tinynn.core.loss import UnigramSampler
+from tinynn.utils.dataset import get_one_hot
+
+
+def test_softmax_cross_entropy_index_labels():
+    logits = np.random.normal(size=(8, 5))
+    labels = np.random.randint(0, 5, 8)
+    one_hot = get_one_hot(labels, 5)
+
+    for T in (1.0, 2.0):
+        loss_fn = SoftmaxCrossEntropy(T=T)
+        assert np.isclose(loss_fn.loss(logits, labels),
+                          loss_fn.loss(logits, one_hot))
+        assert np.allclose(loss_fn.grad(logits, labels),
+                           loss_fn.grad(logits, one_hot))
+
+    weight = np.random.uniform(size=5)
+    loss_fn = SoftmaxCrossEntropy(weight=weight)
+    nll = -np.log(np.exp(logits[np.arange(8), labels]) /
+                  np.exp(logits).sum(axis=1))
+    assert np.isclose(loss_fn.loss(logits, labels),
+                      np.mean(nll * weight[labels]))
+
+
+@pytest.mark.parametrize("loss_fn", [
+    MSE(), MAE(), Huber(delta=0.5), SigmoidCrossEntropy(),
+    SoftmaxCrossEntropy(), SoftmaxCrossEntropy(T=3.0)])
+def test_loss_and_grad(loss_fn):
+    preds = np.random.normal(size=(8, 5))
+    targets = np.random.uniform(size=(8, 5))
+    loss, grad = loss_fn.loss_and_grad(preds, targets)
+    assert np.isclose(loss, loss_fn.loss(preds, targets))
+    assert np.allclose(grad, loss_fn.grad(preds, targets))
+
+    if isinstance(loss_fn, SoftmaxCrossEntropy):
+        labels = np.random.randint(0, 5, 8)
+        loss, grad = loss_fn.loss_and_grad(preds, labels)
+        assert np.isclose(loss, loss_fn.loss(preds, labels))
+        assert np.allclose(grad, loss_fn.grad(preds, labels))
+
+
+@pytest.mark.parametrize("loss_fn", [
+    MSE(), MAE(), Huber(delta=0.5), SigmoidCrossEntropy(),
+    SoftmaxCrossEntropy(), SoftmaxCrossEntropy(T=3.0)])
+def test_per_example_loss(loss_fn):
+    preds = np.random.normal(size=(8, 5))
+    targets = np.random.uniform(size=(8, 5))
+    losses = loss_fn.per_example(preds, targets)
+    assert losses.shape == (8,)
+    assert np.isclose(np.mean(losses), loss_fn.loss(preds, targets))
+
+    # scaling the loss of an example scales its row of the gradient
+    weights = np.random.uniform(size=8)
+    loss, grad, losses_ = loss_fn.weighted_loss_and_grad(
+        preds, targets, weights)
+    assert np.allclose(losses_, losses)
+    assert np.isclose(loss, np.mean(weights * losses))
+    assert np.allclose(grad, loss_fn.grad(preds, targets) * weights[:, None])
+
+
+def test_huber_grad():
+    loss_fn = Huber(delta=0.5)
+    preds = np.random.normal(size=(8, 5))
+    targets = np.random.normal(size=(8, 5))
+    # numerical gradient of the loss
+    eps = 1e-6
+    num_grad = np.zeros_like(preds)
+    for i in np.ndindex(preds.shape):
+        shifted = preds.copy()
+        shifted[i] += eps
+        num_grad[i] = (loss_fn.loss(shifted, targets) -
+                       loss_fn.loss(preds, targets)) / eps
+    assert np.allclose(loss_fn.grad(preds, targets), num_grad, atol=1e-4)
+
+
+@pytest.mark.parametrize("sampler", [None, UnigramSampler(np.arange(1, 51))])
+def test_sampled_softmax(sampler):
+    layer = SampledDense(50)
+    loss_fn = SampledSoftmaxCrossEntropy(layer, num_sampled=10, sampler=sampler)
+    inputs = np.random.normal(size=(4, 6))
+    labels = np.random.randint(0, 50, 4)
+    layer.forward(inputs)  # init params
+
+    def loss_and_grad(x):
+        np.random.seed(0)  # draw the same negative classes
+        return loss_fn.loss_and_grad(layer.forward(x), labels)
+
+    loss, grad = loss_and_grad(inputs)
+    assert grad.shape == (4, 11)
+    d_in = layer.backward(grad)
+    w_grad = layer.grads["w"].to_dense()
+    b_grad = layer.grads["b"].to_dense()
+    # only the target and sampled classes have gradients
+    assert len(layer.grads["w"].indices) <= 14
+
+    eps = 1e-6
+    for i in np.ndindex(inputs.shape):
+        shifted = inputs.copy()
+        shifted[i] += eps
+        num_grad = (loss_and_grad(shifted)[0] - loss) / eps
+        assert np.isclose(d_in[i], num_grad, atol=1e-4)
+    for i in layer.grads["w"].indices[:3]:
+        for p, g in ((layer.params["w"][i], w_grad[i]),
+                     (layer.params["b"][i:i + 1], b_grad[i:i + 1])):
+            p[0] += 1e-3
+            num_grad = (loss_and_grad(inputs)[0] - loss) / 1e-3
+            p[0] -= 1e-3
+            assert np.isclose(g[0], num_grad, atol=1e-2)
+
+    # full logits at inference
+    layer.set_phase("TEST")
+    assert layer.forward(inputs).shape == (4, 50)
+    assert layer.predict(inputs).shape == (4, 50)
@@ -0,0 +1,178 @@
+"""test unit for core/optimizer.py"""
+
+import runtime_path  # isort:skip
+
+import numpy as np
+
+import pytest
+from tinynn.core.net import SparseGrad
+from tinynn.core.net import StructuredParam
+from tinynn.core.optimizer import *
+from tinynn.utils.seeder import random_seed
+
+random_seed(0)
+
+
+@pytest.mark.parametrize("optimizer",
+                         [SGD(lr=0.1),
+                          Adam(lr=0.1),
+                          RAdam(lr=0.1),
+                          RMSProp(lr=0.1),
+                          Momentum(lr=0.1),
+                          Adagrad(lr=0.1),
+                          Adadelta(lr=1.0),
+                          Adam(lr=0.1, weight_decay=0.01),
+                          LARS(lr=1.0, eta=0.01, weight_decay=0.01),
+                          LAMB(lr=0.1, weight_decay=0.01)])
+def test_optimizer_minimize(optimizer):
+    # minimize a quadratic function 0.5 * ||x||^2 whose gradient is x
+    param_list = [{"w": np.random.normal(size=(5, 3)).astype(np.float32),
+                   "b": np.random.normal(size=3).astype(np.float32)}]
+    params = StructuredParam(param_list)
+    w = param_list[0]["w"]
+    init_norm = np.linalg.norm(w)
+    for _ in range(100):
+        grads = [{k: v.copy() for k, v in d.items()} for d in param_list]
+        optimizer.step(StructuredParam(grads), params)
+    # parameters are updated in place
+    assert param_list[0]["w"] is w
+    assert np.linalg.norm(w) < init_norm
+
+
+@pytest.mark.parametrize("optimizer", [SGD(lr=0.1), Adam(lr=0.1)])
+def test_sparse_update(optimizer):
+    w = np.random.normal(size=(10, 3)).astype(np.float32)
+    params = StructuredParam([{"w": w}])
+    w_before = w.copy()
+    for _ in range(2):
+        values = np.ones((2, 3))
+        grads = StructuredParam([{"w": SparseGrad(
+            np.array([2, 7]), values, w.shape)}])
+        optimizer.step(grads, params)
+    # only rows with gradients are updated
+    changed = np.any(w != w_before, axis=1)
+    assert list(np.flatnonzero(changed)) == [2, 7]
+    assert np.all(w[[2, 7]] < w_before[[2, 7]])
+
+
+@pytest.mark.parametrize("per_layer", [False, True])
+def test_grad_clip(per_layer):
+    param_list = [{"w": np.zeros((2, 2), dtype=np.float32)},
+                  {"w": np.zeros(4, dtype=np.float32)}]
+    grad_list = [{"w": np.full((2, 2), 3.0)}, {"w": np.full(4, 4.0)}]
+    optimizer = SGD(lr=1.0)
+    optimizer.set_grad_clip(1.0, per_layer=per_layer)
+    optimizer.step(StructuredParam(grad_list), StructuredParam(param_list))
+
+    if per_layer:
+        assert np.allclose(optimizer.grad_norm, [6.0, 8.0])
+        for p in param_list:
+            assert np.isclose(np.linalg.norm(p["w"]), 1.0)
+    else:
+        assert np.isclose(optimizer.grad_norm, 10.0)
+        norm = np.sqrt(sum(np.sum(p["w"] ** 2) for p in param_list))
+        assert np.isclose(norm, 1.0)
+        assert np.allclose(param_list[0]["w"], -0.3)
+
+
+def _adam_moments(g, s, b1, b2):
+    s["m"] = b1 * s["m"] + (1 - b1) * g
+    s["v"] = b2 * s["v"] + (1 - b2) * g ** 2
+
+
+def ref_sgd(g, w, s, t, lr=0.1):
+    return w - lr * g
+
+
+def ref_adam(g, w, s, t, lr=0.1, b1=0.9, b2=0.999, eps=1e-8):
+    _adam_moments(g, s, b1, b2)
+    m_hat, v_hat = s["m"] / (1 - b1 ** t), s["v"] / (1 - b2 ** t)
+    return w - lr * m_hat / (v_hat ** 0.5 + eps)
+
+
+def ref_adam_wd(g, w, s, t, lr=0.1, wd=0.01):
+    # decoupled weight decay
+    return ref_adam(g, w * (1 - lr * wd), s, t, lr=lr)
+
+
+def ref_radam(g, w, s, t, lr=0.1, b1=0.9, b2=0.999, eps=1e-8):
+    _adam_moments(g, s, b1, b2)
+    m_hat = s["m"] / (1 - b1 ** t)
+    rho_inf = 2 / (1 - b2) - 1
+    rho = rho_inf - 2 * t * b2 ** t / (1 - b2 ** t)
+    if rho <= 4:
+        return w - lr * m_hat
+    v_hat = s["v"] / (1 - b2 ** t)
+    r = ((rho - 4) * (rho - 2) * rho_inf /
+         ((rho_inf - 4) * (rho_inf - 2) * rho)) ** 0.5
+    return w - lr * r * m_hat / (v_hat ** 0.5 + eps)
+
+
+def ref_rmsprop(g, w, s, t, lr=0.1, decay=0.99, momentum=0.5, eps=1e-8):
+    s["ms"] = decay * s["ms"] + (1 - decay) * g ** 2
+    s["mom"] = momentum * s["mom"] + lr * g / (s["ms"] + eps) ** 0.5
+    return w - s["mom"]
+
+
+def ref_momentum(g, w, s, t, lr=0.1, momentum=0.9):
+    s["acc"] = momentum * s["acc"] + g
+    return w - lr * s["acc"]
+
+
+def ref_adagrad(g, w, s, t, lr=0.1, eps=1e-8):
+    s["G"] = s["G"] + g ** 2
+    return w - lr * g / (s["G"] + eps) ** 0.5
+
+
+def ref_adadelta(g, w, s, t, lr=1.0, decay=0.9, eps=1e-8):
+    s["Eg"] = decay * s["Eg"] + (1 - decay) * g ** 2
+    delta = g * (s["delta"] + eps) ** 0.5 / (s["Eg"] + eps) ** 0.5
+    s["delta"] = decay * s["delta"] + (1 - decay) * delta ** 2
+    return w - lr * delta
+
+
+def ref_lars(g, w, s, t, lr=1.0, momentum=0.9, eta=0.01, wd=0.01, eps=1e-8):
+    w_norm, g_norm = np.linalg.norm(w), np.linalg.norm(g)
+    local_lr = eta * w_norm / (g_norm + wd * w_norm + eps)
+    s["acc"] = momentum * s["acc"] + lr * local_lr * (g + wd * w)
+    return w - s["acc"]
+
+
+def ref_lamb(g, w, s, t, lr=0.1, b1=0.9, b2=0.999, eps=1e-6, wd=0.01):
+    _adam_moments(g, s, b1, b2)
+    m_hat, v_hat = s["m"] / (1 - b1 ** t), s["v"] / (1 - b2 ** t)
+    r = m_hat / (v_hat ** 0.5 + eps) + wd * w
+    return w - lr * np.linalg.norm(w) / np.linalg.norm(r) * r
+
+
+@pytest.mark.parametrize("optimizer, reference", [
+    (SGD(lr=0.1), ref_sgd),
+    (Adam(lr=0.1), ref_adam),
+    (Adam(lr=0.1, weight_decay=0.01), ref_adam_wd),
+    (RAdam(lr=0.1), ref_radam),
+    (RMSProp(lr=0.1, momentum=0.5), ref_rmsprop),
+    (Momentum(lr=0.1), ref_momentum),
+    (Adagrad(lr=0.1), ref_adagrad),
+    (Adadelta(lr=1.0), ref_adadelta),
+    (LARS(lr=1.0, eta=0.01, weight_decay=0.01), ref_lars),
+    (LAMB(lr=0.1, weight_decay=0.01), ref_lamb)])
+def test_optimizer_update_formula(optimizer, reference):
+    param_list = [{"w": np.random.normal(size=(4, 3)).astype(np.float32),
+                   "b": np.random.normal(size=3).astype(np.float32)}]
+    expect = [p.astype(np.float64) for p in param_list[0].values()]
+    states = [{name: np.zeros_like(p) for name in optimizer.state_names}
+              for p in expect]
+    # 8 steps cover both branches of RAdam
+    for t in range(1, 9):
+        grad_list = [{k: np.random.normal(size=v.shape).astype(np.float32)
+                      for k, v in param_list[0].items()}]
+        expect = [reference(g.astype(np.float64), w, s, t) for g, w, s in
+                  zip(grad_list[0].values(), expect, states)]
+        optimizer.step(StructuredParam(grad_list), StructuredParam(param_list))
+
+        for param, w in zip(param_list[0].values(), expect):
+            assert np.allclose(param, w, rtol=1e-4, atol=1e-5)
+        for state, s in zip(optimizer._states, states):
+            assert set(state) == set(s)
+            for name in s:
+                assert np.allclose(state[name], s[name], rtol=1e-4, atol=1e-6)
@@ -5,13 +5,18 @@ import runtime_path  # isort:skip
 import numpy as np
 
 import pytest
+from tinynn.core.layer import BatchNormalization
 from tinynn.core.layer import Conv2D
 from tinynn.core.layer import Dense
+from tinynn.core.layer import Dropout
+from tinynn.core.layer import Embedding
 from tinynn.core.layer import Flatten
 from tinynn.core.layer import MaxPool2D
+from tinynn.core.layer import ReLU
 from tinynn.core.loss import MSE
 from tinynn.core.model import Model
 from tinynn.core.net import Net
+from tinynn.core.optimizer import Adam
 from tinynn.core.optimizer import SGD
 from tinynn.utils.seeder import random_seed
 
@@ -69,13 +74,42 @@ def test_parameters_change(fake_dataset):
     loss, grads = model.backward(pred, y)
 
     # parameters change test
-    params_before = model.net.params.values
+    params_before = [p.copy() for p in model.net.params.values]
     model.apply_grads(grads)
     params_after = model.net.params.values
     for p1, p2 in zip(params_before, params_after):
         assert np.all(p1 != p2)
 
 
+def test_init_params():
+    net = Net([
+        Conv2D(kernel=[3, 3, 1, 4], stride=[2, 2]),
+        BatchNormalization(),
+        ReLU(),
+        MaxPool2D(pool_size=[2, 2], stride=[2, 2]),
+        Flatten(),
+        Dense(10)
+    ])
+    input_shape = (16, 16, 1)
+    shapes = net.infer_shapes(input_shape)
+    assert shapes == [(8, 8, 4), (8, 8, 4), (8, 8, 4), (4, 4, 4), (64,), (10,)]
+
+    # params are initialized without any forward pass
+    net.init_params(input_shape)
+    assert all(l.is_init for l in net.layers if l.param_names)
+    assert net.layers[-1].params["w"].shape == (64, 10)
+    assert net.layers[2].inputs is None
+
+    # inferred shapes agree with real outputs
+    inputs = np.random.normal(size=(2, *input_shape))
+    for layer, shape in zip(net.layers, shapes):
+        inputs = layer.forward(inputs)
+        assert inputs.shape[1:] == shape
+
+    assert "total params: %d" % (36 + 4 + 4 + 4 + 640 + 10) in \
+        net.summary(input_shape)
+
+
 def test_backprop_dense(fc_model, fake_dataset):
     # train on a single data point
     X, y = fake_dataset
@@ -102,3 +136,172 @@ def test_backprop_cnn(cnn_model, img_dataset):
         # loss should decrease monotonically
         assert loss < previous_loss
         previous_loss = loss
+
+
+def test_gradient_checkpointing(img_dataset):
+    X, y = img_dataset
+
+    def build_net():
+        random_seed(0)
+        return Net([
+            Conv2D(kernel=[3, 3, 1, 2]),
+            BatchNormalization(),
+            ReLU(),
+            MaxPool2D(pool_size=[2, 2], stride=[2, 2]),
+            Conv2D(kernel=[3, 3, 2, 4]),
+            ReLU(),
+            Flatten(),
+            Dropout(keep_prob=0.8),
+            Dense(1)
+        ])
+
+    results = []
+    for boundaries in (None, "auto", [2, 5]):
+        net = build_net()
+        net.set_checkpoints(boundaries)
+        model = Model(net, loss=MSE(), optimizer=SGD())
+        random_seed(1)
+        pred = model.forward(X)
+        loss, grads = model.backward(pred, y)
+        results.append((loss, grads, net.params))
+
+    # checkpointing should not change the results
+    expect_loss, expect_grads, expect_params = results[0]
+    for loss, grads, params in results[1:]:
+        assert np.allclose(loss, expect_loss)
+        for g1, g2 in zip(grads.values, expect_grads.values):
+            assert np.allclose(g1, g2)
+        for p1, p2 in zip(params.ut_values, expect_params.ut_values):
+            assert np.allclose(p1, p2)
+
+
+def test_compile(img_dataset):
+    X, y = img_dataset
+    X = X.astype(np.float32)
+
+    def build_model():
+        random_seed(0)
+        net = Net([
+            Conv2D(kernel=[3, 3, 1, 2]),
+            ReLU(),
+            MaxPool2D(pool_size=[2, 2], stride=[2, 2]),
+            Conv2D(kernel=[3, 3, 2, 4], padding="VALID"),
+            ReLU(),
+            Flatten(),
+            Dense(1)
+        ])
+        return Model(net, loss=MSE(), optimizer=SGD())
+
+    model = build_model()
+    model.net.init_params(X.shape[1:])
+    expect_draw = np.random.uniform()
+    compiled = build_model()
+    compiled.net.compile(input_shape=X.shape[1:], batch_size=32)
+    # params are initialized as usual and the dry run leaves the random
+    # state untouched
+    assert np.random.uniform() == expect_draw
+    arena = compiled.net._arena
+    # float32 inputs and params keep all float buffers in float32
+    assert all(buf.dtype == np.float32 for layer in compiled.net.layers
+               for buf in layer.buffers.values() if buf.dtype.kind == "f")
+
+    # the last batch has a different size and falls back to allocation
+    for start in range(0, len(X), 32):
+        batch_x, batch_y = X[start: start + 32], y[start: start + 32]
+        results = []
+        for m in (model, compiled):
+            pred = m.forward(batch_x)
+            loss, grads = m.backward(pred, batch_y)
+            m.apply_grads(grads)
+            results.append((pred.copy(), loss))
+        assert np.allclose(results[0][0], results[1][0])
+        assert np.allclose(results[0][1], results[1][1])
+        if len(batch_x) == 32:
+            assert np.shares_memory(pred, arena)
+
+    for p1, p2 in zip(model.net.params.values, compiled.net.params.values):
+        assert np.allclose(p1, p2)
+
+
+def test_compile_embedding():
+    net = Net([Embedding(20, 4), Flatten(), Dense(1)])
+    indices = np.random.randint(0, 20, size=(8, 3))
+    net.compile(inputs=indices)
+    outputs = net.forward(indices)
+    assert outputs.shape == (8, 1)
+    assert np.shares_memory(outputs, net._arena)
+
+    net = Net([Embedding(20, 4), Flatten(), Dense(1)])
+    net.compile(input_shape=(3,), batch_size=8, dtype=np.int64)
+    assert net.forward(indices).shape == (8, 1)
+
+
+def test_save_and_resume(fake_dataset, tmp_path):
+    X, y = fake_dataset
+
+    def build_model():
+        return Model(Net([Dense(10), Dense(1)]), loss=MSE(),
+                     optimizer=Adam(lr=1e-2))
+
+    model = build_model()
+    for step in range(3):
+        loss, grads = model.backward(model.forward(X), y)
+        model.apply_grads(grads)
+    path = str(tmp_path / "model.pkl")
+    model.save(path)
+
+    for mmap in (True, False):
+        resumed = build_model()
+        resumed.load(path, mmap_optimizer=mmap)
+        loss, grads = resumed.backward(resumed.forward(X), y)
+        resumed.apply_grads(grads)
+        if mmap:
+            loss, grads = model.backward(model.forward(X), y)
+            model.apply_grads(grads)
+        # resumed training continues with the same moments and step count
+        for p1, p2 in zip(model.net.params.values, resumed.net.params.values):
+            assert np.allclose(p1, p2)
+
+
+def test_save_over_resumed_checkpoint(fake_dataset, tmp_path):
+    X, y = fake_dataset
+
+    def build_model():
+        # states larger than a page
+        return Model(Net([Dense(100), Dense(1)]), loss=MSE(),
+                     optimizer=Adam(lr=1e-2))
+
+    model = build_model()
+    loss, grads = model.backward(model.forward(X), y)
+    model.apply_grads(grads)
+    path = str(tmp_path / "model.pkl")
+    model.save(path)
+
+    # save a checkpoint over the memory-mapped file it was resumed from
+    resumed = build_model()
+    resumed.load(path)
+    loss, grads = resumed.backward(resumed.forward(X), y)
+    resumed.apply_grads(grads)
+    resumed.save(path)
+    reloaded = build_model()
+    reloaded.load(path)
+    assert reloaded.optimizer._t == resumed.optimizer._t
+    assert np.array_equal(reloaded.optimizer._buffer, resumed.optimizer._buffer)
+
+
+def test_assign_params(fake_dataset):
+    X, y = fake_dataset
+    model = Model(Net([Dense(10), Dense(1)]), loss=MSE(),
+                  optimizer=Adam(lr=1e-2))
+    model.forward(X)
+    # e.g. the target network of DQN
+    target = Net([Dense(10), Dense(1)])
+    target.params = model.net.params
+    expect = [v.copy() for v in target.params.values]
+
+    loss, grads = model.backward(model.forward(X), y)
+    model.apply_grads(grads)
+    for p1, p2, p3 in zip(model.net.params.values, target.params.values,
+                          expect):
+        assert not np.shares_memory(p1, p2)
+        assert np.array_equal(p2, p3)
@@ -0,0 +1,65 @@
+"""test unit for utils/augmentation.py"""
+
+import runtime_path  # isort:skip
+
+import numpy as np
+import pytest
+
+from tinynn.utils.augmentation import Compose
+from tinynn.utils.augmentation import Cutout
+from tinynn.utils.augmentation import Mixup
+from tinynn.utils.augmentation import Normalize
+from tinynn.utils.augmentation import RandomCrop
+from tinynn.utils.augmentation import RandomFlip
+from tinynn.utils.augmentation import RandomTranslate
+from tinynn.utils.data_iterator import BatchIterator
+
+
+def test_crop_and_flip():
+    images = np.random.uniform(size=(8, 6, 5, 3))
+    labels = np.arange(8)
+
+    crops, _ = RandomCrop(size=(4, 3))(images, labels)
+    assert crops.shape == (8, 4, 3, 3)
+    for crop, image in zip(crops, images):
+        # each crop is a window of its own image
+        assert any(np.all(crop == image[i:i + 4, j:j + 3])
+                   for i in range(3) for j in range(3))
+
+    shifted, _ = RandomTranslate(max_shift=2)(images, labels)
+    assert shifted.shape == images.shape
+
+    flipped, _ = RandomFlip(prob=1.0)(images, labels)
+    assert np.all(flipped == images[:, :, ::-1])
+    unchanged, _ = RandomFlip(prob=0.0)(images, labels)
+    assert np.all(unchanged == images)
+
+
+def test_cutout_and_mixup():
+    images = np.ones((8, 10, 10, 3))
+    labels = np.random.randint(0, 4, 8)
+
+    outputs, _ = Cutout(size=4)(images, labels)
+    n_cut = np.sum(outputs[..., 0] == 0, axis=(1, 2))
+    assert np.all(n_cut > 0) and np.all(n_cut <= 16)
+    assert np.all(images == 1)
+
+    outputs, targets = Mixup(alpha=0.4, num_classes=4)(images, labels)
+    assert outputs.shape == images.shape
+    assert targets.shape == (8, 4)
+    assert np.allclose(targets.sum(axis=1), 1.0)
+    with pytest.raises(ValueError):
+        Mixup()(images, labels)
+
+
+def test_batch_transform():
+    images = np.random.uniform(size=(20, 8, 8, 3))
+    labels = np.arange(20)
+    images = (images * 255).astype(np.uint8)
+    augment = Compose([Normalize(scale=1 / 255.0), RandomCrop(padding=2),
+                       RandomFlip(), Cutout(size=3)])
+    iterator = BatchIterator(batch_size=8, batch_transform=augment)
+    batches = list(iterator(images, labels))
+    assert all(b.inputs.dtype == np.float32 for b in batches)
+    assert [len(b.inputs) for b in batches] == [8, 8, 4]
+    assert all(b.inputs.shape[1:] == (8, 8, 3) for b in batches)
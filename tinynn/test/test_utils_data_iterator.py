@@ -3,8 +3,15 @@
 import runtime_path  # isort:skip
 
 import numpy as np
+import pytest
 
+from tinynn.utils.data_iterator import BaseIterator
 from tinynn.utils.data_iterator import BatchIterator
+from tinynn.utils.data_iterator import MultiprocessIterator
+from tinynn.utils.data_iterator import PrefetchIterator
+from tinynn.utils.data_iterator import StreamingIterator
+from tinynn.utils.dataset import ChunkedDataset
+from tinynn.utils.dataset import ChunkedDatasetWriter
 
 
 def test_batch_iterator():
@@ -23,3 +30,162 @@ def test_batch_iterator():
         n_batches += 1
 
     assert n_batches == 10
+
+
+@pytest.mark.parametrize("reuse_buffer", [False, True])
+def test_batch_iterator_shuffle(reuse_buffer):
+    n_data = 95
+    fake_x = np.arange(n_data * 3).reshape((n_data, 3))
+    fake_y = np.arange(n_data)
+
+    iterator = BatchIterator(batch_size=10, reuse_buffer=reuse_buffer)
+    seen = []
+    for batch_x, batch_y in iterator(fake_x, fake_y):
+        assert np.all(batch_x[:, 0] == batch_y * 3)
+        seen.extend(batch_y)
+    # the last batch is incomplete
+    assert len(batch_y) == 5
+    assert sorted(seen) == list(range(n_data))
+
+    iterator = BatchIterator(batch_size=10, drop_last=True,
+                             reuse_buffer=reuse_buffer)
+    batches = [batch_y.copy() for _, batch_y in iterator(fake_x, fake_y)]
+    assert len(batches) == 9
+    assert all(len(b) == 10 for b in batches)
+    assert len(set(np.concatenate(batches))) == 90
+
+
+@pytest.mark.parametrize("num_threads", [1, 3])
+def test_prefetch_iterator(num_threads):
+    fake_x = np.random.normal(size=(95, 3))
+    fake_y = np.arange(95)
+    iterator = PrefetchIterator(BatchIterator(batch_size=10),
+                                buffer_size=2, num_threads=num_threads)
+
+    for _ in range(2):
+        np.random.seed(0)
+        expect = [batch_y for _, batch_y in BatchIterator(10)(fake_x, fake_y)]
+        np.random.seed(0)
+        for i, (batch_x, batch_y) in enumerate(iterator(fake_x, fake_y)):
+            assert np.all(batch_y == expect[i])
+            assert np.all(batch_x == fake_x[batch_y])
+        assert i == len(expect) - 1
+        assert iterator.wait_time >= 0.0
+
+    # stop in the middle of an epoch
+    for i, _ in enumerate(iterator(fake_x, fake_y)):
+        if i == 3:
+            break
+
+
+def test_prefetch_iterator_generic():
+
+    class RangeIterator(BaseIterator):
+
+        def __call__(self, inputs, targets):
+            for i in range(len(inputs)):
+                if inputs[i] < 0:
+                    raise ValueError("negative input")
+                yield inputs[i], targets[i]
+
+    iterator = PrefetchIterator(RangeIterator())
+    x = np.arange(5)
+    assert [b[0] for b in iterator(x, x)] == list(range(5))
+    with pytest.raises(ValueError):
+        list(iterator(x - 3, x))
+
+
+def _noisy_flip(x, y):
+    return x[::-1] + np.random.normal(size=x.shape), y * 2
+
+
+def _fail(x, y):
+    if y == 10:
+        raise ValueError("bad sample")
+    return x, y
+
+
+def test_multiprocess_iterator():
+    fake_x = np.random.normal(size=(50, 4, 3))
+    fake_y = np.arange(50)
+
+    results, next_draws = [], []
+    for num_workers in (0, 1, 3):
+        np.random.seed(0)
+        iterator = MultiprocessIterator(batch_size=8, transform=_noisy_flip,
+                                        num_workers=num_workers)
+        batches = [(x.copy(), y.copy()) for x, y in iterator(fake_x, fake_y)]
+        iterator.close()
+        results.append(batches)
+        # the transform seeds do not leak into the random state of the caller
+        next_draws.append(np.random.uniform(size=3))
+    # the same batches for any number of workers
+    for draws in next_draws[1:]:
+        assert np.all(draws == next_draws[0])
+    for batches in results[1:]:
+        for (x1, y1), (x2, y2) in zip(results[0], batches):
+            assert np.all(x1 == x2) and np.all(y1 == y2)
+    assert len(results[0]) == 7 and len(results[0][-1][1]) == 2
+    assert sorted(np.concatenate([y for _, y in results[0]])) == \
+        list(range(0, 100, 2))
+
+    iterator = MultiprocessIterator(batch_size=8, shuffle=False)
+    batch_x, batch_y = next(iterator(fake_x, fake_y))
+    assert np.all(batch_x == fake_x[:8]) and np.all(batch_y == fake_y[:8])
+
+    iterator = MultiprocessIterator(batch_size=8, transform=_fail)
+    with pytest.raises(RuntimeError):
+        list(iterator(fake_x, fake_y))
+    iterator.close()
+
+
+def _scale(x, y):
+    return x * 100, y
+
+
+def test_prefetch_multiprocess_iterator():
+    x = np.arange(5)
+    iterator = PrefetchIterator(MultiprocessIterator(
+        batch_size=1, shuffle=False, transform=_scale, num_workers=2))
+    assert [int(b[0][0]) for b in iterator(x, x)] == [0, 100, 200, 300, 400]
+    iterator.iterator.close()
+
+
+def test_streaming_iterator(tmp_path):
+    fake_x = np.random.normal(size=(103, 2, 3))
+    fake_y = np.arange(103)
+    path = str(tmp_path / "chunked")
+    with ChunkedDatasetWriter(path, chunk_size=20) as writer:
+        for start in range(0, 103, 7):
+            writer.write(fake_x[start: start + 7], fake_y[start: start + 7])
+    dataset = ChunkedDataset(path)
+    assert len(dataset) == 103 and dataset.num_chunks == 6
+
+    # the same batches as BatchIterator without shuffling
+    iterator = StreamingIterator(batch_size=8, shuffle=False)
+    expect = BatchIterator(batch_size=8, shuffle=False)(fake_x, fake_y)
+    for (x1, y1), (x2, y2) in zip(iterator(dataset), expect):
+        assert np.all(x1 == x2) and np.all(y1 == y2)
+
+    iterator = StreamingIterator(batch_size=8, buffer_size=30)
+    batches = list(iterator(dataset))
+    seen = np.concatenate([batch_y for _, batch_y in batches])
+    assert sorted(seen) == list(range(103))
+    assert not np.all(seen == np.arange(103))
+    for batch_x, batch_y in batches:
+        assert np.all(batch_x == fake_x[batch_y])
+    assert [len(y) for _, y in batches].count(8) == 12
+
+    iterator = StreamingIterator(batch_size=8, buffer_size=30, drop_last=True)
+    assert all(len(y) == 8 for _, y in iterator(dataset))
+
+    # streaming batches are read ahead in a background thread
+    np.random.seed(0)
+    expect = list(StreamingIterator(batch_size=8, buffer_size=30)(dataset))
+    np.random.seed(0)
+    iterator = PrefetchIterator(
+        StreamingIterator(batch_size=8, buffer_size=30))
+    batches = list(iterator(dataset))
+    assert len(batches) == len(expect)
+    for (x1, y1), (x2, y2) in zip(batches, expect):
+        assert np.all(x1 == x2) and np.all(y1 == y2)
@@ -0,0 +1,50 @@
+"""test unit for utils/dataset.py"""
+
+import runtime_path  # isort:skip
+
+import numpy as np
+
+from tinynn.utils.dataset import _cifar_features
+from tinynn.utils.dataset import chw_to_hwc
+from tinynn.utils.dataset import hwc_to_chw
+from tinynn.utils.dataset import load_cached
+from tinynn.utils.dataset import normalize_images
+
+
+def test_load_cached(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    calls = []
+
+    def build():
+        calls.append(1)
+        return {"x": np.arange(12, dtype=np.uint8).reshape((3, 4)),
+                "y": np.array([0, 1, 2])}
+
+    for _ in range(2):
+        data = load_cached(cache_dir, ["x", "y"], build)
+        assert isinstance(data["x"], np.memmap)
+        assert data["x"].dtype == np.uint8 and data["x"].shape == (3, 4)
+        assert np.all(data["y"] == [0, 1, 2])
+    # the cache is built only once
+    assert len(calls) == 1
+
+
+def test_normalize_images():
+    images = np.random.randint(0, 256, size=(4, 5, 5, 3)).astype(np.uint8)
+    mean, std = (0.4, 0.5, 0.6), (0.2, 0.25, 0.3)
+    outputs = normalize_images(images, 1 / 255.0, mean, std)
+    assert outputs.dtype == np.float32
+    expect = (images / 255.0 - np.array(mean)) / np.array(std)
+    assert np.allclose(outputs, expect, atol=1e-5)
+    # flattened HWC images are normalized per channel as well
+    flat = normalize_images(images.reshape((4, -1)), 1 / 255.0, mean, std)
+    assert np.allclose(flat, outputs.reshape((4, -1)))
+
+    chw = np.transpose(images, (0, 3, 1, 2)).reshape((4, -1))
+    assert np.all(chw_to_hwc(chw) == images.reshape((4, -1)))
+    assert np.all(hwc_to_chw(images.reshape((4, -1))) == chw)
+
+    # cifar loaders default to normalized CHW features, built from the
+    # uint8 HWC cache
+    features = _cifar_features(images.reshape((4, -1)), True, False, mean, std)
+    assert np.allclose(features, hwc_to_chw(outputs.reshape((4, -1))))
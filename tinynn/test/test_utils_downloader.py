@@ -0,0 +1,121 @@
+"""test unit for utils/downloader.py"""
+
+import runtime_path  # isort:skip
+
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from tinynn.utils import downloader
+from tinynn.utils.downloader import download_url
+from tinynn.utils.downloader import download_urls
+from tinynn.utils.downloader import is_verified
+from tinynn.utils.downloader import md5_checksum
+
+FILES = {"/file%d" % i: os.urandom(300000 + i) for i in range(4)}
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve FILES with range requests. Paths in `broken` are cut off once."""
+    ranges = []
+    broken = set()
+
+    def do_GET(self):
+        data = FILES[self.path]
+        start = 0
+        range_header = self.headers.get("Range")
+        self.ranges.append((self.path, range_header))
+        if range_header is not None:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        if self.path in self.broken:
+            self.broken.discard(self.path)
+            self.wfile.write(data[start: start + 100000])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    RangeHandler.ranges.clear()
+    yield "http://127.0.0.1:%d" % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def test_md5_checksum(tmp_path):
+    path = str(tmp_path / "file")
+    with open(path, "wb") as f:
+        f.write(FILES["/file0"])
+    assert md5_checksum(path, chunk_size=4096) == md5(FILES["/file0"])
+
+
+def test_resume_download(server, tmp_path):
+    path = str(tmp_path / "data" / "file0")
+    RangeHandler.broken.add("/file0")
+    with pytest.raises(Exception):
+        download_url(server + "/file0", path, md5(FILES["/file0"]))
+    assert os.path.getsize(path + ".part") == 100000
+
+    download_url(server + "/file0", path, md5(FILES["/file0"]))
+    with open(path, "rb") as f:
+        assert f.read() == FILES["/file0"]
+    assert not os.path.exists(path + ".part")
+    assert RangeHandler.ranges[-1] == ("/file0", "bytes=100000-")
+
+    # wrong checksum
+    with pytest.raises(RuntimeError):
+        download_url(server + "/file1", str(tmp_path / "file1"), "0" * 32)
+    assert not os.path.exists(str(tmp_path / "file1.part"))
+
+
+def test_download_urls(server, tmp_path):
+    paths = [str(tmp_path / name[1:]) for name in FILES]
+    download_urls([server + name for name in FILES], paths,
+                  [md5(data) for data in FILES.values()], max_workers=2)
+    for path, data in zip(paths, FILES.values()):
+        with open(path, "rb") as f:
+            assert f.read() == data
+
+
+def test_verification_record(server, tmp_path, monkeypatch):
+    path = str(tmp_path / "file2")
+    checksum = md5(FILES["/file2"])
+    download_url(server + "/file2", path, checksum)
+    assert is_verified(path, checksum)
+    assert not is_verified(path, "0" * 32)
+
+    # verified files are not hashed again
+    monkeypatch.setattr(downloader, "md5_checksum", None)
+    download_url(server + "/file2", path, checksum)
+    assert len(RangeHandler.ranges) == 1
+    monkeypatch.undo()
+
+    # a modified file is hashed again and downloaded since it is wrong
+    with open(path, "r+b") as f:
+        f.write(b"corrupted")
+    assert not is_verified(path, checksum)
+    download_url(server + "/file2", path, checksum)
+    assert len(RangeHandler.ranges) == 2
+    assert is_verified(path, checksum)
@@ -0,0 +1,71 @@
+"""test unit for utils/sampler.py"""
+
+import runtime_path  # isort:skip
+
+import numpy as np
+import pytest
+
+from tinynn.utils.data_iterator import BatchIterator
+from tinynn.utils.sampler import ImportanceSampler
+from tinynn.utils.sampler import WeightedSampler
+from tinynn.utils.sampler import build_alias_table
+
+
+def implied_probs(prob, alias):
+    n = len(prob)
+    probs = prob.copy()
+    np.add.at(probs, alias, 1.0 - prob)
+    return probs / n
+
+
+@pytest.mark.parametrize("weights", [
+    np.random.uniform(size=1000),
+    np.r_[1000.0, np.ones(999)],  # one heavy bucket
+    np.r_[np.zeros(10), np.random.exponential(size=90)]])
+def test_build_alias_table(weights):
+    prob, alias = build_alias_table(weights)
+    assert np.allclose(implied_probs(prob, alias), weights / weights.sum())
+
+
+def test_weighted_sampler():
+    weights = np.random.uniform(size=50)
+    sampler = WeightedSampler(weights, block_size=7)
+    freq = np.bincount(sampler.sample(200000), minlength=50) / 200000
+    assert np.allclose(freq, weights / weights.sum(), atol=0.01)
+
+    # incremental updates
+    sampler.update(np.arange(25), np.zeros(25))
+    assert np.all(sampler.sample(10000) >= 25)
+    sampler.update([3], [100.0])
+    assert np.mean(sampler.sample(10000) == 3) > 0.5
+
+    labels = np.r_[np.zeros(900, dtype=int), np.ones(100, dtype=int)]
+    sampler = WeightedSampler.class_balanced(labels)
+    assert abs(np.mean(labels[sampler.sample(20000)]) - 0.5) < 0.02
+
+    iterator = BatchIterator(batch_size=32, sampler=sampler, num_samples=320)
+    batches = list(iterator(labels, labels))
+    assert len(batches) == 10 and all(len(b.inputs) == 32 for b in batches)
+
+
+def test_importance_sampler():
+    sampler = ImportanceSampler(50, uniform_ratio=0.2)
+    losses = np.random.exponential(size=50)
+    sampler.record(np.arange(40), losses[:40])
+    idx = sampler.sample(200000)
+    # unseen samples get the largest recorded loss
+    assert np.allclose(sampler.weights[40:], np.max(losses[:40]))
+    freq = np.bincount(idx, minlength=50) / 200000
+    assert np.allclose(freq, sampler.probability(np.arange(50)), atol=0.01)
+    assert np.isclose(np.sum(sampler.probability(np.arange(50))), 1.0)
+
+    # importance weighted means are unbiased estimates of the mean
+    values = np.random.normal(size=50)
+    estimate = np.mean(values[idx] * sampler.importance_weights(idx))
+    assert abs(estimate - np.mean(values)) < 0.02
+    assert np.max(sampler.importance_weights(np.arange(50))) <= 1 / 0.2
+
+    iterator = BatchIterator(batch_size=10, sampler=sampler)
+    inputs = np.arange(50)
+    for batch in iterator(inputs, inputs):
+        assert np.all(batch.inputs == inputs[batch.indices])
@@ -0,0 +1,55 @@
+"""test unit for utils/shared_dataset.py"""
+
+import runtime_path  # isort:skip
+
+import multiprocessing
+import os
+import pickle
+
+import numpy as np
+
+from tinynn.utils.shared_dataset import SharedDataset
+
+
+def shard_sums(shared, rank, num_shards):
+    x, y = shared.shard(rank, num_shards)
+    return float(x.sum()), y.tolist()
+
+
+def test_shared_dataset(tmp_path):
+    x = np.random.normal(size=(100, 3, 4)).astype(np.float32)
+    y = np.arange(100, dtype=np.uint8)
+    shared = SharedDataset((x, y), dir=str(tmp_path))
+    shared_x, shared_y = shared
+    assert np.array_equal(shared_x, x) and np.array_equal(shared_y, y)
+
+    # the pickled handle does not contain the data
+    data = pickle.dumps(shared)
+    assert len(data) < 1000
+    attached = pickle.loads(data)
+    assert np.array_equal(attached[0], x)
+    assert not attached[0].flags.writeable
+
+    with multiprocessing.get_context().Pool(2) as pool:
+        results = pool.starmap(shard_sums, [(shared, r, 3) for r in range(3)])
+    indices = sorted(i for _, ys in results for i in ys)
+    assert indices == list(range(100))
+    assert np.isclose(sum(s for s, _ in results), x.sum(), rtol=1e-4)
+
+    # the attached copy never deletes the file
+    attached.close()
+    path = shared._path
+    assert os.path.exists(path)
+    shared.close()
+    assert not os.path.exists(path)
+
+
+def test_shared_dataset_memmap(tmp_path):
+    path = str(tmp_path / "x.npy")
+    np.save(path, np.random.normal(size=(20, 5)))
+    x = np.load(path, mmap_mode="r")
+    shared = SharedDataset((x, np.ones(20)), dir=str(tmp_path))
+    # file-backed arrays are referenced in place
+    assert pickle.loads(pickle.dumps(shared))._specs[0][0] == path
+    assert np.array_equal(shared[0], x)
+    assert np.array_equal(shared[1], np.ones(20))
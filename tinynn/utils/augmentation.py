@@ -0,0 +1,157 @@
+"""Data augmentation operating on whole NHWC image batches.
+
+Each op draws the random parameters of all samples in one call and applies
+them with fancy indexing and strided views, so no Python loop runs over the
+samples. Ops take and return (inputs, targets) and never modify the input
+batch in place, so they can be plugged into BatchIterator as
+`batch_transform`, e.g.
+    BatchIterator(batch_size=128, batch_transform=Compose([
+        RandomCrop(padding=4), RandomFlip(), Cutout(size=8)]))
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from tinynn.utils.dataset import get_one_hot
+from tinynn.utils.dataset import normalize_images
+
+
+class Augmentation:
+
+    def __call__(self, inputs, targets):
+        raise NotImplementedError
+
+
+class Compose(Augmentation):
+
+    def __init__(self, ops):
+        self.ops = ops
+
+    def __call__(self, inputs, targets):
+        for op in self.ops:
+            inputs, targets = op(inputs, targets)
+        return inputs, targets
+
+
+class Normalize(Augmentation):
+    """
+    Convert a batch to float32 and normalize it as (inputs * scale - mean)
+    / std with per-channel mean and std. Used to keep datasets as uint8 and
+    convert them batch by batch.
+    """
+    def __init__(self, scale=1.0, mean=None, std=None):
+        self.scale = scale
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, inputs, targets):
+        return normalize_images(inputs, self.scale, self.mean, self.std), targets
+
+
+class RandomCrop(Augmentation):
+    """
+    Zero-pad the images and crop a random window from each of them.
+    :param size: (height, width) of the crops, defaults to the image size
+    :param padding: number of zero pixels added to each border
+    """
+    def __init__(self, size=None, padding=0):
+        self.size = size
+        self.padding = padding
+
+    def __call__(self, inputs, targets):
+        batch_sz, in_h, in_w, in_c = inputs.shape
+        out_h, out_w = self.size or (in_h, in_w)
+        p = self.padding
+        if p:
+            padded = np.zeros((batch_sz, in_h + 2 * p, in_w + 2 * p, in_c),
+                              dtype=inputs.dtype)
+            padded[:, p: p + in_h, p: p + in_w] = inputs
+            inputs = padded
+        top = np.random.randint(0, in_h + 2 * p - out_h + 1, size=batch_sz)
+        left = np.random.randint(0, in_w + 2 * p - out_w + 1, size=batch_sz)
+
+        # a crop row is a contiguous run of out_w * in_c values, thus rows
+        # are gathered from a strided window view over the flattened rows
+        rows = inputs.reshape((batch_sz, inputs.shape[1], -1))
+        win_len = out_w * in_c
+        windows = as_strided(
+            rows, shape=(*rows.shape[:2], rows.shape[2] - win_len + 1, win_len),
+            strides=(*rows.strides, rows.strides[2]), writeable=False)
+        outputs = windows[np.arange(batch_sz)[:, None],
+                          top[:, None] + np.arange(out_h),
+                          left[:, None] * in_c]
+        return outputs.reshape((batch_sz, out_h, out_w, in_c)), targets
+
+
+class RandomTranslate(RandomCrop):
+    """
+    Shift each image by a random offset of at most `max_shift` pixels in
+    both directions and fill the uncovered area with zeros.
+    """
+    def __init__(self, max_shift):
+        super().__init__(size=None, padding=max_shift)
+
+
+class RandomFlip(Augmentation):
+    """Flip each image horizontally with probability `prob`."""
+
+    def __init__(self, prob=0.5):
+        self.prob = prob
+
+    def __call__(self, inputs, targets):
+        flip = np.random.uniform(size=len(inputs)) < self.prob
+        outputs = inputs.copy()
+        outputs[flip] = inputs[flip, :, ::-1]
+        return outputs, targets
+
+
+class Cutout(Augmentation):
+    """
+    Zero out a square of `size` pixels at a random center in each image.
+    The square is clipped at the image borders.
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, inputs, targets):
+        batch_sz, in_h, in_w, _ = inputs.shape
+        top = np.random.randint(0, in_h, size=batch_sz) - self.size // 2
+        left = np.random.randint(0, in_w, size=batch_sz) - self.size // 2
+        rows = np.arange(in_h) - top[:, None]
+        cols = np.arange(in_w) - left[:, None]
+        cut = (((rows >= 0) & (rows < self.size))[:, :, None] &
+               ((cols >= 0) & (cols < self.size))[:, None, :])
+        outputs = inputs.copy()
+        outputs[cut] = 0
+        return outputs, targets
+
+
+class Mixup(Augmentation):
+    """
+    Mix each sample with another random sample of the batch:
+    x = lam * x_i + (1 - lam) * x_j and the same for the targets, with
+    lam ~ Beta(alpha, alpha) drawn per sample.
+    :param num_classes: number of classes used to one-hot encode integer
+        targets. Mixed targets are always soft labels.
+    """
+    def __init__(self, alpha=1.0, num_classes=None):
+        self.alpha = alpha
+        self.num_classes = num_classes
+
+    def __call__(self, inputs, targets):
+        if targets.ndim == 1:
+            if self.num_classes is None:
+                raise ValueError("Mixup of integer targets requires "
+                                 "`num_classes`.")
+            targets = get_one_hot(targets, self.num_classes)
+        batch_sz = len(inputs)
+        lam = np.random.beta(self.alpha, self.alpha, size=batch_sz)
+        perm = np.random.permutation(batch_sz)
+
+        dtype = inputs.dtype if inputs.dtype.kind == "f" else np.float32
+        lam_x = lam.astype(dtype).reshape((-1, 1, 1, 1))
+        outputs = inputs * lam_x
+        outputs += inputs[perm] * (1 - lam_x)
+        lam_y = lam.astype(targets.dtype)[:, None]
+        mixed_targets = targets * lam_y
+        mixed_targets += targets[perm] * (1 - lam_y)
+        return outputs, mixed_targets
@@ -1,10 +1,23 @@
 """Data Iterator class."""
 
+import multiprocessing
+import threading
+import time
+import traceback
 from collections import namedtuple
 
 import numpy as np
 
-Batch = namedtuple("Batch", ["inputs", "targets"])
+
+class Batch(namedtuple("Batch", ["inputs", "targets"])):
+    """
+    A mini-batch which unpacks to (inputs, targets). `indices` are the
+    indices of the samples in the dataset (an array or a slice) if known.
+    """
+    def __new__(cls, inputs, targets, indices=None):
+        batch = super().__new__(cls, inputs, targets)
+        batch.indices = indices
+        return batch
 
 
 class BaseIterator:
@@ -14,21 +27,473 @@ class BaseIterator:
 
 
 class BatchIterator(BaseIterator):
-
-    def __init__(self, batch_size=32, shuffle=True):
+    """
+    Iterate over mini-batches of (inputs, targets).
+    Shuffling permutes an index array only and each batch is gathered on
+    demand, thus the dataset is never copied as a whole.
+    :param batch_size: number of samples in a batch
+    :param shuffle: shuffle the samples at the beginning of each epoch
+    :param drop_last: drop the last incomplete batch so that all batches
+        have the same shape
+    :param reuse_buffer: gather batches into preallocated arrays which are
+        reused across batches. A batch is overwritten by the next one, so
+        copy it if it needs to be kept.
+    :param batch_transform: function mapping (inputs, targets) of a batch
+        to new ones, e.g. ops in tinynn.utils.augmentation
+    :param sampler: a WeightedSampler to draw the samples of each epoch
+        from (with replacement) instead of shuffling
+    :param num_samples: number of samples drawn by the sampler in an epoch,
+        defaults to the size of the dataset
+    """
+    def __init__(self, batch_size=32, shuffle=True, drop_last=False,
+                 reuse_buffer=False, batch_transform=None, sampler=None,
+                 num_samples=None):
         self.batch_size = batch_size
         self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.reuse_buffer = reuse_buffer
+        self.batch_transform = batch_transform
+        self.sampler = sampler
+        self.num_samples = num_samples
+        self._buffers = {}
 
     def __call__(self, inputs, targets):
-        starts = np.arange(0, len(inputs), self.batch_size)
-        if self.shuffle:
-            idx = np.arange(len(inputs))
+        out = self._buffers if self.reuse_buffer else None
+        for batch_idx in self._batch_indices(len(inputs)):
+            yield self._make_batch(inputs, targets, batch_idx, out)
+
+    def _batch_indices(self, n_samples):
+        """Return the sample indices (an array or a slice) of each batch."""
+        if self.sampler is not None:
+            n_samples = self.num_samples or n_samples
+        n_batched = n_samples
+        if self.drop_last:
+            n_batched -= n_samples % self.batch_size
+        starts = range(0, n_batched, self.batch_size)
+        if not self.shuffle and self.sampler is None:
+            return [slice(start, min(start + self.batch_size, n_batched))
+                    for start in starts]
+
+        if self.sampler is not None:
+            idx = self.sampler.sample(n_samples)
+        else:
+            idx = np.arange(n_samples)
             np.random.shuffle(idx)
-            inputs = inputs[idx]
-            targets = targets[idx]
-
-        for start in starts:
-            end = start + self.batch_size
-            batch_inputs = inputs[start: end]
-            batch_targets = targets[start: end]
-            yield Batch(inputs=batch_inputs, targets=batch_targets)
+        return [idx[start: start + self.batch_size] for start in starts]
+
+    def _make_batch(self, inputs, targets, batch_idx, out=None):
+        """
+        Gather a batch. If `out` (a dict) is given, the batch is written to
+        the arrays in it, which are allocated on first use.
+        """
+        batch_inputs = self._gather(inputs, batch_idx, out, "inputs")
+        batch_targets = self._gather(targets, batch_idx, out, "targets")
+        if self.batch_transform is not None:
+            batch_inputs, batch_targets = self.batch_transform(
+                batch_inputs, batch_targets)
+        return Batch(inputs=batch_inputs, targets=batch_targets,
+                     indices=batch_idx)
+
+    def _gather(self, data, batch_idx, out, name):
+        if out is None:
+            return data[batch_idx]
+        shape = (self.batch_size, *data.shape[1:])
+        buf = out.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != data.dtype:
+            buf = np.empty(shape, dtype=data.dtype)
+            out[name] = buf
+        if isinstance(batch_idx, slice):
+            batch = data[batch_idx]
+            buf = buf[:len(batch)]
+            np.copyto(buf, batch)
+            return buf
+        # mode="clip" avoids the internal buffering of mode="raise"
+        return np.take(data, batch_idx, axis=0, out=buf[:len(batch_idx)],
+                       mode="clip")
+
+
+class StreamingIterator(BaseIterator):
+    """
+    Iterate over mini-batches of a ChunkedDataset that does not fit in
+    memory. Chunks are read one at a time in a random order and samples
+    are drawn at random from a shuffle buffer holding at most
+    `buffer_size` samples plus one chunk.
+    Without shuffling, batches are the same as BatchIterator(shuffle=False)
+    on the whole dataset. The dataset is passed as `inputs` (`targets` is
+    unused) so that it can be wrapped like other iterators, e.g.
+        PrefetchIterator(StreamingIterator(batch_size=128))(dataset)
+    :param batch_size: number of samples in a batch
+    :param shuffle: shuffle the chunk order and the samples in the buffer
+    :param buffer_size: number of samples kept for shuffling
+    :param drop_last: drop the last incomplete batch
+    """
+    def __init__(self, batch_size=32, shuffle=True, buffer_size=10000,
+                 drop_last=False):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.drop_last = drop_last
+
+    def __call__(self, inputs, targets=None):
+        dataset = inputs
+        order = np.arange(dataset.num_chunks)
+        if self.shuffle:
+            np.random.shuffle(order)
+        chunks = (dataset.read_chunk(i) for i in order)
+        if self.shuffle:
+            batches = self._shuffled_batches(chunks)
+        else:
+            batches = self._sequential_batches(chunks)
+
+        for inputs, targets in batches:
+            if self.drop_last and len(inputs) < self.batch_size:
+                return
+            yield Batch(inputs=inputs, targets=targets)
+
+    def _sequential_batches(self, chunks):
+        rest_x, rest_y = None, None
+        for inputs, targets in chunks:
+            if rest_x is not None:
+                inputs = np.concatenate([rest_x, inputs])
+                targets = np.concatenate([rest_y, targets])
+            n_full = len(inputs) - len(inputs) % self.batch_size
+            for start in range(0, n_full, self.batch_size):
+                end = start + self.batch_size
+                yield inputs[start: end], targets[start: end]
+            rest_x, rest_y = inputs[n_full:], targets[n_full:]
+        if rest_x is not None and len(rest_x):
+            yield rest_x, rest_y
+
+    def _shuffled_batches(self, chunks):
+        buf_x, buf_y, n = None, None, 0
+        for inputs, targets in chunks:
+            if buf_x is None:
+                capacity = self.buffer_size + self.batch_size + len(inputs)
+                buf_x = np.empty((capacity, *inputs.shape[1:]), inputs.dtype)
+                buf_y = np.empty((capacity, *targets.shape[1:]), targets.dtype)
+            if n + len(inputs) > len(buf_x):
+                capacity = n + len(inputs)
+                buf_x = np.concatenate([buf_x[:n], np.empty(
+                    (capacity - n, *inputs.shape[1:]), inputs.dtype)])
+                buf_y = np.concatenate([buf_y[:n], np.empty(
+                    (capacity - n, *targets.shape[1:]), targets.dtype)])
+            buf_x[n: n + len(inputs)] = inputs
+            buf_y[n: n + len(targets)] = targets
+            n += len(inputs)
+
+            while n >= self.buffer_size + self.batch_size:
+                idx = np.random.choice(n, self.batch_size, replace=False)
+                yield buf_x[idx], buf_y[idx]
+                # fill the holes with the samples at the tail
+                n -= self.batch_size
+                tail = np.ones(self.batch_size, dtype=bool)
+                tail[idx[idx >= n] - n] = False
+                holes = idx[idx < n]
+                buf_x[holes] = buf_x[n:][:self.batch_size][tail]
+                buf_y[holes] = buf_y[n:][:self.batch_size][tail]
+
+        # drain the buffer
+        idx = np.random.permutation(n)
+        for start in range(0, n, self.batch_size):
+            batch_idx = idx[start: start + self.batch_size]
+            yield buf_x[batch_idx], buf_y[batch_idx]
+
+
+class PrefetchIterator(BaseIterator):
+    """
+    Prepare batches of the wrapped iterator in background threads so that
+    data loading overlaps with training. NumPy gathers release the GIL, thus
+    threads are enough to hide most of the loading time.
+    Batches of a BatchIterator are gathered by `num_threads` threads into a
+    ring of preallocated buffers, and yielded in the original order. Other
+    iterators are consumed by a single thread, except MultiprocessIterator
+    which already prepares batches ahead in its workers and is iterated
+    directly.
+    :param iterator: the wrapped BaseIterator
+    :param buffer_size: max number of batches prepared ahead
+    :param num_threads: number of threads gathering BatchIterator batches
+    A yielded batch is only valid until the next one is requested. The
+    time (in seconds) the consumer spent waiting for batches in the last
+    call is kept in `wait_time`.
+    """
+    def __init__(self, iterator, buffer_size=2, num_threads=1):
+        self.iterator = iterator
+        self.buffer_size = buffer_size
+        self.num_threads = num_threads
+        self.wait_time = 0.0
+        self._ring = []
+
+    def __call__(self, inputs, targets=None):
+        self.wait_time = 0.0
+        # one extra slot is held by the consumer
+        n_slots = self.buffer_size + 1
+        if len(self._ring) != n_slots:
+            self._ring = [{} for _ in range(n_slots)]
+
+        if isinstance(self.iterator, MultiprocessIterator):
+            # its batches are views of slots reused by the next batches,
+            # thus they can not be read ahead
+            batches = self.iterator(inputs, targets)
+            while True:
+                t_start = time.time()
+                batch = next(batches, None)
+                self.wait_time += time.time() - t_start
+                if batch is None:
+                    return
+                yield batch
+
+        if isinstance(self.iterator, BatchIterator):
+            # sample indices are drawn in the caller thread to keep the
+            # random state deterministic
+            tasks = self.iterator._batch_indices(len(inputs))
+            n_batches = len(tasks)
+            n_threads = self.num_threads
+
+            def make_batch(seq):
+                return self.iterator._make_batch(
+                    inputs, targets, tasks[seq], self._ring[seq % n_slots])
+        else:
+            batches = self.iterator(inputs, targets)
+            n_batches = None
+            n_threads = 1
+
+            def make_batch(seq):
+                return next(batches, None)
+
+        state = {"next": 0, "ready": {}, "error": None, "stop": False}
+        free = threading.Semaphore(n_slots)
+        lock = threading.Lock()
+        cond = threading.Condition()
+
+        def produce():
+            while True:
+                free.acquire()
+                with lock:
+                    seq = state["next"]
+                    state["next"] += 1
+                if state["stop"] or (n_batches is not None and
+                                     seq >= n_batches):
+                    free.release()
+                    return
+                try:
+                    batch = make_batch(seq)
+                except Exception as e:
+                    batch, state["error"] = None, e
+                with cond:
+                    state["ready"][seq] = batch
+                    cond.notify_all()
+                if batch is None:
+                    return
+
+        threads = [threading.Thread(target=produce, daemon=True)
+                   for _ in range(n_threads)]
+        for thread in threads:
+            thread.start()
+
+        seq = 0
+        try:
+            while n_batches is None or seq < n_batches:
+                t_start = time.time()
+                with cond:
+                    while seq not in state["ready"]:
+                        cond.wait()
+                    batch = state["ready"].pop(seq)
+                self.wait_time += time.time() - t_start
+                if batch is None:
+                    if state["error"] is not None:
+                        raise state["error"]
+                    break
+                yield batch
+                # the consumed slot can be filled again
+                free.release()
+                seq += 1
+        finally:
+            state["stop"] = True
+            for _ in threads:
+                free.release()
+            # the ring may be reused by the next call
+            for thread in threads:
+                thread.join()
+
+
+class MultiprocessIterator(BatchIterator):
+    """
+    Iterate over mini-batches with a per-sample transform (e.g. decoding or
+    augmentation) running in `num_workers` processes, which is useful when
+    the transform holds the GIL. Workers write batches to a ring of shared
+    memory slots and batches are yielded as zero-copy views of the slots in
+    the original order.
+    :param transform: function mapping a sample (x, y) to a new (x, y)
+        with fixed shapes. It may use np.random, which is seeded for each
+        batch, thus batches are the same for any number of workers.
+    :param num_workers: number of worker processes, 0 to run in-process
+    :param buffer_size: number of batches prepared ahead, defaults to
+        twice the number of workers
+    A yielded batch is only valid until the next one is requested. Call
+    `close` to release the shared memory.
+    """
+    def __init__(self, batch_size=32, shuffle=True, drop_last=False,
+                 transform=None, num_workers=2, buffer_size=None):
+        super().__init__(batch_size, shuffle, drop_last)
+        self.transform = transform
+        self.num_workers = num_workers
+        self.buffer_size = buffer_size or 2 * max(num_workers, 1)
+        self._shms = []
+        self._ring = []
+        self._layout = None
+
+    def __call__(self, inputs, targets):
+        tasks = self._batch_indices(len(inputs))
+        base_seed = np.random.randint(2 ** 31)
+        layout = self._sample_layout(inputs, targets)
+        self._setup_ring(layout)
+
+        if self.num_workers == 0:
+            for seq, batch_idx in enumerate(tasks):
+                slot = seq % len(self._ring)
+                n = _fill_slot(inputs, targets, self.transform, batch_idx,
+                               base_seed + seq, self._ring[slot])
+                yield Batch(*[buf[:n] for buf in self._ring[slot]],
+                            indices=tasks[seq])
+            return
+
+        ctx = multiprocessing.get_context()
+        task_queue, done_queue = ctx.Queue(), ctx.Queue()
+        workers = [ctx.Process(
+            target=_worker_loop, daemon=True,
+            args=(inputs, targets, self.transform,
+                  [shm.name for shm in self._shms], layout,
+                  task_queue, done_queue))
+            for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+
+        def submit(seq):
+            if seq < len(tasks):
+                task_queue.put((seq, seq % len(self._ring), tasks[seq],
+                                base_seed + seq))
+
+        try:
+            for seq in range(len(self._ring)):
+                submit(seq)
+            done = {}
+            for seq in range(len(tasks)):
+                while seq not in done:
+                    done_seq, n, error = done_queue.get()
+                    if error is not None:
+                        raise RuntimeError("Error in data worker:\n" + error)
+                    done[done_seq] = n
+                n = done.pop(seq)
+                slot = seq % len(self._ring)
+                yield Batch(*[buf[:n] for buf in self._ring[slot]],
+                            indices=tasks[seq])
+                # the consumed slot can be filled again
+                submit(seq + len(self._ring))
+        finally:
+            for _ in workers:
+                task_queue.put(None)
+            for worker in workers:
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    worker.terminate()
+
+    def close(self):
+        """Release the shared memory of the batch ring."""
+        self._ring = []
+        for shm in self._shms:
+            try:
+                shm.close()
+            except BufferError:
+                # batches still in use, the memory goes away with them
+                pass
+            shm.unlink()
+        self._shms = []
+
+    def _sample_layout(self, inputs, targets):
+        """Shapes and dtypes of a batch, probed on the first sample."""
+        x, y = inputs[0], targets[0]
+        if self.transform is not None:
+            # probe without touching the random state
+            rng_state = np.random.get_state()
+            x, y = self.transform(x, y)
+            np.random.set_state(rng_state)
+        x, y = np.asarray(x), np.asarray(y)
+        return tuple(((self.batch_size, *a.shape), a.dtype.str)
+                     for a in (x, y))
+
+    def _setup_ring(self, layout):
+        n_slots = self.buffer_size + 1
+        if self._ring and self._layout == (layout, n_slots):
+            return
+        self.close()
+        self._layout = (layout, n_slots)
+        # shared_memory requires Python 3.8
+        from multiprocessing import shared_memory
+        for _ in range(n_slots):
+            shm = shared_memory.SharedMemory(
+                create=True, size=max(_layout_nbytes(layout), 1))
+            self._shms.append(shm)
+            self._ring.append(_slot_views(shm.buf, layout))
+
+    def __del__(self):
+        self.close()
+
+
+def _layout_nbytes(layout):
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize
+               for shape, dtype in layout)
+
+
+def _slot_views(buf, layout):
+    views, offset = [], 0
+    for shape, dtype in layout:
+        view = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+        views.append(view)
+        offset += view.nbytes
+    return views
+
+
+def _fill_slot(inputs, targets, transform, batch_idx, seed, views):
+    """Transform the samples of a batch into the slot and return the size."""
+    if isinstance(batch_idx, slice):
+        batch_idx = range(*batch_idx.indices(len(inputs)))
+    if transform is None:
+        views[0][:len(batch_idx)] = inputs[batch_idx]
+        views[1][:len(batch_idx)] = targets[batch_idx]
+        return len(batch_idx)
+
+    # the transform is seeded per batch, and the random state of the
+    # caller (the training process if there are no workers) is kept
+    rng_state = np.random.get_state()
+    np.random.seed(seed % 2 ** 32)
+    try:
+        for i, sample_idx in enumerate(batch_idx):
+            x, y = transform(inputs[sample_idx], targets[sample_idx])
+            views[0][i] = x
+            views[1][i] = y
+    finally:
+        np.random.set_state(rng_state)
+    return len(batch_idx)
+
+
+def _worker_loop(inputs, targets, transform, shm_names, layout,
+                 task_queue, done_queue):
+    from multiprocessing import shared_memory
+    shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+    ring = [_slot_views(shm.buf, layout) for shm in shms]
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            seq, slot, batch_idx, seed = task
+            try:
+                n = _fill_slot(inputs, targets, transform, batch_idx, seed,
+                               ring[slot])
+                done_queue.put((seq, n, None))
+            except Exception:
+                done_queue.put((seq, 0, traceback.format_exc()))
+    finally:
+        del ring
+        for shm in shms:
+            shm.close()
@@ -1,6 +1,7 @@
 """Common datasets"""
 
 import gzip
+import json
 import os
 import pickle
 import sys
@@ -9,11 +10,136 @@ import tarfile
 
 import numpy as np
 
-from tinynn.utils.downloader import download_url
+from tinynn.utils.downloader import download_urls
+
+CIFAR10_MEAN = (0.4914, 0.4822, 0.4465)
+CIFAR10_STD = (0.2023, 0.1994, 0.2010)
 
 
 def get_one_hot(targets, nb_classes):
-    return np.eye(nb_classes)[np.array(targets).reshape(-1)]
+    targets = np.asarray(targets).reshape(-1)
+    one_hot = np.zeros((len(targets), nb_classes))
+    one_hot[np.arange(len(targets)), targets] = 1.0
+    return one_hot
+
+
+def normalize_images(images, scale=1.0, mean=None, std=None,
+                     dtype=np.float32):
+    """
+    Convert images to `dtype` and compute (images * scale - mean) / std,
+    where mean and std are per channel (the innermost axis of the images,
+    also for flattened HWC images).
+    """
+    outputs = images.astype(dtype)
+    if mean is None:
+        outputs *= scale
+        return outputs
+    std = np.ones(len(mean)) if std is None else np.asarray(std)
+    channels = outputs.reshape((-1, len(mean)))
+    channels *= (scale / std).astype(dtype)
+    channels -= (np.asarray(mean) / std).astype(dtype)
+    return outputs
+
+
+def load_cached(cache_dir, names, build_fn):
+    """
+    Load arrays from a .npy cache as read-only memory maps, so that loading
+    is almost free and processes share the same pages of the page cache.
+    The cache is built on first use.
+    :param cache_dir: directory of the cache files
+    :param names: names of the arrays
+    :param build_fn: function returning a dict of the arrays
+    :return: dict of memory-mapped arrays
+    """
+    paths = {name: os.path.join(cache_dir, name + ".npy") for name in names}
+    if not all(os.path.isfile(path) for path in paths.values()):
+        arrays = build_fn()
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, path in paths.items():
+            # write then rename so that a concurrent process never loads
+            # a partially written file
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(arrays[name]))
+            os.replace(tmp_path, path)
+    return {name: np.load(path, mmap_mode="r") for name, path in paths.items()}
+
+
+class ChunkedDataset:
+    """
+    Read-only dataset stored on disk as chunks of .npy files:
+        <path>/index.json
+        <path>/inputs-00000.npy, <path>/targets-00000.npy, ...
+    Chunks are read as a whole, so datasets larger than the memory are
+    streamed with large sequential reads (see StreamingIterator).
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)
+        self.chunk_sizes = self.index["chunk_sizes"]
+
+    def __len__(self):
+        return sum(self.chunk_sizes)
+
+    @property
+    def num_chunks(self):
+        return len(self.chunk_sizes)
+
+    def read_chunk(self, i):
+        """Return (inputs, targets) of the i-th chunk."""
+        return tuple(np.load(os.path.join(self.path, "%s-%05d.npy" % (name, i)))
+                     for name in ("inputs", "targets"))
+
+
+class ChunkedDatasetWriter:
+    """
+    Write samples to a ChunkedDataset incrementally, so that the dataset
+    never needs to be held in memory as a whole.
+        with ChunkedDatasetWriter(path, chunk_size=10000) as writer:
+            for inputs, targets in source:
+                writer.write(inputs, targets)
+    """
+    def __init__(self, path, chunk_size=10000):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunk_sizes = []
+        self._pending = []
+        self._num_pending = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, inputs, targets):
+        self._pending.append((inputs, targets))
+        self._num_pending += len(inputs)
+        if self._num_pending >= self.chunk_size:
+            inputs = np.concatenate([x for x, _ in self._pending])
+            targets = np.concatenate([y for _, y in self._pending])
+            n_full = len(inputs) - len(inputs) % self.chunk_size
+            for start in range(0, n_full, self.chunk_size):
+                end = start + self.chunk_size
+                self._write_chunk(inputs[start: end], targets[start: end])
+            self._pending = [(inputs[n_full:], targets[n_full:])]
+            self._num_pending = len(inputs) - n_full
+
+    def close(self):
+        if self._num_pending:
+            self._write_chunk(np.concatenate([x for x, _ in self._pending]),
+                              np.concatenate([y for _, y in self._pending]))
+        self._pending, self._num_pending = [], 0
+        with open(os.path.join(self.path, "index.json"), "w") as f:
+            json.dump({"chunk_sizes": self.chunk_sizes}, f)
+
+    def _write_chunk(self, inputs, targets):
+        i = len(self.chunk_sizes)
+        for name, arr in (("inputs", inputs), ("targets", targets)):
+            np.save(os.path.join(self.path, "%s-%05d.npy" % (name, i)), arr)
+        self.chunk_sizes.append(len(inputs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 def mnist(data_dir, one_hot=False):
@@ -24,21 +150,27 @@ def mnist(data_dir, one_hot=False):
     test_set size: (10000, 784), (10000,)
     feature: numerical in range [0, 1]
     target: categorical from 0 to 9
+    Arrays are read-only memory maps of the cache in `data_dir`.
     """
     url = "http://deeplearning.net/data/mnist/mnist.pkl.gz"
     checksum = "a02cd19f81d51c426d7ca14024243ce9"
 
     save_path = os.path.join(data_dir, url.split("/")[-1])
     print("Preparing MNIST dataset ...")
-    try:
-        download_url(url, save_path, checksum)
-    except Exception as e:
-        print("Error downloading dataset: %s" % str(e))
-        sys.exit(1)
 
-    # load the dataset
-    with gzip.open(save_path, "rb") as f:
-        train_set, valid_set, test_set = pickle.load(f, encoding="latin1")
+    def build():
+        download([url], [save_path], [checksum])
+        with gzip.open(save_path, "rb") as f:
+            splits = pickle.load(f, encoding="latin1")
+        return {"%s_%s" % (split, name): arr
+                for split, data in zip(("train", "valid", "test"), splits)
+                for name, arr in zip(("x", "y"), data)}
+
+    names = ["train_x", "train_y", "valid_x", "valid_y", "test_x", "test_y"]
+    data = load_cached(os.path.join(data_dir, "mnist-cache"), names, build)
+    train_set = (data["train_x"], data["train_y"])
+    valid_set = (data["valid_x"], data["valid_y"])
+    test_set = (data["test_x"], data["test_y"])
 
     if one_hot:
         train_set = (train_set[0], get_one_hot(train_set[1], 10))
@@ -48,19 +180,23 @@ def mnist(data_dir, one_hot=False):
     return train_set, valid_set, test_set
 
 
-def fashion_mnist(data_dir, one_hot=False):
+def fashion_mnist(data_dir, one_hot=False, normalize=True):
     """
-    return: train_set, test_set
+    return: train_set, valid_set, test_set
     train_set size: (60000, 784), (60000,)
     test_set size: (10000, 784), (10000,)
-    feature: numerical in range [0, 1]
+    feature: float32 in range [0, 1], or read-only uint8 memory maps of
+        the cache in range [0, 255] if normalize is False. uint8 images can
+        be normalized per batch with
+        BatchIterator(batch_transform=Normalize(scale=1 / 255.0)).
     target: categorical from 0 to 9
+    valid_set is None.
     """
     def read_idx(filename):
         with gzip.open(filename, "rb") as f:
             zero, data_type, dims = struct.unpack(">HBB", f.read(4))
             shape = tuple(struct.unpack(">I", f.read(4))[0] for d in range(dims))
-            return np.fromstring(f.read(), dtype=np.uint8).reshape(shape)
+            return np.frombuffer(f.read(), dtype=np.uint8).reshape(shape)
 
     urls = ["http://fashion-mnist.s3-website.eu-central-1.amazonaws.com/train-images-idx3-ubyte.gz",
             "http://fashion-mnist.s3-website.eu-central-1.amazonaws.com/train-labels-idx1-ubyte.gz",
@@ -73,23 +209,23 @@ def fashion_mnist(data_dir, one_hot=False):
     save_paths = [os.path.join(data_dir, url.split("/")[-1]) for url in urls]
 
     print("Preparing Fashion-MNIST dataset...")
-    for url, checksum, save_path in zip(urls, checksums, save_paths):
-        try:
-            download_url(url, save_path, checksum)
-        except Exception as e:
-            print("Error downloading dataset: %s" % str(e))
-            sys.exit(1)
-
-    dataset = []
-    for path in save_paths:
-        dataset.append(read_idx(path))
-    train_x, train_y, test_x, test_y = dataset
-    # normalize
-    train_x = train_x.astype(float) / 255.0
-    test_x = test_x.astype(float) / 255.0
-    # reshape
-    train_x = train_x.reshape((len(train_x), -1))
-    test_x = test_x.reshape((len(test_x), -1))
+
+    def build():
+        # the archives are downloaded concurrently
+        download(urls, save_paths, checksums)
+        train_x, train_y, test_x, test_y = [read_idx(p) for p in save_paths]
+        return {"train_x": train_x.reshape((len(train_x), -1)),
+                "train_y": train_y.astype(np.int64),
+                "test_x": test_x.reshape((len(test_x), -1)),
+                "test_y": test_y.astype(np.int64)}
+
+    data = load_cached(os.path.join(data_dir, "fashion-mnist-cache"),
+                       ["train_x", "train_y", "test_x", "test_y"], build)
+    train_x, train_y = data["train_x"], data["train_y"]
+    test_x, test_y = data["test_x"], data["test_y"]
+    if normalize:
+        train_x = normalize_images(train_x, scale=1 / 255.0)
+        test_x = normalize_images(test_x, scale=1 / 255.0)
     # one hot if need
     if one_hot:
         train_y = get_one_hot(train_y, 10)
@@ -97,56 +233,45 @@ def fashion_mnist(data_dir, one_hot=False):
     return (train_x, train_y), None, (test_x, test_y)
 
 
-def cifar10(data_dir, one_hot=False):
+def cifar10(data_dir, one_hot=False, normalize=True, channels_last=False):
+    """
+    return: train_set, test_set
+    train_set size: (50000, 3072), (50000,)
+    test_set size: (10000, 3072), (10000,)
+    feature: flattened 3x32x32 (CHW) images, or 32x32x3 (HWC) images if
+        channels_last is True, as float32 normalized by CIFAR10_MEAN and
+        CIFAR10_STD, or as uint8 in range [0, 255] if normalize is False.
+        With normalize=False and channels_last=True, the features are
+        read-only memory maps of the cache, which can be normalized per
+        batch with BatchIterator(batch_transform=Normalize(
+            scale=1 / 255.0, mean=CIFAR10_MEAN, std=CIFAR10_STD))
+    target: categorical from 0 to 9
+    """
     url = "https://www.cs.toronto.edu/~kriz/cifar-10-python.tar.gz"
     checksum = "c58f30108f718f92721af3b95e74349a"
 
     save_path = os.path.join(data_dir, url.split("/")[-1])
     print("Preparing CIFAR-10 dataset...")
-    try:
-        download_url(url, save_path, checksum)
-    except Exception as e:
-        print("Error downloading dataset: %s" % str(e))
-        sys.exit(1)
 
-    # load the dataset
-    dataset = {}
-    with open(save_path, "rb") as f:
-        tar = tarfile.open(fileobj=f)
-        for item in tar:
-            obj = tar.extractfile(item)
-            if not obj or item.size < 100:
-                continue
-            cont = pickle.load(obj, encoding="bytes")
-            dataset[item.name.split("/")[-1]] = cont
-
-    data_batch_name = ["data_batch_%d" % i for i in range(1, 6)]
-    train_x, train_y = [], []
-    for name in data_batch_name:
-        cont = dataset[name]
-        train_x.append(cont[b'data'])
-        train_y.extend(cont[b'labels'])
-    train_x = np.concatenate(train_x, axis=0)
-
-    # normalize
-    means, stds = (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
-    train_x = train_x / 255.0
-    train_x = train_x.reshape((-1, 1024, 3))
-    for c in range(3):
-        train_x[:, :, c] = (train_x[:, :, c] - means[c]) / stds[c]
-    train_x = train_x.reshape(-1, 3072)
-
-    train_y = np.asarray(train_y)
-    train_set = (train_x, train_y)
-
-    test_x = dataset["test_batch"][b"data"]
-    test_x = test_x / 255.0
-    test_x = test_x.reshape((-1, 1024, 3))
-    for c in range(3):
-        test_x[:, :, c] = (test_x[:, :, c] - means[c]) / stds[c]
-    test_x = test_x.reshape(-1, 3072)
-    test_y = np.asarray(dataset["test_batch"][b"labels"])
-    test_set = (test_x, test_y)
+    def build():
+        download([url], [save_path], [checksum])
+        dataset = read_tar_pickles(save_path)
+        data_batch_name = ["data_batch_%d" % i for i in range(1, 6)]
+        return {
+            "train_x": chw_to_hwc(np.concatenate(
+                [dataset[name][b"data"] for name in data_batch_name])),
+            "train_y": np.concatenate(
+                [dataset[name][b"labels"] for name in data_batch_name]),
+            "test_x": chw_to_hwc(dataset["test_batch"][b"data"]),
+            "test_y": np.asarray(dataset["test_batch"][b"labels"])}
+
+    # uint8 pixels and labels are cached
+    data = load_cached(os.path.join(data_dir, "cifar10-cache"),
+                       ["train_x", "train_y", "test_x", "test_y"], build)
+    train_set = (_cifar_features(data["train_x"], normalize, channels_last,
+                                 CIFAR10_MEAN, CIFAR10_STD), data["train_y"])
+    test_set = (_cifar_features(data["test_x"], normalize, channels_last,
+                                CIFAR10_MEAN, CIFAR10_STD), data["test_y"])
 
     if one_hot:
         train_set = (train_set[0], get_one_hot(train_set[1], 10))
@@ -154,21 +279,79 @@ def cifar10(data_dir, one_hot=False):
     return train_set, test_set
 
 
-def cifar100(data_dir, one_hot=False):
+def cifar100(data_dir, one_hot=False, normalize=True, channels_last=False):
+    """
+    return: train_set, test_set
+    train_set size: (50000, 3072), (50000,)
+    test_set size: (10000, 3072), (10000,)
+    feature: flattened 3x32x32 (CHW) images, or 32x32x3 (HWC) images if
+        channels_last is True, as float32 in range [0, 1], or as uint8 in
+        range [0, 255] if normalize is False. With normalize=False and
+        channels_last=True, the features are read-only memory maps of the
+        cache.
+    target: categorical from 0 to 99
+    """
     url = "https://www.cs.toronto.edu/~kriz/cifar-100-python.tar.gz"
     checksum = "eb9058c3a382ffc7106e4002c42a8d85"
 
     save_path = os.path.join(data_dir, url.split("/")[-1])
     print("Preparing CIFAR-100 dataset...")
+
+    def build():
+        download([url], [save_path], [checksum])
+        dataset = read_tar_pickles(save_path)
+        return {"train_x": chw_to_hwc(dataset["train"][b"data"]),
+                "train_y": np.asarray(dataset["train"][b"fine_labels"]),
+                "test_x": chw_to_hwc(dataset["test"][b"data"]),
+                "test_y": np.asarray(dataset["test"][b"fine_labels"])}
+
+    # uint8 pixels and labels are cached
+    data = load_cached(os.path.join(data_dir, "cifar100-cache"),
+                       ["train_x", "train_y", "test_x", "test_y"], build)
+    train_set = (_cifar_features(data["train_x"], normalize, channels_last),
+                 data["train_y"])
+    test_set = (_cifar_features(data["test_x"], normalize, channels_last),
+                data["test_y"])
+
+    if one_hot:
+        train_set = (train_set[0], get_one_hot(train_set[1], 100))
+        test_set = (test_set[0], get_one_hot(test_set[1], 100))
+    return train_set, test_set
+
+
+def download(urls, save_paths, checksums):
     try:
-        download_url(url, save_path, checksum)
+        download_urls(urls, save_paths, checksums)
     except Exception as e:
         print("Error downloading dataset: %s" % str(e))
         sys.exit(1)
 
-    # load the dataset
+
+def chw_to_hwc(images, channels=3):
+    """Reorder flattened CHW images (as stored in CIFAR) to flattened HWC."""
+    n = len(images)
+    return images.reshape((n, channels, -1)).transpose((0, 2, 1)).reshape((n, -1))
+
+
+def hwc_to_chw(images, channels=3):
+    """Reorder flattened HWC images to flattened CHW."""
+    n = len(images)
+    return images.reshape((n, -1, channels)).transpose((0, 2, 1)).reshape((n, -1))
+
+
+def _cifar_features(images, normalize, channels_last, mean=None, std=None):
+    # the cache holds uint8 HWC images
+    if normalize:
+        images = normalize_images(images, 1 / 255.0, mean, std)
+    if not channels_last:
+        images = hwc_to_chw(images)
+    return images
+
+
+def read_tar_pickles(path):
+    """Unpickle all the files in a tar archive into a dict by file name."""
     dataset = {}
-    with open(save_path, "rb") as f:
+    with open(path, "rb") as f:
         tar = tarfile.open(fileobj=f)
         for item in tar:
             obj = tar.extractfile(item)
@@ -176,18 +359,4 @@ def cifar100(data_dir, one_hot=False):
                 continue
             cont = pickle.load(obj, encoding="bytes")
             dataset[item.name.split("/")[-1]] = cont
-
-    train_x = dataset["train"][b"data"]
-    train_x = train_x / 255.0
-    train_y = np.asarray(dataset["train"][b"fine_labels"])
-    train_set = (train_x, train_y)
-
-    test_x = dataset["test"][b"data"]
-    test_x = test_x / 255.0
-    test_y = np.asarray(dataset["test"][b"fine_labels"])
-    test_set = (test_x, test_y)
-
-    if one_hot:
-        train_set = (train_set[0], get_one_hot(train_set[1], 10))
-        test_set = (test_set[0], get_one_hot(test_set[1], 10))
-    return train_set, test_set
+    return dataset
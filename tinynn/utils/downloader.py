@@ -1,40 +1,175 @@
 """Simple utilities to download and save a file with progress bar."""
 
 import hashlib
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
 from urllib.error import URLError
-from urllib.request import urlretrieve
+from urllib.request import Request
+from urllib.request import urlopen
 
+CHUNK_SIZE = 1 << 20
 
-def show_progress(blk_num, blk_sz, tot_sz):
-    percentage = 100. * blk_num * blk_sz / tot_sz
-    print("Progress: %.1f %%" % percentage, end="\r", flush=True)
 
+def show_progress(downloaded, tot_sz):
+    if tot_sz:
+        percentage = 100. * downloaded / tot_sz
+        print("Progress: %.1f %%" % percentage, end="\r", flush=True)
 
-def md5_checksum(file_path):
-    with open(file_path, "rb") as f:
-        checksum = hashlib.md5(f.read()).hexdigest()
-    return checksum
+
+def md5_checksum(file_path, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    _hash_file(md5, file_path, chunk_size)
+    return md5.hexdigest()
 
 
-def download_url(url, file_path, checksum):
+def download_url(url, file_path, checksum, progress=True):
+    """
+    Download `url` to `file_path` and verify its md5 checksum.
+    Data goes to `file_path + ".part"` first and is hashed while being
+    written. If the partial file exists (e.g. an interrupted download),
+    the download resumes from its end with an HTTP range request.
+    """
     # create directory if needed
     file_dir = os.path.dirname(file_path)
-    if not os.path.exists(file_dir):
-        os.makedirs(file_dir)
+    if file_dir and not os.path.exists(file_dir):
+        os.makedirs(file_dir, exist_ok=True)
 
     if os.path.exists(file_path):
+        # skip rehashing if the file is unchanged since it was verified
+        if is_verified(file_path, checksum):
+            print("{} already exists.".format(file_path))
+            return
         # check md5
         if md5_checksum(file_path) == checksum:
+            mark_verified(file_path, checksum)
             print("{} already exists.".format(file_path))
-            return 
+            return
         else:
             print("Wrong checksum!")
+            os.remove(file_path)
 
+    part_path = file_path + ".part"
     try:
         print("Downloading {} to {}".format(url, file_path))
-        urlretrieve(url, file_path, show_progress)
+        md5 = _download(url, part_path, progress)
     except URLError:
         raise RuntimeError("Error downloading resource!")
     except KeyboardInterrupt:
+        # the partial file is kept to resume later
         print("Interrupted")
+        raise
+
+    if md5.hexdigest() != checksum:
+        os.remove(part_path)
+        raise RuntimeError("Wrong checksum of {}!".format(url))
+    os.replace(part_path, file_path)
+    mark_verified(file_path, checksum)
+
+
+def is_verified(file_path, checksum, check_inode=True):
+    """
+    Whether the file has been verified to match `checksum` and has not
+    changed since then, according to its verification record (a sidecar
+    file keyed on the path, size, mtime and optionally the inode).
+    """
+    try:
+        with open(_record_path(file_path)) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return False
+    expect = _file_key(file_path, checksum)
+    if not check_inode:
+        record.pop("inode", None)
+        expect.pop("inode")
+    return record == expect
+
+
+def mark_verified(file_path, checksum):
+    """
+    Write the verification record of a file that matches `checksum`.
+    The record is written to a temporary file and renamed, so processes
+    verifying the same file at the same time never see a partial record.
+    """
+    record_path = _record_path(file_path)
+    tmp_path = "%s.%d.%d.tmp" % (record_path, os.getpid(),
+                                 threading.get_ident())
+    with open(tmp_path, "w") as f:
+        json.dump(_file_key(file_path, checksum), f)
+    os.replace(tmp_path, record_path)
+
+
+def _record_path(file_path):
+    return file_path + ".md5.json"
+
+
+def _file_key(file_path, checksum):
+    stat = os.stat(file_path)
+    return {"path": os.path.abspath(file_path), "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino,
+            "md5": checksum}
+
+
+def download_urls(urls, file_paths, checksums, max_workers=4):
+    """Download several files concurrently with at most `max_workers`."""
+    # progress bars of concurrent downloads would overwrite each other
+    progress = len(urls) == 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(download_url, url, path, checksum,
+                                   progress=progress)
+                   for url, path, checksum in zip(urls, file_paths, checksums)]
+        # raise the first error if any
+        for future in futures:
+            future.result()
+
+
+def _download(url, part_path, progress):
+    md5 = hashlib.md5()
+    offset = 0
+    if os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+        # the received part is hashed once, the rest while downloading
+        _hash_file(md5, part_path, CHUNK_SIZE)
+
+    request = Request(url)
+    if offset:
+        request.add_header("Range", "bytes=%d-" % offset)
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if e.code == 416 and offset:
+            # nothing left to download
+            return md5
+        raise
+
+    with response:
+        if offset and response.status != 206:
+            # the server does not support range requests, start over
+            offset, md5 = 0, hashlib.md5()
+        length = response.headers.get("Content-Length")
+        tot_sz = offset + int(length) if length is not None else None
+
+        with open(part_path, "ab" if offset else "wb") as f:
+            downloaded = offset
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                md5.update(chunk)
+                downloaded += len(chunk)
+                if progress:
+                    show_progress(downloaded, tot_sz)
+    if tot_sz is not None and downloaded < tot_sz:
+        # keep the partial file to resume next time
+        raise RuntimeError("Connection closed after %d of %d bytes of %s" % (
+            downloaded, tot_sz, url))
+    return md5
+
+
+def _hash_file(md5, file_path, chunk_size):
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
@@ -4,6 +4,12 @@ import numpy as np
 
 
 def accuracy(predictions, targets):
+    """
+    predictions and targets are class indices. 2D scores or one-hot
+    arrays are also accepted and converted to indices by argmax.
+    """
+    predictions = _to_index(predictions)
+    targets = _to_index(targets)
     total_num = len(predictions)
     hit_num = int(np.sum(predictions == targets))
     return {"total_num": total_num,
@@ -107,3 +113,10 @@ def mean_absolute_error(predictions, targets):
     else:
         raise ValueError("predictions supposes to have 1 or 2 dim.")
     return {"mae": mae}
+
+
+def _to_index(labels):
+    labels = np.asarray(labels)
+    if labels.ndim == 2 and labels.shape[1] > 1:
+        return np.argmax(labels, axis=1)
+    return labels.reshape(-1)
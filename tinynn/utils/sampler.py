@@ -0,0 +1,177 @@
+"""Weighted sampling of dataset indices with Walker's alias method."""
+
+import numpy as np
+
+
+class WeightedSampler:
+    """
+    Draw sample indices with probability proportional to `weights`, e.g.
+    to balance classes or to sample by importance. Pass it to BatchIterator
+    as `sampler` to draw each epoch from it (with replacement).
+
+    Draws cost O(1) each with Walker's alias method. The indices are split
+    into blocks of about sqrt(N) and there is an alias table for the block
+    totals and one inside each block. Updating some weights thus only
+    rebuilds the touched blocks and the small table of block totals rather
+    than the whole O(N) table.
+    :param weights: non-negative weight of each sample
+    :param block_size: number of samples in a block, defaults to sqrt(N)
+    """
+    def __init__(self, weights, block_size=None):
+        self.weights = np.array(weights, dtype=np.float64)
+        n = len(self.weights)
+        self.block_size = block_size or max(int(np.sqrt(n)), 1)
+        self._starts = np.arange(0, n, self.block_size)
+        self._sizes = np.minimum(self.block_size, n - self._starts)
+
+        self._prob = np.empty(n)
+        self._alias = np.empty(n, dtype=np.int64)
+        self._block_weights = np.empty(len(self._starts))
+        self._build_blocks(np.arange(len(self._starts)))
+
+    @classmethod
+    def class_balanced(cls, labels, class_weights=None, **kwargs):
+        """
+        Sampler drawing each class with the same probability, or with
+        probability proportional to `class_weights` if specified.
+        """
+        labels = np.asarray(labels)
+        counts = np.bincount(labels)
+        if class_weights is None:
+            class_weights = np.ones(len(counts))
+        per_sample = np.asarray(class_weights, dtype=np.float64)[labels]
+        return cls(per_sample / counts[labels], **kwargs)
+
+    def __len__(self):
+        return len(self.weights)
+
+    def sample(self, n):
+        """Draw `n` indices with replacement."""
+        blocks = alias_sample(self._block_prob, self._block_alias, n)
+        idx = self._starts[blocks] + np.random.randint(self._sizes[blocks])
+        keep = np.random.uniform(size=n) < self._prob[idx]
+        return np.where(keep, idx, self._alias[idx])
+
+    def update(self, indices, weights):
+        """Set the weights of samples at `indices`."""
+        indices = np.asarray(indices)
+        self.weights[indices] = weights
+        self._build_blocks(np.unique(indices // self.block_size))
+
+    def _build_blocks(self, blocks):
+        for block in blocks:
+            start = self._starts[block]
+            end = start + self._sizes[block]
+            w = self.weights[start: end]
+            prob, alias = build_alias_table(w)
+            self._prob[start: end] = prob
+            self._alias[start: end] = alias + start
+            self._block_weights[block] = w.sum()
+        self._block_prob, self._block_alias = build_alias_table(
+            self._block_weights)
+
+
+class ImportanceSampler(WeightedSampler):
+    """
+    Draw samples in proportion to their most recent loss, so training
+    spends fewer passes on examples that are already learned. A fraction
+    `uniform_ratio` of the draws is uniform, which keeps revisiting the
+    examples whose recorded loss is stale and bounds the importance
+    weights by 1 / uniform_ratio.
+
+    Losses are recorded with `record` after each batch and the sampling
+    distribution is rebuilt from them at each `sample` call, i.e. once per
+    epoch in BatchIterator. Weighting the loss of sample i with
+    `importance_weights` = 1 / (N * p_i) keeps the gradient an unbiased
+    estimate of the full-dataset gradient, e.g.
+        iterator = BatchIterator(batch_size=128, sampler=sampler)
+        for batch in iterator(train_x, train_y):
+            weights = sampler.importance_weights(batch.indices)
+            loss, grads, losses = model.weighted_backward(
+                model.forward(batch.inputs), batch.targets, weights)
+            model.apply_grads(grads)
+            sampler.record(batch.indices, losses)
+    :param num_samples: size of the dataset
+    :param uniform_ratio: fraction of uniform draws
+    :param init_loss: loss of examples not seen yet, defaults to the
+        largest recorded loss
+    """
+    def __init__(self, num_samples, uniform_ratio=0.3, init_loss=None,
+                 block_size=None):
+        # the whole table is rebuilt at once, thus one block by default
+        super().__init__(np.ones(num_samples), block_size or num_samples)
+        self.uniform_ratio = uniform_ratio
+        self.init_loss = init_loss
+        self.losses = np.full(num_samples, np.nan, dtype=np.float32)
+
+    def record(self, indices, losses):
+        """Record the recent losses of samples at `indices`."""
+        self.losses[indices] = losses
+
+    def sample(self, n):
+        """Draw `n` indices with the distribution of the recorded losses."""
+        init_loss = self.init_loss
+        unseen = np.isnan(self.losses)
+        if init_loss is None:
+            seen_losses = self.losses[~unseen]
+            init_loss = np.max(seen_losses) if len(seen_losses) else 1.0
+        self.weights[:] = np.where(unseen, init_loss, self.losses)
+        self._build_blocks(np.arange(len(self._starts)))
+
+        idx = super().sample(n)
+        uniform = np.random.uniform(size=n) < self.uniform_ratio
+        idx[uniform] = np.random.randint(len(self), size=np.sum(uniform))
+        return idx
+
+    def probability(self, indices):
+        """Probability of drawing samples at `indices` with `sample`."""
+        n = len(self)
+        total = np.sum(self._block_weights)
+        p = self.weights[indices] / total if total > 0 else 1.0 / n
+        return self.uniform_ratio / n + (1.0 - self.uniform_ratio) * p
+
+    def importance_weights(self, indices):
+        """Loss weights 1 / (N * p) of samples at `indices`."""
+        return 1.0 / (len(self) * self.probability(indices))
+
+
+def build_alias_table(weights):
+    """
+    Build the alias table of a discrete distribution in O(N).
+    Bucket i is kept with probability prob[i] and replaced by alias[i]
+    otherwise. Under-full buckets are filled from over-full ones a round at
+    a time, where each over-full bucket takes as many under-full ones as
+    its excess allows, so the number of rounds stays small.
+    """
+    n = len(weights)
+    total = np.sum(weights)
+    prob = weights * (n / total) if total > 0 else np.ones(n)
+    alias = np.arange(n)
+
+    small = np.flatnonzero(prob < 1.0)
+    large = np.flatnonzero(prob >= 1.0)
+    while len(small) and len(large):
+        # assign each under-full bucket to the over-full bucket whose excess
+        # covers the end of its cumulative deficit
+        # (the total deficit equals the total excess, the clip only fixes
+        # rounding errors)
+        deficit = 1.0 - prob[small]
+        excess_end = np.cumsum(prob[large] - 1.0)
+        owner = np.minimum(np.searchsorted(excess_end, np.cumsum(deficit)),
+                           len(large) - 1)
+        alias[small] = large[owner]
+        prob[large] -= np.bincount(owner, weights=deficit, minlength=len(large))
+        now_small = prob[large] < 1.0
+        small = large[now_small]
+        large = large[~now_small]
+    # leftovers are full up to rounding errors
+    prob[small] = 1.0
+    prob[large] = 1.0
+    return prob, alias
+
+
+def alias_sample(prob, alias, n):
+    """Draw `n` samples from an alias table."""
+    idx = np.random.randint(len(prob), size=n)
+    keep = np.random.uniform(size=n) < prob[idx]
+    return np.where(keep, idx, alias[idx])
@@ -0,0 +1,105 @@
+"""Datasets shared by processes without copies."""
+
+import mmap
+import os
+import tempfile
+
+import numpy as np
+
+ALIGNMENT = 64
+
+
+class SharedDataset:
+    """
+    Arrays shared by processes on the same machine without copying them.
+    The arrays are written once to a memory-mapped file and pickling a
+    SharedDataset (e.g. to pass it to multiprocessing workers or ray
+    actors) only sends a handle, the file name and the array layouts,
+    which reattaches as read-only NumPy views of the same memory pages.
+    Arrays that already are memory maps of a file, e.g. the datasets of
+    tinynn.utils.dataset, are referenced in place and not copied at all.
+
+    It unpacks to its arrays like a tuple, e.g. `train_x, train_y = shared`.
+    :param arrays: arrays with the same number of samples
+    :param dir: directory of the file, e.g. "/dev/shm" to keep it in
+        memory, defaults to the temporary directory
+    """
+    def __init__(self, arrays, dir=None):
+        self._path = None
+        self._specs = []
+        pending = []
+        offset = 0
+        for array in arrays:
+            if _is_file_backed(array):
+                self._specs.append((array.filename, array.offset,
+                                    array.shape, array.dtype.str))
+                continue
+            array = np.asarray(array)
+            offset = -(-offset // ALIGNMENT) * ALIGNMENT
+            self._specs.append((None, offset, array.shape, array.dtype.str))
+            pending.append((array, offset))
+            offset += array.nbytes
+
+        if pending:
+            fd, self._path = tempfile.mkstemp(suffix=".shared", dir=dir)
+            with os.fdopen(fd, "wb") as f:
+                f.truncate(max(offset, 1))
+            self._specs = [(spec[0] or self._path, *spec[1:])
+                           for spec in self._specs]
+            for array, offset in pending:
+                if array.size:
+                    view = np.memmap(self._path, dtype=array.dtype, mode="r+",
+                                     offset=offset, shape=array.shape)
+                    view[...] = array
+                    view.flush()
+        self._attach()
+
+    def shard(self, rank, num_shards):
+        """
+        Samples rank, rank + num_shards, rank + 2 * num_shards, ... of the
+        arrays, as views. Shards of different ranks do not overlap and
+        together cover the dataset.
+        """
+        return tuple(array[rank::num_shards] for array in self.arrays)
+
+    def close(self):
+        """Drop the views and delete the file if it was created here."""
+        self.arrays = ()
+        if self._path is not None:
+            # processes which are attached keep their mapping
+            os.remove(self._path)
+            self._path = None
+
+    def _attach(self):
+        self.arrays = tuple(
+            np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+            if np.prod(shape) else np.empty(shape, dtype=dtype)
+            for path, offset, shape, dtype in self._specs)
+
+    def __getstate__(self):
+        return {"specs": self._specs}
+
+    def __setstate__(self, state):
+        # only the process that created the file deletes it
+        self._path = None
+        self._specs = state["specs"]
+        self._attach()
+
+    def __getitem__(self, i):
+        return self.arrays[i]
+
+    def __iter__(self):
+        return iter(self.arrays)
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __del__(self):
+        self.close()
+
+
+def _is_file_backed(array):
+    # a memmap owning its mapping (not a view of one) has a valid offset
+    return (isinstance(array, np.memmap) and array.filename is not None and
+            isinstance(array.base, mmap.mmap) and
+            array.flags.c_contiguous)